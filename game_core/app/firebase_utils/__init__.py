@@ -1,2 +1,13 @@
+from typing import Any
+
 from firebase_admin import firestore  # type:  ignore
-from .firebase import app, db
+from .firebase import get_app, get_backend, use_backend
+from .backend import Backend, FirestoreBackend, MemoryBackend
+from . import firebase as _firebase
+
+
+def __getattr__(name: str) -> Any:
+    """ app, client and db are created lazily on first access """
+    if name in ("app", "client", "db"):
+        return getattr(_firebase, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,138 @@
+""" Storage backends for the ORM """
+
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional
+from abc import ABC, abstractmethod
+from threading import Lock
+from firebase_admin import firestore, firestore_async  # type:  ignore
+from google.cloud.firestore_v1.query import CollectionGroup  # type: ignore
+
+from .memory import MemoryClient, MemoryAsyncClient
+
+
+class Backend(ABC):
+    """A client implementing (at least the ORM's subset of) the firestore client
+    API, and the root that collections are created under
+    """
+
+    def __init__(self, client: Any, testing: bool = False):
+        self.client = client
+        self.testing = testing
+        self.db = self.root(client)
+        self.collections: Dict[str, Any] = {}
+
+        # the async client is only created if async access is used
+        self._lock = Lock()
+        self._async_client: Optional[Any] = None
+        self.async_collections: Dict[str, Any] = {}
+
+    def root(self, client: Any) -> Any:
+        """ Where collections are created for a client """
+        return client.collection("test").document("testing") if self.testing else client
+
+    def collection(self, collection: str) -> Any:
+        """ Reference to a top-level collection, memoized per backend """
+        if collection not in self.collections:
+            self.collections[collection] = self.db.collection(collection)
+        return self.collections[collection]
+
+    def batch(self) -> Any:
+        """ New write batch """
+        return self.client.batch()
+
+    def get_all(self, references: Iterable[Any]) -> Iterable[Any]:
+        """ Fetch several documents in one call """
+        return self.client.get_all(references)
+
+    def partition_keys(self, collection: str, count: int) -> List[str]:
+        """Keys splitting a collection into up to count ranges of about the same
+        size, ranges run from one key up to the next
+        """
+        doc_refs = self.collection(collection).list_documents()
+        keys = sorted(doc_ref.id for doc_ref in doc_refs)
+        if len(keys) < count:
+            return []
+        return [keys[len(keys) * index // count] for index in range(1, count)]
+
+    def write_option(self, **kwargs) -> Any:
+        """ Precondition for writes """
+        return self.client.write_option(**kwargs)
+
+    @abstractmethod
+    def create_async_client(self) -> Any:
+        """ Async client for the same database as client """
+        return NotImplemented
+
+    @property
+    def async_client(self) -> Any:
+        """ Async client, created on first use """
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    self._async_client = self.create_async_client()
+        return self._async_client
+
+    def async_collection(self, collection: str) -> Any:
+        """ Async reference to a top-level collection, memoized per backend """
+        if collection not in self.async_collections:
+            root = self.root(self.async_client)
+            self.async_collections[collection] = root.collection(collection)
+        return self.async_collections[collection]
+
+    def async_get_all(self, references: Iterable[Any]) -> AsyncIterator[Any]:
+        """ Fetch several documents in one call, asynchronously """
+        return self.async_client.get_all(references)
+
+
+class FirestoreBackend(Backend):
+    """ Backend storing data in firestore """
+
+    def __init__(self, testing: bool = False):
+        super().__init__(firestore.client(self.app()), testing)
+
+    @staticmethod
+    def app() -> Any:
+        from .firebase import get_app  # pylint: disable=import-outside-toplevel
+
+        return get_app()
+
+    def create_async_client(self) -> Any:
+        return firestore_async.client(self.app())
+
+    def partition_keys(self, collection: str, count: int) -> List[str]:
+        """Split points from a partition query, without reading every key. Only
+        collection group queries can be partitioned, so the group is rooted at
+        the backend's root and split points in other collections are dropped
+        """
+        collection_ref = self.collection(collection)
+        root = self.root_path(collection_ref)
+        query = CollectionGroup(collection_ref)
+        return sorted(
+            {
+                partition.end_at.id
+                for partition in query.get_partitions(count)
+                if partition.end_at is not None
+                and self.root_path(partition.end_at.parent) == root
+            }
+        )
+
+    @staticmethod
+    def root_path(collection_ref: Any) -> Optional[str]:
+        """ Path of the document a collection is under, None for the database """
+        parent = collection_ref.parent
+        return None if parent is None else parent.path
+
+
+class MemoryBackend(Backend):
+    """ Backend keeping data in the process, for tests and load testing """
+
+    def __init__(self, testing: bool = False):
+        super().__init__(MemoryClient(), testing)
+
+    def create_async_client(self) -> Any:
+        return MemoryAsyncClient(self.client)
+
+
+backends: Dict[str, Callable[..., Backend]] = {
+    "firestore": FirestoreBackend,
+    "memory": MemoryBackend,
+}
@@ -1,12 +1,61 @@
+from threading import Lock
+from typing import Any, Optional
+
 from environs import Env
 import firebase_admin  # type:  ignore
-from firebase_admin import firestore  # type:  ignore
+
+from .backend import Backend, backends
 
 env = Env()
 environment = env("ENVIRONMENT", "production")
+storage_backend = env("STORAGE_BACKEND", "firestore")
+
+if storage_backend not in backends:
+    raise ValueError(f"Unknown storage backend {storage_backend}")
+
+# app and backend are created on first use, so requests that never touch
+# storage (e.g. rejected webhooks) don't pay for client setup on cold start
+_lock = Lock()
+_app: Optional[firebase_admin.App] = None
+_backend: Optional[Backend] = None
+
+
+def get_app() -> firebase_admin.App:
+    """ The firebase app, initialized on first use """
+    global _app  # pylint: disable=global-statement,invalid-name
+    if _app is None:
+        with _lock:
+            if _app is None:
+                _app = firebase_admin.initialize_app()
+    return _app
+
+
+def get_backend() -> Backend:
+    """ The backend the ORM currently stores data in, created on first use """
+    global _backend  # pylint: disable=global-statement,invalid-name
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = backends[storage_backend](testing=environment == "testing")
+    return _backend
+
+
+def use_backend(new_backend: Optional[Backend]) -> Optional[Backend]:
+    """Switch the backend the ORM stores data in, returns the previous one.
+    None goes back to lazily creating the configured backend
+    """
+    global _backend  # pylint: disable=global-statement,invalid-name
+    with _lock:
+        previous, _backend = _backend, new_backend
+    return previous
 
-app = firebase_admin.initialize_app()
-db = firestore.client()
 
-if environment == "testing":
-    db = db.collection("test").document("testing")
+def __getattr__(name: str) -> Any:
+    """ Lazy access to app, client and db for backwards compatibility """
+    if name == "app":
+        return get_app()
+    if name == "client":
+        return get_backend().client
+    if name == "db":
+        return get_backend().db
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,698 @@
+""" In-process storage backend mirroring the subset of the Firestore client we use """
+
+from __future__ import annotations
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from datetime import datetime, timedelta, timezone
+import operator
+import threading
+import uuid
+
+from google.api_core.exceptions import (  # type: ignore
+    AlreadyExists,
+    FailedPrecondition,
+    NotFound,
+)
+from google.cloud.firestore_v1 import transforms  # type: ignore
+
+# firestore's name for the document id pseudo-field
+DOCUMENT_ID = "__name__"
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda left, right: left in right,
+    "not-in": lambda left, right: left not in right,
+    "array_contains": lambda left, right: isinstance(left, list) and right in left,
+    "array_contains_any": lambda left, right: isinstance(left, list)
+    and any(item in left for item in right),
+}
+
+ASCENDING = "ASCENDING"
+DESCENDING = "DESCENDING"
+
+_MISSING = object()
+
+
+def _copy(value: Any) -> Any:
+    """ Copy of a document value, cheaper than deepcopy as leaves are immutable """
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _apply(current: Dict[str, Any], data: Dict[str, Any], now: datetime) -> None:
+    """ Write field values and transforms into a stored document in-place """
+    for field, value in data.items():
+        if value is transforms.SERVER_TIMESTAMP:
+            current[field] = now
+        elif value is transforms.DELETE_FIELD:
+            current.pop(field, None)
+        elif isinstance(value, transforms.ArrayUnion):
+            existing = list(current.get(field) or [])
+            existing.extend(item for item in value.values if item not in existing)
+            current[field] = existing
+        elif isinstance(value, transforms.ArrayRemove):
+            current[field] = [
+                item for item in current.get(field) or [] if item not in value.values
+            ]
+        elif isinstance(value, transforms.Increment):
+            current[field] = (current.get(field) or 0) + value.value
+        else:
+            current[field] = _copy(value)
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    """ Sort key following firestore's ordering of value types """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, bytes):
+        return (5, value)
+    if isinstance(value, list):
+        return (6, [_sort_key(item) for item in value])
+    return (7, repr(value))
+
+
+class MemoryWriteOption:
+    """ Precondition for a write, see Client.write_option() """
+
+    def __init__(
+        self, last_update_time: Optional[datetime] = None, exists: Optional[bool] = None
+    ):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+    def check(self, stored: Optional[_StoredDocument]) -> None:
+        if self.exists is not None and self.exists != (stored is not None):
+            raise FailedPrecondition("Document existence precondition failed")
+        if self.last_update_time is not None:
+            if stored is None or stored.update_time != self.last_update_time:
+                raise FailedPrecondition("Document update_time precondition failed")
+
+
+class MemoryWriteResult:
+    """ Mirrors firestore WriteResult """
+
+    def __init__(self, update_time: datetime):
+        self.update_time = update_time
+
+
+class _StoredDocument:
+    """ A document as held by the store """
+
+    def __init__(
+        self, data: Dict[str, Any], create_time: datetime, update_time: datetime
+    ):
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+
+class MemoryDocumentSnapshot:
+    """ Mirrors firestore DocumentSnapshot """
+
+    def __init__(
+        self,
+        reference: MemoryDocumentReference,
+        data: Optional[Dict[str, Any]],
+        create_time: Optional[datetime] = None,
+        update_time: Optional[datetime] = None,
+    ):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return _copy(self._data)
+
+    def get(self, field_path: str) -> Any:
+        if self._data is None or field_path not in self._data:
+            raise KeyError(field_path)
+        return _copy(self._data[field_path])
+
+
+class MemoryDocumentReference:
+    """ Mirrors firestore DocumentReference """
+
+    def __init__(self, client: MemoryClient, path: Tuple[str, ...]):
+        self._client = client
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def path(self) -> str:
+        return "/".join(self._path)
+
+    @property
+    def parent(self) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self._client, self._path[:-1])
+
+    def collection(self, collection_id: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self._client, self._path + (collection_id,))
+
+    def get(
+        self, field_paths: Optional[Iterable[str]] = None
+    ) -> MemoryDocumentSnapshot:
+        return self._client._snapshot(self, field_paths)
+
+    def create(self, document_data: Dict[str, Any]) -> MemoryWriteResult:
+        return self._client._write(self, document_data, create=True)
+
+    def set(
+        self,
+        document_data: Dict[str, Any],
+        merge: Union[bool, List[str]] = False,
+    ) -> MemoryWriteResult:
+        return self._client._write(self, document_data, merge=merge)
+
+    def update(
+        self, field_updates: Dict[str, Any], option: Optional[MemoryWriteOption] = None
+    ) -> MemoryWriteResult:
+        return self._client._write(self, field_updates, update=True, option=option)
+
+    def delete(self, option: Optional[MemoryWriteOption] = None) -> None:
+        self._client._delete(self, option)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MemoryDocumentReference) and self._path == other._path
+
+    def __hash__(self) -> int:
+        return hash(self._path)
+
+
+class MemoryQuery:
+    """ Mirrors firestore Query, immutable like the real thing """
+
+    def __init__(
+        self,
+        parent: MemoryCollectionReference,
+        filters: Tuple[Tuple[str, str, Any], ...] = (),
+        orders: Tuple[Tuple[str, str], ...] = (),
+        limit: Optional[int] = None,
+        start_after: Optional[Dict[str, Any]] = None,
+        projection: Optional[Tuple[str, ...]] = None,
+    ):
+        self._parent = parent
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **kwargs) -> MemoryQuery:
+        params: Dict[str, Any] = dict(
+            filters=self._filters,
+            orders=self._orders,
+            limit=self._limit,
+            start_after=self._start_after,
+            projection=self._projection,
+        )
+        params.update(kwargs)
+        return MemoryQuery(self._parent, **params)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> MemoryQuery:
+        if op_string not in OPERATORS:
+            raise ValueError(f"Unsupported operator {op_string}")
+        # keys are compared as document references, as in firestore
+        if field_path == DOCUMENT_ID and not isinstance(value, str):
+            value = value.id
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> MemoryQuery:
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> MemoryQuery:
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields: Any) -> MemoryQuery:
+        if isinstance(document_fields, MemoryDocumentSnapshot):
+            cursor = document_fields.to_dict() or {}
+            cursor[DOCUMENT_ID] = document_fields.id
+        else:
+            cursor = dict(document_fields)
+            if isinstance(cursor.get(DOCUMENT_ID), MemoryDocumentReference):
+                cursor[DOCUMENT_ID] = cursor[DOCUMENT_ID].id
+        return self._copy(start_after=cursor)
+
+    def select(self, field_paths: Iterable[str]) -> MemoryQuery:
+        return self._copy(projection=tuple(field_paths))
+
+    def _value(self, doc_id: str, data: Dict[str, Any], field: str) -> Any:
+        if field == DOCUMENT_ID:
+            return doc_id
+        return data.get(field, _MISSING)
+
+    def _ordering(self) -> List[Tuple[str, str]]:
+        orders = list(self._orders)
+        # like firestore, inequality filters imply ordering on that field first
+        for field, op_string, _ in self._filters:
+            if op_string in ("<", "<=", ">", ">=", "!=", "not-in") and not any(
+                field == order_field for order_field, _ in orders
+            ):
+                orders.insert(0, (field, ASCENDING))
+        if not any(field == DOCUMENT_ID for field, _ in orders):
+            orders.append((DOCUMENT_ID, ASCENDING))
+        return orders
+
+    def _matches(self, doc_id: str, data: Dict[str, Any]) -> bool:
+        for field, op_string, value in self._filters:
+            left = self._value(doc_id, data, field)
+            if left is _MISSING:
+                return False
+            # firestore never matches null against ordering comparisons
+            if left is None and op_string not in ("==", "in"):
+                return False
+            try:
+                if not OPERATORS[op_string](left, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def _after_cursor(self, orders: List[Tuple[str, str]], doc_id: str, data) -> bool:
+        cursor = self._start_after or {}
+        for field, direction in orders:
+            if field not in cursor:
+                continue
+            left = _sort_key(self._value(doc_id, data, field))
+            right = _sort_key(cursor[field])
+            if left != right:
+                return (left > right) == (direction == ASCENDING)
+        return False
+
+    def stream(self) -> Iterator[MemoryDocumentSnapshot]:
+        client = self._parent._client
+        orders = self._ordering()
+
+        with client._lock:
+            rows = [
+                (doc_id, stored)
+                for doc_id, stored in client._collection(self._parent._path).items()
+                if self._matches(doc_id, stored.data)
+                and all(
+                    self._value(doc_id, stored.data, field) is not _MISSING
+                    for field, _ in orders
+                )
+            ]
+
+            # stable sorts from the least significant order
+            for field, direction in reversed(orders):
+                rows.sort(
+                    key=lambda row: _sort_key(self._value(row[0], row[1].data, field)),
+                    reverse=direction == DESCENDING,
+                )
+
+            # rows after the cursor form a suffix, so bisect for the start
+            start, end = 0, len(rows)
+            if self._start_after is not None:
+                while start < end:
+                    middle = (start + end) // 2
+                    doc_id, stored = rows[middle]
+                    if self._after_cursor(orders, doc_id, stored.data):
+                        end = middle
+                    else:
+                        start = middle + 1
+            rows = rows[start:]
+
+            if self._limit is not None:
+                rows = rows[: self._limit]
+
+            snapshots = []
+            for doc_id, stored in rows:
+                data = stored.data
+                if self._projection is not None:
+                    data = {
+                        field: data[field]
+                        for field in self._projection
+                        if field in data
+                    }
+                snapshots.append(
+                    MemoryDocumentSnapshot(
+                        self._parent.document(doc_id),
+                        data,
+                        stored.create_time,
+                        stored.update_time,
+                    )
+                )
+
+        yield from snapshots
+
+    def get(self) -> List[MemoryDocumentSnapshot]:
+        return list(self.stream())
+
+
+class MemoryCollectionReference(MemoryQuery):
+    """ Mirrors firestore CollectionReference """
+
+    def __init__(self, client: MemoryClient, path: Tuple[str, ...]):
+        self._client = client
+        self._path = path
+        super().__init__(self)
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    def document(self, document_id: Optional[str] = None) -> MemoryDocumentReference:
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return MemoryDocumentReference(self._client, self._path + (document_id,))
+
+    def add(
+        self, document_data: Dict[str, Any]
+    ) -> Tuple[datetime, MemoryDocumentReference]:
+        doc_ref = self.document()
+        return doc_ref.create(document_data).update_time, doc_ref
+
+    def list_documents(self) -> Iterator[MemoryDocumentReference]:
+        with self._client._lock:
+            doc_ids = list(self._client._collection(self._path))
+        for doc_id in doc_ids:
+            yield self.document(doc_id)
+
+
+class MemoryWriteBatch:
+    """ Mirrors firestore WriteBatch, writes are applied atomically on commit """
+
+    def __init__(self, client: MemoryClient):
+        self._client = client
+        self._writes: List[Tuple[MemoryDocumentReference, Dict[str, Any]]] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def create(self, reference: MemoryDocumentReference, document_data: dict) -> None:
+        self._writes.append((reference, dict(data=document_data, create=True)))
+
+    def set(
+        self,
+        reference: MemoryDocumentReference,
+        document_data: dict,
+        merge: Union[bool, List[str]] = False,
+    ) -> None:
+        self._writes.append((reference, dict(data=document_data, merge=merge)))
+
+    def update(
+        self,
+        reference: MemoryDocumentReference,
+        field_updates: dict,
+        option: Optional[MemoryWriteOption] = None,
+    ) -> None:
+        self._writes.append(
+            (reference, dict(data=field_updates, update=True, option=option))
+        )
+
+    def delete(
+        self,
+        reference: MemoryDocumentReference,
+        option: Optional[MemoryWriteOption] = None,
+    ) -> None:
+        self._writes.append((reference, dict(data=None, option=option)))
+
+    def commit(self) -> List[MemoryWriteResult]:
+        with self._client._lock:
+            # stored documents are never changed in place, so keeping hold of
+            # them is enough to roll back if any write fails
+            backup = {
+                reference._path: self._client._stored(reference)
+                for reference, _ in self._writes
+            }
+            results = []
+            try:
+                for reference, kwargs in self._writes:
+                    if kwargs["data"] is None:
+                        self._client._delete(reference, kwargs["option"])
+                        results.append(MemoryWriteResult(self._client._now()))
+                    else:
+                        results.append(self._client._write(reference, **kwargs))
+            except Exception:
+                for path, stored in backup.items():
+                    collection = self._client._collection(path[:-1])
+                    if stored is None:
+                        collection.pop(path[-1], None)
+                    else:
+                        collection[path[-1]] = stored
+                raise
+
+        self._writes = []
+        return results
+
+
+class MemoryClient:
+    """ Mirrors the firestore Client, holding all documents in dicts per collection """
+
+    def __init__(self):
+        self._collections: Dict[Tuple[str, ...], Dict[str, _StoredDocument]] = {}
+        self._lock = threading.RLock()
+        self._last_time: Optional[datetime] = None
+
+    def _now(self) -> datetime:
+        """ Strictly increasing timestamps, so update_time preconditions are exact """
+        now = datetime.now(timezone.utc)
+        if self._last_time is not None and now <= self._last_time:
+            now = self._last_time + timedelta(microseconds=1)
+        self._last_time = now
+        return now
+
+    def _collection(self, path: Tuple[str, ...]) -> Dict[str, _StoredDocument]:
+        return self._collections.setdefault(path, {})
+
+    def _stored(self, reference: MemoryDocumentReference) -> Optional[_StoredDocument]:
+        return self._collection(reference._path[:-1]).get(reference.id)
+
+    def collection(self, collection_id: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self, (collection_id,))
+
+    def document(self, *document_path: str) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self, tuple("/".join(document_path).split("/")))
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    @staticmethod
+    def write_option(**kwargs) -> MemoryWriteOption:
+        return MemoryWriteOption(**kwargs)
+
+    def get_all(
+        self,
+        references: Iterable[MemoryDocumentReference],
+        field_paths: Optional[Iterable[str]] = None,
+    ) -> Iterator[MemoryDocumentSnapshot]:
+        for reference in dict.fromkeys(references):
+            yield self._snapshot(reference, field_paths)
+
+    def _snapshot(
+        self,
+        reference: MemoryDocumentReference,
+        field_paths: Optional[Iterable[str]] = None,
+    ) -> MemoryDocumentSnapshot:
+        with self._lock:
+            stored = self._stored(reference)
+            if stored is None:
+                return MemoryDocumentSnapshot(reference, None)
+
+            data = stored.data
+            if field_paths is not None:
+                data = {field: data[field] for field in field_paths if field in data}
+            return MemoryDocumentSnapshot(
+                reference, data, stored.create_time, stored.update_time
+            )
+
+    def _write(
+        self,
+        reference: MemoryDocumentReference,
+        data: Dict[str, Any],
+        create: bool = False,
+        update: bool = False,
+        merge: Union[bool, List[str]] = False,
+        option: Optional[MemoryWriteOption] = None,
+    ) -> MemoryWriteResult:
+        with self._lock:
+            stored = self._stored(reference)
+            if option is not None:
+                option.check(stored)
+            if create and stored is not None:
+                raise AlreadyExists(f"Document already exists: {reference.path}")
+            if update and stored is None:
+                raise NotFound(f"No document to update: {reference.path}")
+
+            now = self._now()
+            if stored is None:
+                document: Dict[str, Any] = {}
+                create_time = now
+            else:
+                document = dict(stored.data) if update or merge else {}
+                create_time = stored.create_time
+
+            if isinstance(merge, list):
+                data = {field: data[field] for field in merge if field in data}
+            _apply(document, data, now)
+
+            # documents are replaced rather than changed in place, so snapshots
+            # holding on to the old one are unaffected
+            self._collection(reference._path[:-1])[reference.id] = _StoredDocument(
+                document, create_time, now
+            )
+            return MemoryWriteResult(now)
+
+    def _delete(
+        self,
+        reference: MemoryDocumentReference,
+        option: Optional[MemoryWriteOption] = None,
+    ) -> None:
+        with self._lock:
+            if option is not None:
+                option.check(self._stored(reference))
+            self._collection(reference._path[:-1]).pop(reference.id, None)
+
+
+class MemoryAsyncDocumentReference:
+    """ Mirrors firestore AsyncDocumentReference """
+
+    def __init__(self, reference: MemoryDocumentReference):
+        self._reference = reference
+
+    @property
+    def id(self) -> str:
+        return self._reference.id
+
+    @property
+    def path(self) -> str:
+        return self._reference.path
+
+    def collection(self, collection_id: str) -> MemoryAsyncCollectionReference:
+        return MemoryAsyncCollectionReference(self._reference.collection(collection_id))
+
+    async def get(
+        self, field_paths: Optional[Iterable[str]] = None
+    ) -> MemoryDocumentSnapshot:
+        return self._reference.get(field_paths)
+
+    async def create(self, document_data: Dict[str, Any]) -> MemoryWriteResult:
+        return self._reference.create(document_data)
+
+    async def set(
+        self,
+        document_data: Dict[str, Any],
+        merge: Union[bool, List[str]] = False,
+    ) -> MemoryWriteResult:
+        return self._reference.set(document_data, merge=merge)
+
+    async def update(
+        self, field_updates: Dict[str, Any], option: Optional[MemoryWriteOption] = None
+    ) -> MemoryWriteResult:
+        return self._reference.update(field_updates, option=option)
+
+    async def delete(self, option: Optional[MemoryWriteOption] = None) -> None:
+        self._reference.delete(option=option)
+
+
+class MemoryAsyncQuery:
+    """ Mirrors firestore AsyncQuery """
+
+    def __init__(self, query: MemoryQuery):
+        self._query = query
+
+    def where(self, field_path: str, op_string: str, value: Any) -> MemoryAsyncQuery:
+        return MemoryAsyncQuery(self._query.where(field_path, op_string, value))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> MemoryAsyncQuery:
+        return MemoryAsyncQuery(self._query.order_by(field_path, direction))
+
+    def limit(self, count: int) -> MemoryAsyncQuery:
+        return MemoryAsyncQuery(self._query.limit(count))
+
+    def start_after(self, document_fields: Any) -> MemoryAsyncQuery:
+        return MemoryAsyncQuery(self._query.start_after(document_fields))
+
+    def select(self, field_paths: Iterable[str]) -> MemoryAsyncQuery:
+        return MemoryAsyncQuery(self._query.select(field_paths))
+
+    async def stream(self) -> AsyncIterator[MemoryDocumentSnapshot]:
+        for snapshot in self._query.stream():
+            yield snapshot
+
+    async def get(self) -> List[MemoryDocumentSnapshot]:
+        return self._query.get()
+
+
+class MemoryAsyncCollectionReference(MemoryAsyncQuery):
+    """ Mirrors firestore AsyncCollectionReference """
+
+    _query: MemoryCollectionReference
+
+    @property
+    def id(self) -> str:
+        return self._query.id
+
+    def document(
+        self, document_id: Optional[str] = None
+    ) -> MemoryAsyncDocumentReference:
+        return MemoryAsyncDocumentReference(self._query.document(document_id))
+
+    async def add(
+        self, document_data: Dict[str, Any]
+    ) -> Tuple[datetime, MemoryAsyncDocumentReference]:
+        update_time, doc_ref = self._query.add(document_data)
+        return update_time, MemoryAsyncDocumentReference(doc_ref)
+
+
+class MemoryAsyncClient:
+    """ Mirrors the firestore AsyncClient, sharing the documents of a MemoryClient """
+
+    def __init__(self, client: MemoryClient):
+        self._client = client
+
+    def collection(self, collection_id: str) -> MemoryAsyncCollectionReference:
+        return MemoryAsyncCollectionReference(self._client.collection(collection_id))
+
+    def document(self, *document_path: str) -> MemoryAsyncDocumentReference:
+        return MemoryAsyncDocumentReference(self._client.document(*document_path))
+
+    @staticmethod
+    def write_option(**kwargs) -> MemoryWriteOption:
+        return MemoryWriteOption(**kwargs)
+
+    async def get_all(
+        self,
+        references: Iterable[MemoryAsyncDocumentReference],
+        field_paths: Optional[Iterable[str]] = None,
+    ) -> AsyncIterator[MemoryDocumentSnapshot]:
+        unwrapped = [reference._reference for reference in references]
+        for snapshot in self._client.get_all(unwrapped, field_paths):
+            yield snapshot
@@ -1,6 +1,7 @@
 """ Game entity management """
 
 from __future__ import annotations
+from typing import cast
 
 from orm import Orm
 from user import User
@@ -15,7 +16,7 @@ class Game(Orm, collection="game", parent_orm=User):
     @classmethod
     def from_user(cls, user: User) -> Game:
         key = cls.make_key(user)
-        game = cls(key)
+        game = cast(Game, cls.get(key, load=False))
         game.parent_key = user.key
         return game
 
@@ -26,3 +27,14 @@ class Game(Orm, collection="game", parent_orm=User):
 
     def set_fork_url(self, fork_url: str) -> None:
         self.data.fork_url = fork_url
+
+    def set_fork_id(self, fork_id: int) -> None:
+        self.data.fork_id = fork_id
+
+    def is_fork(self, repo_id: int, full_name: str) -> bool:
+        """Whether a repo is the player's fork, by its id. Games saved before the
+        id was stored are matched by the full name in fork_url, the API url
+        """
+        if self.data.fork_id:
+            return self.data.fork_id == repo_id
+        return self.data.fork_url.lower().endswith(f"/repos/{full_name.lower()}")
@@ -6,3 +6,4 @@ class GameData(BaseModel):
     """ Data to store for game """
 
     fork_url: str = Field("", title="Url of player's fork")
+    fork_id: int = Field(0, title="ID of player's fork, 0 if not known yet")
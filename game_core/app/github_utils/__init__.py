@@ -1,2 +1,10 @@
-from .models import GitHubHookFork
-from .github import verify_signature, check_repo_ours
+from .models import (
+    GitHubHook,
+    GitHubHookActivity,
+    GitHubHookFork,
+    GitHubHookIssues,
+    GitHubHookIssueComment,
+    GitHubHookPush,
+    GitHubHookPullRequest,
+)
+from .github import verify_signature, check_repo_ours, parse_hook
@@ -1,18 +1,22 @@
 """ Verify the GitHub webhook secret """
 
+from typing import Optional, cast
 import hmac
 import hashlib
 
 from environs import Env
 from flask import Request
 
-from .models import GitHubHookFork
+from .models import GitHubHook, GitHubHookFork, HOOK_MODELS
 
 env = Env()
 
 WEBHOOK_SECRET = env("WEBHOOK_SECRET")
 OUR_REPO = env("OUR_REPO", "meseta/lgtm")
 
+# webhooks without an event header are forks, the only event hooked up at first
+DEFAULT_EVENT = "fork"
+
 
 def verify_signature(request: Request) -> bool:
     """ Validates the github webhook secret. Will return false if secret not provided """
@@ -28,3 +32,14 @@ def verify_signature(request: Request) -> bool:
 def check_repo_ours(hook_fork: GitHubHookFork) -> str:
     """ Check repo is valid and return the forked URL """
     return hook_fork.repository.full_name == OUR_REPO
+
+
+def parse_hook(request: Request) -> Optional[GitHubHook]:
+    """Parse a webhook payload by its event type, None if it's an event we don't
+    handle. Raises ValidationError if the payload doesn't fit its event
+    """
+    event = request.headers.get("X-GitHub-Event", DEFAULT_EVENT)
+    hook_model = HOOK_MODELS.get(event)
+    if hook_model is None:
+        return None
+    return cast(GitHubHook, hook_model.parse_raw(request.data))
@@ -1,4 +1,5 @@
 """ github-related models """
+from typing import Dict, Type, Union
 from pydantic import BaseModel, Field, Extra  # pylint: disable=no-name-in-module
 
 # pylint: disable=too-few-public-methods,missing-class-docstring
@@ -32,3 +33,82 @@ class GitHubHookFork(BaseModel):
 
     class Config:
         extra = Extra.ignore
+
+
+class GitHubIssue(BaseModel):
+    """ Issue entity for GitHub hooks, pull requests are issues too """
+
+    id: int = Field(..., title="Issue's ID")
+    number: int = Field(..., title="Issue's number in the repo")
+    title: str = Field(..., title="Issue's title")
+    state: str = Field(..., title="Whether the issue is open or closed")
+    user: GitHubUser = Field(..., title="Author of the issue")
+
+    class Config:
+        extra = Extra.ignore
+
+
+class GitHubComment(BaseModel):
+    """ Comment entity for GitHub hooks """
+
+    id: int = Field(..., title="Comment's ID")
+    body: str = Field(..., title="Comment text")
+    user: GitHubUser = Field(..., title="Author of the comment")
+
+    class Config:
+        extra = Extra.ignore
+
+
+class GitHubHookActivity(BaseModel):
+    """Base for webhook payloads of player activity on their fork, which is the
+    repository the event happened on
+    """
+
+    repository: GitHubRepository = Field(..., title="The fork the event is on")
+    sender: GitHubUser = Field(..., title="User that triggered the event")
+
+    class Config:
+        extra = Extra.ignore
+
+
+class GitHubHookIssues(GitHubHookActivity):
+    """ Webhook payload for GitHub issues hooks """
+
+    action: str = Field(..., title="What happened to the issue")
+    issue: GitHubIssue = Field(..., title="The issue")
+
+
+class GitHubHookIssueComment(GitHubHookActivity):
+    """ Webhook payload for GitHub issue_comment hooks """
+
+    action: str = Field(..., title="What happened to the comment")
+    issue: GitHubIssue = Field(..., title="The issue commented on")
+    comment: GitHubComment = Field(..., title="The comment")
+
+
+class GitHubHookPush(GitHubHookActivity):
+    """ Webhook payload for GitHub push hooks """
+
+    ref: str = Field(..., title="Full ref that was pushed to")
+    before: str = Field(..., title="Commit SHA before the push")
+    after: str = Field(..., title="Commit SHA after the push")
+
+
+class GitHubHookPullRequest(GitHubHookActivity):
+    """ Webhook payload for GitHub pull_request hooks """
+
+    action: str = Field(..., title="What happened to the pull request")
+    number: int = Field(..., title="Pull request's number in the repo")
+    pull_request: GitHubIssue = Field(..., title="The pull request")
+
+
+GitHubHook = Union[GitHubHookFork, GitHubHookActivity]
+
+# payload models by the X-GitHub-Event header, events not listed are ignored
+HOOK_MODELS: Dict[str, Type[BaseModel]] = {
+    "fork": GitHubHookFork,
+    "issues": GitHubHookIssues,
+    "issue_comment": GitHubHookIssueComment,
+    "push": GitHubHookPush,
+    "pull_request": GitHubHookPullRequest,
+}
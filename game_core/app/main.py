@@ -1,5 +1,18 @@
 """ Game core """
 
+from typing import (
+    Any,
+    ContextManager,
+    Generator,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
+from datetime import datetime, timezone
+from functools import partial
+from itertools import islice
+
 import structlog  # type: ignore
 from environs import Env
 
@@ -13,23 +26,64 @@ from firebase_admin.auth import (  # type:  ignore
     RevokedIdTokenError,
 )
 from github import Github, BadCredentialsException
+from pydantic import ValidationError
 
-from github_utils import verify_signature, check_repo_ours, GitHubHookFork
+from firebase_utils import get_app, get_backend
+from orm import Orm, OrmConflict, IdentityMap
+from github_utils import (
+    verify_signature,
+    check_repo_ours,
+    parse_hook,
+    GitHubHookFork,
+    GitHubHookActivity,
+)
 from user import User, Source, UserData
 from game import Game
 from quest_page import QuestPage
-from tick import TickEvent, TickType
+from quest import waiting_on_conditions
+from tick import (
+    TickEvent,
+    TickType,
+    TickBudget,
+    TickShard,
+    publish_ticks,
+    run_pipeline,
+)
 from framework import inject_http_model, inject_pubsub_model, StatusReturn
 
 env = Env()
 CORS_ORIGIN = env("CORS_ORIGIN", "https://lgtm.meseta.dev")
 
+# objects held by each invocation's identity scope, the least recently used are
+# dropped past it so ticks over many quests stay bounded, 0 leaves it unbounded
+ORM_CACHE_SIZE = env.int("ORM_CACHE_SIZE", 1000)
+
+# budgets keeping ticks inside the function timeout, 0 leaves them unlimited:
+# stages run per quest page, seconds per stage, and seconds for the whole tick
+TICK_MAX_STAGES = env.int("TICK_MAX_STAGES", 0)
+TICK_MAX_STAGE_TIME = env.float("TICK_MAX_STAGE_TIME", 0)
+TICK_DURATION = env.float("TICK_DURATION", 0)
+
+# quest pages loaded at a time, whose conditions are checked together
+TICK_CHUNK_SIZE = env.int("TICK_CHUNK_SIZE", 100)
+
+# quest pages waiting between fetching, executing and saving
+TICK_QUEUE_SIZE = env.int("TICK_QUEUE_SIZE", 8)
+
 logger = structlog.get_logger(__name__).bind(version=env("APP_VERSION", "test"))
 logger.info("Started")
 
 
+def invocation_scope() -> ContextManager[IdentityMap]:
+    """Identity scope for one invocation. Each gets a fresh map, objects aren't
+    kept between invocations of a warm instance, where another instance may
+    have changed them since
+    """
+    return Orm.identity_scope(IdentityMap(max_size=ORM_CACHE_SIZE or None))
+
+
 @inject_http_model
-def github_webhook_listener(request: Request, hook_fork: GitHubHookFork):
+def github_webhook_listener(request: Request):
     """ A listener for github webhooks """
 
     # verify
@@ -37,6 +91,24 @@ def github_webhook_listener(request: Request, hook_fork: GitHubHookFork):
         logger.error("Invalid signature")
         return StatusReturn(error="Invalid signature", http_code=403)
 
+    try:
+        hook = parse_hook(request)
+    except ValidationError as err:
+        logger.error("Validation error", err=err)
+        return StatusReturn(error="Validation error", http_code=400)
+
+    if isinstance(hook, GitHubHookFork):
+        return new_game_from_fork(hook)
+    if isinstance(hook, GitHubHookActivity):
+        return advance_game_from_activity(hook)
+
+    logger.info("Ignoring event", github_event=request.headers.get("X-GitHub-Event"))
+    return StatusReturn(success=True)
+
+
+def new_game_from_fork(hook_fork: GitHubHookFork) -> StatusReturn:
+    """ Create a game for a new fork of our repo, and start its first quest """
+
     # decode and check it's ours
     if not check_repo_ours(hook_fork):
         logger.error("Not our repo!", repo=hook_fork.repository.full_name)
@@ -45,27 +117,60 @@ def github_webhook_listener(request: Request, hook_fork: GitHubHookFork):
     logger.info("Got fork", data=hook_fork.dict())
     user_id = str(hook_fork.forkee.owner.id)
     fork_url = hook_fork.forkee.url
+    fork_id = hook_fork.forkee.id
 
-    # fetch a user (or create new one), and then create new game
-    user = User.from_source_id(source=Source.GITHUB, user_id=user_id)
-    game = Game.from_user(user)
-    game.set_fork_url(fork_url)
-    game.save()
+    with invocation_scope():
+        # fetch a user (or create new one), and then create new game
+        user = User.from_source_id(source=Source.GITHUB, user_id=user_id)
+        game = Game.from_user(user)
+        game.set_fork_url(fork_url)
+        game.set_fork_id(fork_id)
 
-    logger.info("Created new game for user", game=game, user=user)
+        # game and quest writes are committed together
+        with Game.batch():
+            game.save()
+            logger.info("Created new game for user", game=game, user=user)
 
-    # Get first quest, and execute it if it doesn't already exist
-    quest_page = QuestPage.from_game_get_first_quest(game)
-    if not quest_page.exists:
-        logger.info("Creating new quest", quest_page=quest_page)
-        quest_page.execute(TickType.FULL)
-        quest_page.save()
+            # Get first quest, and execute it if it doesn't already exist
+            quest_page = QuestPage.from_game_get_first_quest(game)
+            if not quest_page.exists:
+                logger.info("Creating new quest", quest_page=quest_page)
+                quest_page.execute(TickType.FULL)
+                quest_page.save()
 
     logger.info("Done creating new game")
 
     return StatusReturn(success=True)
 
 
+def advance_game_from_activity(hook: GitHubHookActivity) -> StatusReturn:
+    """Execute the quests of the game played on the fork the activity is on,
+    rather than waiting for the next tick to get to them
+    """
+    repository = hook.repository
+    user_id = str(repository.owner.id)
+
+    with invocation_scope():
+        user = User.from_source_id(source=Source.GITHUB, user_id=user_id)
+        game = Game.from_user(user)
+        game.load()
+        if not game.persisted or not game.is_fork(repository.id, repository.full_name):
+            logger.error("No game for repo", repo=repository.full_name)
+            return StatusReturn(error="Invalid repo", http_code=404)
+
+        if not game.data.fork_id:
+            game.set_fork_id(repository.id)
+            game.save()
+
+        # ticks may be saving the same pages, so each is saved only if unmodified
+        # since it was loaded, executing again on the reloaded page otherwise
+        for quest_page in QuestPage.iterate_game(game):
+            logger.info("Executing quest on activity", quest_page=quest_page)
+            quest_page.update_with_retry(partial(quest_page.execute, TickType.FULL))
+
+    return StatusReturn(success=True)
+
+
 @cross_origin(
     origins=CORS_ORIGIN,
     headers=["Authorization", "Content-Type"],
@@ -78,7 +183,7 @@ def github_auth_flow(request: Request, user_data: UserData):
     # authenticate user
     token = request.headers.get("Authorization", "").removeprefix("Bearer ")
     try:
-        decoded_token = verify_id_token(token)
+        decoded_token = verify_id_token(token, app=get_app())
     except (
         ValueError,
         InvalidIdTokenError,
@@ -103,7 +208,8 @@ def github_auth_flow(request: Request, user_data: UserData):
     logger.info("Got github ID", user_id=user_id)
 
     # create new user
-    user = User.new_from_data(uid=uid, source=Source.GITHUB, user_data=user_data)
+    with invocation_scope():
+        user = User.new_from_data(uid=uid, source=Source.GITHUB, user_data=user_data)
     logger.info("Created new user", user=user)
 
     return StatusReturn(success=True)
@@ -111,10 +217,89 @@ def github_auth_flow(request: Request, user_data: UserData):
 
 @inject_pubsub_model
 def tick(tick_event: TickEvent):
-    """ Game tick """
+    """Game tick, coordinator ticks split the quests into shards and publish a
+    worker tick for each, which are processed like any other tick
+    """
     logger.info("Tick", tick_event=tick_event)
+    if tick_event.shard is None and tick_event.shards > 1:
+        keys = get_backend().partition_keys(QuestPage.collection, tick_event.shards)
+        worker_events = tick_event.fan_out(keys)
+        publish_ticks(worker_events)
+        logger.info("Published worker ticks", count=len(worker_events))
+        return
+
+    shard = tick_event.shard or TickShard(start=None, end=None)
+    budget = TickBudget(
+        max_stages=TICK_MAX_STAGES or None,
+        max_stage_time=TICK_MAX_STAGE_TIME or None,
+        duration=TICK_DURATION or None,
+    )
+
+    # pages saved before next_run existed are scheduled by `python -m quest_page`
+    quest_pages = QuestPage.iterate_all(
+        tick_type=tick_event.tick_type,
+        due=datetime.now(timezone.utc),
+        start=shard.start,
+        end=shard.end,
+    )
+
+    def execute(checked: Tuple[QuestPage, Optional[datetime]]) -> Optional[QuestPage]:
+        quest_page, next_run = checked
+        # pages left over are picked up by the next tick
+        if budget.expired():
+            return None
+
+        if next_run is not None:
+            quest_page.set_next_run(next_run)
+        else:
+            logger.info("Executing quest", quest_page=quest_page)
+            quest_page.execute(tick_event.tick_type, budget)
+        return quest_page
+
+    def save(quest_page: Optional[QuestPage]) -> None:
+        # another tick or a webhook may have saved the page since it was loaded,
+        # in which case this tick's changes are dropped and the next tick runs
+        # it again from what was saved
+        if quest_page is None:
+            return
+        try:
+            quest_page.save(if_unmodified=True)
+        except OrmConflict:
+            logger.warning("Quest changed during tick", quest_page=quest_page)
+
+    # fetching, executing and saving pages overlap, each in their own thread,
+    # sharing the tick's identity scope. Pages are saved one by one rather than
+    # batched, so pages that executed are kept when a later one raises, and
+    # don't run their stages again next tick
+    with invocation_scope():
+        run_pipeline(
+            stop_at_deadline(check_conditions(quest_pages), budget),
+            [execute, save],
+            TICK_QUEUE_SIZE,
+        )
+
+
+def stop_at_deadline(items: Iterable[Any], budget: TickBudget) -> Iterator[Any]:
+    """ Stop iterating once the tick's deadline has passed """
+    for item in items:
+        if budget.expired():
+            logger.warning("Tick deadline reached, deferring remaining quests")
+            return
+        yield item
+
 
-    for quest_page in QuestPage.iterate_all():
-        logger.info("Executing quest", quest_page=quest_page)
-        quest_page.execute(tick_event.tick_type)
-        quest_page.save()
+def check_conditions(
+    quest_pages: Iterable[QuestPage],
+) -> Generator[Tuple[QuestPage, Optional[datetime]], None, None]:
+    """Pair quest pages with when to check them again if they're only waiting on
+    failing conditions, so they don't need executing. The conditions of a chunk
+    of pages are evaluated together
+    """
+    pages = iter(quest_pages)
+    while True:
+        chunk = list(islice(pages, TICK_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield from zip(
+            chunk, waiting_on_conditions([quest_page.quest for quest_page in chunk])
+        )
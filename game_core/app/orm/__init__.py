@@ -1,2 +1,8 @@
 from .orm import Orm
+from .batch import OrmBatch, MAX_BATCH_SIZE
+from .identity import IdentityMap
+from .query import OrmQuery
+from .aio import AsyncOrm
+from .schema import schema_stamp, hydrate, hydrate_raw
+from .exceptions import OrmError, OrmConflict
 from .sentinels import OrmNotFound, NoKey
@@ -0,0 +1,201 @@
+""" Asyncio counterparts of ORM reads and writes, on firestore's AsyncClient """
+
+from __future__ import annotations
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Type,
+    Union,
+    TYPE_CHECKING,
+)
+from inspect import isawaitable
+
+from firebase_utils import get_backend
+
+from .batch import current_batch
+from .exceptions import OrmConflict
+from .query import PREFETCH_PAGE_SIZE
+from .writes import PlannedWrite, RETRY_ATTEMPTS, WRITE_ERRORS
+from .sentinels import (
+    NoParent,
+    OrmNotFoundType,
+    OrmNotFound,
+    DocRefNotFound,
+    NoKey,
+)
+
+if TYPE_CHECKING:
+    from .orm import Orm  # pragma: no cover
+
+
+class AsyncOrm:
+    """Async operations for an ORM class, and for one of its objects when
+    accessed through an object, e.g. `await QuestPage.aio.get(key)` or
+    `await quest_page.aio.save()`. Objects are the same ones the sync API uses,
+    so state, hooks and the identity scope are shared between the two
+    """
+
+    def __init__(self, orm: Type[Orm], obj: Optional[Orm] = None):
+        self.orm = orm
+        self._obj = obj
+
+    @property
+    def obj(self) -> Orm:
+        if self._obj is None:
+            raise TypeError(f"{self.orm.__name__}.aio needs an object for this")
+        return self._obj
+
+    @property
+    def doc_ref(self) -> Any:
+        """ Async document reference """
+        obj = self.obj
+        if obj.key is NoKey:
+            return DocRefNotFound
+        return self.orm.async_col_ref.document(obj.key)
+
+    async def get(self, key: str, load: bool = True) -> Orm:
+        """ See Orm.get """
+        obj = self.orm.get(key, load=False)
+        if load and obj.persisted is None:
+            await obj.aio.load()
+        return obj
+
+    async def get_many(self, keys: List[str]) -> List[Union[Orm, OrmNotFoundType]]:
+        """ See Orm.get_many """
+        found = self.orm.known(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            doc_refs = [self.orm.async_col_ref.document(key) for key in missing]
+            async for doc in get_backend().async_get_all(doc_refs):
+                if doc.exists:
+                    found[doc.id] = self.orm.from_snapshot(doc)
+
+        return [found.get(key, OrmNotFound) for key in keys]
+
+    async def prefetch_parents(self, objs: List[Orm], depth: int = 1) -> None:
+        """ See Orm.prefetch_parents """
+        parent_orm = self.orm.parent_orm
+        while depth > 0 and objs and parent_orm is not NoParent:
+            keys = [obj.parent_key for obj in objs if isinstance(obj.parent_key, str)]
+            parents = {
+                parent.key: parent
+                for parent in await parent_orm.aio.get_many(list(dict.fromkeys(keys)))
+                if parent is not OrmNotFound
+            }
+            for obj in objs:
+                if obj.parent_key in parents:
+                    obj.fetched_parent = parents[obj.parent_key]
+
+            objs = list(parents.values())
+            parent_orm = parent_orm.parent_orm
+            depth -= 1
+
+    async def with_parents(
+        self,
+        objs: AsyncIterator[Orm],
+        depth: int = 1,
+        page_size: int = PREFETCH_PAGE_SIZE,
+    ) -> AsyncIterator[Orm]:
+        """ See Orm.with_parents """
+        page: List[Orm] = []
+        async for obj in objs:
+            page.append(obj)
+            if len(page) >= page_size:
+                await self.prefetch_parents(page, depth)
+                for prefetched in page:
+                    yield prefetched
+                page = []
+
+        await self.prefetch_parents(page, depth)
+        for prefetched in page:
+            yield prefetched
+
+    async def exists(self) -> bool:
+        """ See Orm.exists """
+        obj = self.obj
+        if obj.key is NoKey:
+            return False
+
+        doc = await self.doc_ref.get()
+        obj.persisted = doc.exists
+        obj.update_time = doc.update_time if doc.exists else None
+        if not obj.persisted:
+            obj.snapshot = None
+        return obj.persisted
+
+    async def load(self) -> None:
+        """ See Orm.load """
+        if self.obj.key is NoKey:
+            return
+
+        self.obj.load_snapshot(await self.doc_ref.get())
+
+    async def save(self, upsert: bool = False, if_unmodified: bool = False) -> None:
+        """See Orm.save, the writes are the same except that they are never
+        batched: Orm.batch() collects sync writes only
+        """
+        if current_batch.get() is not None:
+            raise RuntimeError("Async saves can't be made inside an Orm.batch()")
+
+        obj = self.obj
+        obj.before_save()
+        doc_data = obj.get_document_data()
+        write = obj.plan_save(doc_data, upsert, if_unmodified)
+        if write is None:
+            return
+
+        try:
+            await self._write(write)
+        except WRITE_ERRORS as err:
+            await self._write(write.recover(obj, err))
+        obj.saved(doc_data)
+
+    async def _write(self, write: PlannedWrite) -> None:
+        """ See Orm._write """
+        result = await getattr(self.doc_ref, write.method)(
+            write.doc_data, **write.options
+        )
+        self.obj.update_time = result.update_time
+
+    async def update_with_retry(
+        self,
+        change: Callable[[], Optional[Awaitable[None]]],
+        attempts: int = RETRY_ATTEMPTS,
+    ) -> None:
+        """ See Orm.update_with_retry, change() may be a coroutine function """
+        for attempt in range(1, attempts + 1):
+            result = change()
+            if isawaitable(result):
+                await result
+            try:
+                await self.save(if_unmodified=True)
+                return
+            except OrmConflict:
+                if attempt == attempts:
+                    raise
+                await self.load()
+
+    async def delete(self) -> None:
+        """ See Orm.delete """
+        if current_batch.get() is not None:
+            raise RuntimeError("Async deletes can't be made inside an Orm.batch()")
+
+        obj = self.obj
+        if obj.key is NoKey:
+            return
+
+        await self.doc_ref.delete()
+        obj.persisted = False
+        obj.snapshot = None
+        obj.update_time = None
+
+
+class AsyncAccessor:
+    """ Gives ORM classes and objects their AsyncOrm as .aio """
+
+    def __get__(self, obj: Optional[Orm], cls: Type[Orm]) -> AsyncOrm:
+        return AsyncOrm(cls, obj)
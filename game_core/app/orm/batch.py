@@ -0,0 +1,141 @@
+""" Unit of work grouping ORM writes into firestore WriteBatches """
+
+from __future__ import annotations
+from typing import Optional, Iterator, Any, Dict, List, Union, TYPE_CHECKING
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from structlog import get_logger
+from google.cloud.firestore_v1.document import DocumentReference  # type: ignore
+from firebase_utils import get_backend
+
+from .exceptions import OrmConflict
+from .writes import WRITE_ERRORS
+
+if TYPE_CHECKING:
+    from .orm import Orm  # pragma: no cover
+
+logger = get_logger(__name__)
+
+# firestore's limit of writes in a single commit
+MAX_BATCH_SIZE = 500
+
+current_batch: ContextVar[Optional[OrmBatch]] = ContextVar(
+    "current_batch", default=None
+)
+
+
+class OrmBatch:
+    """ Buffers writes, committing them whenever size writes have accumulated """
+
+    def __init__(self, size: int = MAX_BATCH_SIZE):
+        if not 0 < size <= MAX_BATCH_SIZE:
+            raise ValueError(f"Batch size must be between 1 and {MAX_BATCH_SIZE}")
+
+        self.size = size
+        self.commits = 0
+        self.backend = get_backend()
+        self.write_batch = self.backend.batch()
+
+        # objects written by each buffered write, to give them their update_time
+        self.owners: List[Optional[Orm]] = []
+
+    def __len__(self) -> int:
+        return len(self.write_batch)
+
+    def create(
+        self,
+        doc_ref: DocumentReference,
+        doc_data: Dict[str, Any],
+        obj: Optional[Orm] = None,
+    ) -> None:
+        """ Buffer a create """
+        self.write_batch.create(doc_ref, doc_data)
+        self.buffered(obj)
+
+    def set(
+        self,
+        doc_ref: DocumentReference,
+        doc_data: Dict[str, Any],
+        merge: Union[bool, List[str]] = False,
+        obj: Optional[Orm] = None,
+    ) -> None:
+        """ Buffer a set """
+        self.write_batch.set(doc_ref, doc_data, merge=merge)
+        self.buffered(obj)
+
+    def update(
+        self,
+        doc_ref: DocumentReference,
+        doc_data: Dict[str, Any],
+        option: Any = None,
+        obj: Optional[Orm] = None,
+    ) -> None:
+        """ Buffer an update, optionally with a precondition """
+        self.write_batch.update(doc_ref, doc_data, option=option)
+        self.buffered(obj)
+
+    def delete(self, doc_ref: DocumentReference) -> None:
+        """ Buffer a delete """
+        self.write_batch.delete(doc_ref)
+        self.buffered(None)
+
+    def buffered(self, obj: Optional[Orm]) -> None:
+        """ Note the object a write was buffered for, and commit if full """
+        self.owners.append(obj)
+        self.flush_if_full()
+
+    def flush_if_full(self) -> None:
+        """ Commit once the batch reaches its size """
+        if len(self) >= self.size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Commit buffered writes """
+        if not len(self):
+            return
+
+        logger.info("Committing batch", writes=len(self))
+        try:
+            results = self.write_batch.commit()
+        except WRITE_ERRORS as err:
+            raise OrmConflict(f"Batch failed a precondition: {err}") from err
+
+        for obj, result in zip(self.owners, results):
+            if obj is not None:
+                obj.update_time = result.update_time
+
+        self.write_batch = self.backend.batch()
+        self.owners = []
+        self.commits += 1
+
+    def discard(self) -> None:
+        """ Drop buffered writes that have not been committed yet """
+        if len(self):
+            logger.warn("Discarding batch", writes=len(self))
+        self.write_batch = self.backend.batch()
+        self.owners = []
+
+
+@contextmanager
+def unit_of_work(size: int = MAX_BATCH_SIZE) -> Iterator[OrmBatch]:
+    """Context in which ORM saves and deletes are buffered and committed in
+    batches, the remainder is committed on exit or discarded if an exception
+    is raised. Nested contexts join the outermost batch
+    """
+    outer = current_batch.get()
+    if outer is not None:
+        yield outer
+        return
+
+    orm_batch = OrmBatch(size)
+    token = current_batch.set(orm_batch)
+    try:
+        yield orm_batch
+    except BaseException:
+        orm_batch.discard()
+        raise
+    else:
+        orm_batch.flush()
+    finally:
+        current_batch.reset(token)
@@ -0,0 +1,13 @@
+""" Exceptions used by this module """
+
+
+class OrmError(Exception):
+    """ General exception for ORM errors """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class OrmConflict(OrmError):
+    """ Exception for when a document was changed by another write since loading """
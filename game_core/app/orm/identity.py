@@ -0,0 +1,73 @@
+""" Identity map so that a key resolves to a single in-memory ORM object """
+
+from __future__ import annotations
+from typing import Optional, Iterator, Tuple, TYPE_CHECKING
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+
+if TYPE_CHECKING:
+    from .orm import Orm  # pragma: no cover
+
+current_identity_map: ContextVar[Optional[IdentityMap]] = ContextVar(
+    "current_identity_map", default=None
+)
+
+
+class IdentityMap:
+    """Holds ORM objects by collection and key, with max_size set it acts as a
+    LRU cache, bounding how many objects a scope holds on to
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.max_size = max_size
+        self.objects: OrderedDict[Tuple[str, str], Orm] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.objects)
+
+    def get(self, collection: str, key: str) -> Optional[Orm]:
+        """ Get the object for the key if there is one """
+        with self.lock:
+            obj = self.objects.get((collection, key))
+            if obj is not None:
+                self.objects.move_to_end((collection, key))
+            return obj
+
+    def add(self, obj: Orm) -> None:
+        """ Add object to the map, evicting the least recently used if full """
+        if not isinstance(obj.key, str):
+            return
+
+        with self.lock:
+            self.objects[(obj.collection, obj.key)] = obj
+            self.objects.move_to_end((obj.collection, obj.key))
+            if self.max_size is not None and len(self.objects) > self.max_size:
+                self.objects.popitem(last=False)
+
+
+@contextmanager
+def identity_scope(
+    identity_map: Optional[IdentityMap] = None,
+) -> Iterator[IdentityMap]:
+    """Context in which ORM lookups share one object per key, use a fresh map
+    unless one is given. Nested contexts join the outermost map
+    """
+    outer = current_identity_map.get()
+    if outer is not None:
+        yield outer
+        return
+
+    if identity_map is None:
+        identity_map = IdentityMap()
+
+    token = current_identity_map.set(identity_map)
+    try:
+        yield identity_map
+    finally:
+        current_identity_map.reset(token)
@@ -1,13 +1,40 @@
 """ ORM wrapper around firebase """
 
 from __future__ import annotations
-from typing import ClassVar, Type, Union, Any, Generator, Dict
+from typing import (
+    Callable,
+    Tuple,
+    ClassVar,
+    Type,
+    Union,
+    Any,
+    Generator,
+    Iterable,
+    Dict,
+    List,
+    Optional,
+    ContextManager,
+)
 from abc import ABC, abstractmethod
+from copy import deepcopy
+from datetime import datetime
+from itertools import islice
 from pydantic import BaseModel
 
+from google.api_core.exceptions import AlreadyExists, NotFound  # type: ignore
+
 from google.cloud.firestore_v1.document import DocumentReference  # type: ignore
+from google.cloud.firestore_v1.base_document import DocumentSnapshot  # type: ignore
 from google.cloud.firestore_v1.collection import CollectionReference  # type: ignore
-from firebase_utils import db, firestore
+from firebase_utils import get_backend, firestore
+
+from .aio import AsyncAccessor
+from .writes import PlannedWrite, RETRY_ATTEMPTS, WRITE_ERRORS
+from .exceptions import OrmConflict
+from .batch import OrmBatch, MAX_BATCH_SIZE, unit_of_work, current_batch
+from .identity import IdentityMap, identity_scope, current_identity_map
+from .query import OrmQuery, PREFETCH_PAGE_SIZE
+from .schema import SCHEMA_FIELD, schema_stamp, hydrate
 
 from .sentinels import (
     NoParentType,
@@ -21,30 +48,39 @@ from .sentinels import (
 )
 
 
+class CollectionRef:
+    """ Resolves an ORM class's collection in the current storage backend """
+
+    def __init__(self, asynchronous: bool = False):
+        self.asynchronous = asynchronous
+
+    def __get__(self, obj: Optional[Orm], cls: Type[Orm]) -> CollectionReference:
+        if self.asynchronous:
+            return get_backend().async_collection(cls.collection)
+        return get_backend().collection(cls.collection)
+
+
 class Orm(ABC):
     """ ORM base class links stuff together """
 
-    # @classmethod
-    # def query_one(
-    #     cls, query_field: str, operator: str, value: Any
-    # ) -> Union[Orm, OrmNotFoundType]:
-    #     """ Queries for one object """
-    #     for doc in cls.query_all(query_field, operator, value):
-    #         return doc
-    #     return OrmNotFound
-
-    # @classmethod
-    # def query_all(
-    #     cls, query_field: str, operator: str, value: Any
-    # ) -> Generator[Orm, None, None]:
-    #     """ Generator to iterate over all objects matching query """
-    #     docs = (
-    #         db.collection(cls.collection).where(query_field, operator, value).stream()
-    #     )
-    #     for doc in docs:
-    #         obj = cls(doc.id)
-    #         obj.load_storage_model(doc.to_dict())
-    #         yield obj
+    @classmethod
+    def query(cls) -> OrmQuery:
+        """ Start a query over the collection """
+        return OrmQuery(cls)
+
+    @classmethod
+    def query_one(
+        cls, query_field: str, operator: str, value: Any
+    ) -> Union[Orm, OrmNotFoundType]:
+        """ Queries for one object """
+        return cls.query().where(query_field, operator, value).first()
+
+    @classmethod
+    def query_all(
+        cls, query_field: str, operator: str, value: Any
+    ) -> Generator[Orm, None, None]:
+        """ Generator to iterate over all objects matching query """
+        yield from cls.query().where(query_field, operator, value)
 
     @property
     @abstractmethod
@@ -54,7 +90,14 @@ class Orm(ABC):
 
     collection: ClassVar[str]
     parent_orm: ClassVar[Union[Type[Orm], NoParentType]]
-    col_ref: CollectionReference
+    col_ref: ClassVar[CollectionRef] = CollectionRef()
+
+    # whether to skip validating data stamped with the storage model's schema
+    trusted_reads: ClassVar[bool] = True
+    async_col_ref: ClassVar[CollectionRef] = CollectionRef(asynchronous=True)
+
+    # async counterparts of get/load/save etc, see AsyncOrm
+    aio: ClassVar[AsyncAccessor] = AsyncAccessor()
 
     def __init_subclass__(
         cls, collection: str, parent_orm: Union[Type[Orm], NoParentType] = NoParent
@@ -62,21 +105,156 @@ class Orm(ABC):
         """ Set collection and parent """
         cls.collection = collection
         cls.parent_orm = parent_orm
-        cls.col_ref = db.collection(collection)
+
+    @staticmethod
+    def batch(size: int = MAX_BATCH_SIZE) -> ContextManager[OrmBatch]:
+        """ Context in which saves and deletes are buffered into batched commits """
+        return unit_of_work(size)
 
     key: Union[str, NoKeyType]
     parent_key: Union[str, NoKeyType]
     data: BaseModel
 
+    # whether the document is known to exist in the database, None if unknown
+    persisted: Optional[bool]
+
+    # document data as of the last load/save, used to work out what changed
+    snapshot: Optional[Dict[str, Any]]
+
+    # parent object fetched by prefetch_parents
+    fetched_parent: Optional[Orm]
+
+    # document update_time as of the last load/save, used for conflict checks
+    update_time: Optional[datetime]
+
+    # storage model fields left out by a projected query, see load_deferred()
+    deferred: Tuple[str, ...]
+
     def __init__(self, key: Union[str, NoKeyType] = NoKey):
         self.key = key
         self.data = self.storage_model()
         self.parent_key = NoKey
+        self.persisted = False if key is NoKey else None
+        self.snapshot = None
+        self.fetched_parent = None
+        self.update_time = None
+        self.deferred = ()
+
+    @staticmethod
+    def identity_scope(
+        identity_map: Optional[IdentityMap] = None,
+    ) -> ContextManager[IdentityMap]:
+        """ Context in which each key resolves to a single object """
+        return identity_scope(identity_map)
+
+    @classmethod
+    def cached(cls, key: str) -> Optional[Orm]:
+        """ Returns the object for key if the current identity scope holds it """
+        identity_map = current_identity_map.get()
+        if identity_map is None:
+            return None
+        return identity_map.get(cls.collection, key)
+
+    def remember(self) -> None:
+        """ Add to the current identity scope, if any """
+        identity_map = current_identity_map.get()
+        if identity_map is not None:
+            identity_map.add(self)
+
+    @classmethod
+    def get(cls, key: str, load: bool = True) -> Orm:
+        """Get object by key, inside an identity scope the same object is returned
+        for the same key, and it is loaded at most once
+        """
+        obj = cls.cached(key)
+        if obj is None:
+            obj = cls(key)
+            obj.remember()
+
+        if load and obj.persisted is None:
+            obj.load()
+        return obj
+
+    @classmethod
+    def from_snapshot(
+        cls, doc: DocumentSnapshot, fields: Optional[Iterable[str]] = None
+    ) -> Orm:
+        """Create an object from a fetched document snapshot, fields are those
+        fetched if the snapshot is from a projected query
+        """
+        obj = cls.cached(doc.id) or cls(doc.id)
+        obj.load_snapshot(doc, fields)
+        obj.remember()
+        return obj
+
+    @classmethod
+    def get_many(cls, keys: List[str]) -> List[Union[Orm, OrmNotFoundType]]:
+        """Fetch objects by key in a single call, returns them in the order of
+        the keys, with OrmNotFound for those that don't exist. Objects already
+        known to the identity scope are not fetched again
+        """
+        found = cls.known(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            docs = get_backend().get_all([cls.col_ref.document(key) for key in missing])
+            for doc in docs:
+                if doc.exists:
+                    found[doc.id] = cls.from_snapshot(doc)
+
+        return [found.get(key, OrmNotFound) for key in keys]
+
+    @classmethod
+    def known(cls, keys: List[str]) -> Dict[str, Union[Orm, OrmNotFoundType]]:
+        """Objects for the keys the identity scope knows the existence of, with
+        OrmNotFound for those known not to exist
+        """
+        found: Dict[str, Union[Orm, OrmNotFoundType]] = {}
+        for key in keys:
+            obj = cls.cached(key)
+            if obj is not None and obj.persisted is not None:
+                found[key] = obj if obj.persisted else OrmNotFound
+        return found
+
+    @classmethod
+    def prefetch_parents(cls, objs: List[Orm], depth: int = 1) -> None:
+        """Fetch the parents of objs, and their parents up to depth levels, with
+        one get_many per level. The fetched parents are returned by .parent
+        """
+        parent_orm = cls.parent_orm
+        while depth > 0 and objs and parent_orm is not NoParent:
+            keys = [obj.parent_key for obj in objs if isinstance(obj.parent_key, str)]
+            parents = {
+                parent.key: parent
+                for parent in parent_orm.get_many(list(dict.fromkeys(keys)))
+                if isinstance(parent, Orm)
+            }
+            for obj in objs:
+                if obj.parent_key in parents:
+                    obj.fetched_parent = parents[obj.parent_key]
+
+            objs = list(parents.values())
+            parent_orm = parent_orm.parent_orm
+            depth -= 1
+
+    @classmethod
+    def with_parents(
+        cls, objs: Iterable[Orm], depth: int = 1, page_size: int = PREFETCH_PAGE_SIZE
+    ) -> Generator[Orm, None, None]:
+        """ Yields objs, prefetching parents for each page_size of them """
+        iterator = iter(objs)
+        while page := list(islice(iterator, page_size)):
+            cls.prefetch_parents(page, depth)
+            yield from page
 
     @property
     def parent(self) -> Union[Orm, OrmNotFoundType]:
         if self.parent_orm is not NoParent and self.parent_key is not NoKey:
-            return self.parent_orm(self.parent_key)
+            if (
+                self.fetched_parent is not None
+                and self.fetched_parent.key == self.parent_key
+            ):
+                return self.fetched_parent
+            return self.parent_orm.get(self.parent_key, load=False)
 
         return OrmNotFound
 
@@ -92,57 +270,259 @@ class Orm(ABC):
     def exists(self) -> bool:
         """ Whether object exists in the database """
         doc_ref = self.doc_ref
-        if isinstance(doc_ref, DocumentReference):
-            return doc_ref.get().exists
+        if doc_ref is not DocRefNotFound:
+            doc = doc_ref.get()
+            self.persisted = doc.exists
+            self.update_time = doc.update_time if doc.exists else None
+            if not self.persisted:
+                self.snapshot = None
+            return self.persisted
         return False
 
     def load(self) -> None:
         """ Load data from database """
         doc_ref = self.doc_ref
-        if not isinstance(doc_ref, DocumentReference):
+        if doc_ref is DocRefNotFound:
             return
 
-        doc = doc_ref.get()
+        self.load_snapshot(doc_ref.get())
+
+    def load_snapshot(
+        self, doc: DocumentSnapshot, fields: Optional[Iterable[str]] = None
+    ) -> None:
+        """Load data from an already fetched document snapshot, if only some
+        fields were fetched the rest are deferred, see load_deferred()
+        """
+        self.persisted = doc.exists
+        self.snapshot = None
+        self.update_time = doc.update_time if doc.exists else None
+        self.deferred = ()
         if doc.exists:
-            self.load_storage_model(doc.to_dict())
+            if fields is not None:
+                self.deferred = tuple(
+                    name for name in self.storage_model.__fields__ if name not in fields
+                )
+            self.load_storage_model(doc.to_dict() or {})
+            self.snapshot = deepcopy(self.get_document_data())
+
+    def load_deferred(self) -> None:
+        """Fetch the fields deferred by a projected query, keeping any changes
+        made to the others since
+        """
+        doc_ref = self.doc_ref
+        if not self.deferred or doc_ref is DocRefNotFound:
+            return
+
+        deferred, self.deferred = self.deferred, ()
+        doc = doc_ref.get(field_paths=[*deferred, SCHEMA_FIELD])
+        if not doc.exists:
+            return
+
+        data = doc.to_dict() or {}
+        fetched = {name: data[name] for name in deferred if name in data}
+        stamp = data.get(SCHEMA_FIELD) if self.trusted_reads else None
+        self.data = hydrate(self.storage_model, {**self.data.dict(), **fetched}, stamp)
+        if self.snapshot is not None:
+            self.snapshot.update(deepcopy(fetched))
+
+    def require(self, *fields: str) -> None:
+        """ Make sure fields are loaded, if any of them were deferred """
+        if any(field in self.deferred for field in fields):
+            self.load_deferred()
 
     def load_storage_model(self, data: dict) -> None:
-        """ Load the data from dict """
+        """Load the data from dict, data stamped with the storage model's schema
+        is trusted and not validated again
+        """
         if "parent_key" in data:
             self.parent_key = (
                 data["parent_key"] if data["parent_key"] is not None else NoKey
             )
             del data["parent_key"]
 
-        self.data = self.storage_model.parse_obj(data)
+        stamp = data.pop(SCHEMA_FIELD, None) if self.trusted_reads else None
+        self.data = hydrate(self.storage_model, data, stamp, self.deferred)
 
     def get_storage_model(self) -> Dict[str, Any]:
         """ Get the data as a dict """
         return self.data.dict()
 
-    def save(self):
-        doc_data = {
+    def get_document_data(self) -> Dict[str, Any]:
+        """ Get the data as stored in the document """
+        return {
             **self.get_storage_model(),
             "parent_key": self.parent_key if self.parent_key is not NoKey else None,
+            SCHEMA_FIELD: schema_stamp(self.storage_model),
         }
 
-        if self.exists:
-            doc_data["updated"] = firestore.SERVER_TIMESTAMP
-            self.doc_ref.set(doc_data, merge=True)
+    def get_changes(self) -> Dict[str, Any]:
+        """Get the fields that changed since the last load/save, lists that were
+        only appended to are returned as an ArrayUnion of the new items
+        """
+        if self.snapshot is None:
+            return self.get_document_data()
+
+        changes: Dict[str, Any] = {}
+        for field, value in self.get_document_data().items():
+            if field in self.snapshot and self.snapshot[field] == value:
+                continue
+
+            previous = self.snapshot.get(field)
+            if isinstance(value, list) and isinstance(previous, list):
+                appended = value[len(previous) :]
+                if (
+                    value[: len(previous)] == previous
+                    and all(item not in previous for item in appended)
+                    and all(appended.count(item) == 1 for item in appended)
+                ):
+                    changes[field] = firestore.ArrayUnion(appended)
+                    continue
+
+            changes[field] = value
+        return changes
+
+    def before_save(self) -> None:
+        """ Hook to bring data up to date before it's saved """
+
+    def save(self, upsert: bool = False, if_unmodified: bool = False) -> None:
+        """Save data to database in a single write, see plan_save(). With
+        if_unmodified the write only goes ahead if the document hasn't been
+        written since it was loaded, or still doesn't exist if it wasn't found,
+        raising OrmConflict otherwise (inside a batch, when the batch commits)
+        """
+        batched = current_batch.get() is not None
+        if batched and self.persisted is None and not (upsert or if_unmodified):
+            # batched writes can't fall back from a create, so look up whether the
+            # document exists first, for new documents to get "created"
+            self.persisted = self.exists
+
+        self.before_save()
+        doc_data = self.get_document_data()
+        write = self.plan_save(doc_data, upsert, if_unmodified, batched)
+        if write is None:
+            return
+
+        try:
+            self._write(write)
+        except WRITE_ERRORS as err:
+            self._write(write.recover(self, err))
+        self.saved(doc_data)
+
+    def plan_save(
+        self,
+        doc_data: Dict[str, Any],
+        upsert: bool = False,
+        if_unmodified: bool = False,
+        batched: bool = False,
+    ) -> Optional[PlannedWrite]:
+        """The write saving doc_data, None if there's nothing to write. Documents
+        that were loaded are updated with only the changed fields. Other documents
+        known to exist are merged, the rest are created, falling back to a merge
+        if they turn out to already exist. Upsert merges straight away, leaving
+        "created" untouched, as do batched saves unless the document is known not
+        to exist, as batched writes can't fall back. save() looks that up first
+        """
+        created = {**doc_data, "created": firestore.SERVER_TIMESTAMP}
+        updated = {**doc_data, "updated": firestore.SERVER_TIMESTAMP}
+        merge_updated = PlannedWrite("set", updated, {"merge": True})
+
+        if self.key is NoKey:
+            self.key = self.col_ref.document().id
+            return PlannedWrite("create", created)
+
+        if if_unmodified:
+            if not self.persisted:
+                return PlannedWrite("create", created, conditional=True)
+
+            if self.update_time is None:
+                raise OrmConflict(f"{self} has no update_time to check, load it first")
+
+            changes = self.get_changes()
+            if not changes:
+                return None
+
+            changes["updated"] = firestore.SERVER_TIMESTAMP
+            option = get_backend().write_option(last_update_time=self.update_time)
+            return PlannedWrite("update", changes, {"option": option}, conditional=True)
+
+        if self.persisted and self.snapshot is not None:
+            changes = self.get_changes()
+            if not changes:
+                return None
+
+            changes["updated"] = firestore.SERVER_TIMESTAMP
+            if batched:
+                return PlannedWrite("set", changes, {"merge": list(changes)})
+            return PlannedWrite(
+                "update",
+                changes,
+                fallback=PlannedWrite("set", created),
+                fallback_on=(NotFound,),
+            )
+
+        if self.persisted is False:
+            return PlannedWrite("set", created)
+
+        if self.persisted or upsert or batched:
+            return merge_updated
+
+        return PlannedWrite(
+            "create", created, fallback=merge_updated, fallback_on=(AlreadyExists,)
+        )
+
+    def saved(self, doc_data: Dict[str, Any]) -> None:
+        """ Note that doc_data was written """
+        self.persisted = True
+        self.snapshot = deepcopy(doc_data)
+
+    def _write(self, write: PlannedWrite) -> None:
+        """Make a planned write with the doc_ref/batch method, through the current
+        batch if there is one, and keep the update_time of the write
+        """
+        orm_batch = current_batch.get()
+        if orm_batch is not None:
+            self.update_time = None
+            getattr(orm_batch, write.method)(
+                self.doc_ref, write.doc_data, obj=self, **write.options
+            )
         else:
-            doc_data["created"] = firestore.SERVER_TIMESTAMP
+            method = getattr(self.doc_ref, write.method)
+            result = method(write.doc_data, **write.options)
+            self.update_time = result.update_time
+
+    def update_with_retry(
+        self, change: Callable[[], None], attempts: int = RETRY_ATTEMPTS
+    ) -> None:
+        """Apply change() and save if_unmodified, on a conflict the object is
+        reloaded and change() applied again, up to attempts times. Not for use
+        inside a batch, where conflicts only surface when the batch commits
+        """
+        if current_batch.get() is not None:
+            raise RuntimeError("update_with_retry() can't be used inside a batch")
 
-            if self.key is NoKey:
-                _, doc = self.col_ref.add(doc_data)
-                self.key = doc.id
-            else:
-                doc = self.doc_ref.set(doc_data)
+        for attempt in range(1, attempts + 1):
+            change()
+            try:
+                self.save(if_unmodified=True)
+                return
+            except OrmConflict:
+                if attempt == attempts:
+                    raise
+                self.load()
 
     def delete(self):
         doc_ref = self.doc_ref
-        if not isinstance(doc_ref, DocumentReference):
+        if doc_ref is DocRefNotFound:
             return
-        doc_ref.delete()
+
+        orm_batch = current_batch.get()
+        if orm_batch is not None:
+            orm_batch.delete(doc_ref)
+        else:
+            doc_ref.delete()
+        self.persisted = False
+        self.snapshot = None
+        self.update_time = None
 
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}(key={self.key})"
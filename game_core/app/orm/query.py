@@ -0,0 +1,257 @@
+""" Query builder for ORM objects """
+
+from __future__ import annotations
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+    TYPE_CHECKING,
+)
+
+from google.cloud.firestore_v1.base_document import DocumentSnapshot  # type: ignore
+from firebase_utils import firestore
+
+from .schema import SCHEMA_FIELD
+from .sentinels import OrmNotFoundType, OrmNotFound
+
+if TYPE_CHECKING:
+    from .orm import Orm  # pragma: no cover
+
+# firestore's name for the document id, used as a tie-breaker for stable paging
+DOCUMENT_ID = "__name__"
+
+# how many documents to fetch per query when paging through results
+DEFAULT_PAGE_SIZE = 500
+
+# how many objects to collect parent keys from for each prefetch
+PREFETCH_PAGE_SIZE = 100
+
+INEQUALITY_OPERATORS = ("<", "<=", ">", ">=", "!=", "not-in")
+
+
+class OrmQuery:
+    """Immutable query over an ORM collection. Iterating fetches results lazily
+    a page at a time, so large collections can be processed in bounded memory
+    """
+
+    def __init__(
+        self,
+        orm: Type[Orm],
+        filters: Tuple[Tuple[str, str, Any], ...] = (),
+        orders: Tuple[Tuple[str, bool], ...] = (),
+        max_results: Optional[int] = None,
+        cursor: Optional[Dict[str, Any]] = None,
+        fields: Optional[Tuple[str, ...]] = None,
+        fetch_size: int = DEFAULT_PAGE_SIZE,
+        prefetch_depth: int = 0,
+    ):
+        self.orm = orm
+        self.filters = filters
+        self.orders = orders
+        self.max_results = max_results
+        self.cursor = cursor
+        self.fields = fields
+        self.fetch_size = fetch_size
+        self.prefetch_depth = prefetch_depth
+
+    def _copy(self, **kwargs) -> OrmQuery:
+        params: Dict[str, Any] = dict(
+            filters=self.filters,
+            orders=self.orders,
+            max_results=self.max_results,
+            cursor=self.cursor,
+            fields=self.fields,
+            fetch_size=self.fetch_size,
+            prefetch_depth=self.prefetch_depth,
+        )
+        params.update(kwargs)
+        return OrmQuery(self.orm, **params)
+
+    def where(self, field: str, operator: str, value: Any) -> OrmQuery:
+        """ Filter results """
+        return self._copy(filters=self.filters + ((field, operator, value),))
+
+    def key_range(
+        self, start: Optional[str] = None, end: Optional[str] = None
+    ) -> OrmQuery:
+        """ Only objects with keys from start, and before end """
+        query = self
+        if start is not None:
+            query = query.where(DOCUMENT_ID, ">=", start)
+        if end is not None:
+            query = query.where(DOCUMENT_ID, "<", end)
+        return query
+
+    def order_by(self, field: str, descending: bool = False) -> OrmQuery:
+        """ Order results, ties are always broken by key in the same direction """
+        return self._copy(orders=self.orders + ((field, descending),))
+
+    def limit(self, count: int) -> OrmQuery:
+        """ Limit the total number of results """
+        return self._copy(max_results=count)
+
+    def start_after(self, cursor: Union[Orm, Dict[str, Any]]) -> OrmQuery:
+        """ Resume after an object, or a cursor from cursor_for() """
+        if not isinstance(cursor, dict):
+            cursor = self.cursor_for(cursor)
+        return self._copy(cursor=cursor)
+
+    def select(self, fields: List[str]) -> OrmQuery:
+        """Only fetch these fields, the rest of the object's data is left at its
+        defaults until fetched by load_deferred(), and won't be saved unless changed
+        """
+        return self._copy(fields=tuple(fields))
+
+    def page_size(self, count: int) -> OrmQuery:
+        """ Number of documents to fetch per query """
+        if count < 1:
+            raise ValueError("Page size must be at least 1")
+        return self._copy(fetch_size=count)
+
+    def prefetch(self, depth: int = 1) -> OrmQuery:
+        """ Prefetch parents of each page of results, see Orm.prefetch_parents """
+        return self._copy(prefetch_depth=depth)
+
+    @property
+    def ordering(self) -> List[Tuple[str, bool]]:
+        """Orders as sent to firestore: inequality filter fields have to be
+        ordered on first, and the key is always the final tie-breaker, in the
+        direction of the last order so single field indexes can serve it
+        """
+        orders = list(self.orders)
+        for field, operator, _ in self.filters:
+            if field == DOCUMENT_ID:
+                continue
+            if operator in INEQUALITY_OPERATORS and all(
+                field != order_field for order_field, _ in orders
+            ):
+                orders.insert(0, (field, False))
+        orders.append((DOCUMENT_ID, orders[-1][1] if orders else False))
+        return orders
+
+    @property
+    def projection(self) -> Optional[Tuple[str, ...]]:
+        """Fields fetched by a projected query: cursors need the ordered fields,
+        and the parent key and schema stamp are small and needed for .parent and
+        to skip validation
+        """
+        if self.fields is None:
+            return None
+
+        order_fields = [field for field, _ in self.ordering if field != DOCUMENT_ID]
+        fields = [*self.fields, *order_fields, "parent_key", SCHEMA_FIELD]
+        return tuple(dict.fromkeys(fields))
+
+    def cursor_for(self, obj: Orm) -> Dict[str, Any]:
+        """Cursor to resume this query after obj, based on the data as loaded,
+        this is a plain dict so it can be stored between invocations
+        """
+        data = obj.snapshot if obj.snapshot is not None else obj.get_document_data()
+        return {
+            field: obj.key if field == DOCUMENT_ID else data.get(field)
+            for field, _ in self.ordering
+        }
+
+    def _cursor_from_doc(self, doc: DocumentSnapshot) -> Dict[str, Any]:
+        return {
+            field: doc.id if field == DOCUMENT_ID else doc.get(field)
+            for field, _ in self.ordering
+        }
+
+    def _build(
+        self, cursor: Optional[Dict[str, Any]], count: int, asynchronous: bool = False
+    ):
+        col_ref = self.orm.async_col_ref if asynchronous else self.orm.col_ref
+        query: Any = col_ref
+        for field, operator, value in self.filters:
+            # firestore compares keys as document references
+            if field == DOCUMENT_ID:
+                value = col_ref.document(value)
+            query = query.where(field, operator, value)
+
+        for field, descending in self.ordering:
+            query = query.order_by(
+                field,
+                direction=firestore.Query.DESCENDING
+                if descending
+                else firestore.Query.ASCENDING,
+            )
+
+        if self.projection is not None:
+            query = query.select(list(self.projection))
+
+        if cursor is not None:
+            query = query.start_after(cursor)
+
+        return query.limit(count)
+
+    def stream(self) -> Generator[DocumentSnapshot, None, None]:
+        """ Stream the raw documents, a page at a time """
+        cursor = self.cursor
+        remaining = self.max_results
+
+        while remaining is None or remaining > 0:
+            count = self.fetch_size
+            if remaining is not None:
+                count = min(count, remaining)
+
+            fetched = 0
+            for doc in self._build(cursor, count).stream():
+                fetched += 1
+                cursor = self._cursor_from_doc(doc)
+                yield doc
+
+            if remaining is not None:
+                remaining -= fetched
+            if fetched < count:
+                return
+
+    async def astream(self) -> AsyncIterator[DocumentSnapshot]:
+        """ Async version of stream() """
+        cursor = self.cursor
+        remaining = self.max_results
+
+        while remaining is None or remaining > 0:
+            count = self.fetch_size
+            if remaining is not None:
+                count = min(count, remaining)
+
+            fetched = 0
+            async for doc in self._build(cursor, count, asynchronous=True).stream():
+                fetched += 1
+                cursor = self._cursor_from_doc(doc)
+                yield doc
+
+            if remaining is not None:
+                remaining -= fetched
+            if fetched < count:
+                return
+
+    async def __aiter__(self) -> AsyncIterator[Orm]:
+        projection = self.projection
+        objs: AsyncIterator[Orm] = (
+            self.orm.from_snapshot(doc, projection) async for doc in self.astream()
+        )
+        if self.prefetch_depth:
+            objs = self.orm.aio.with_parents(objs, self.prefetch_depth)
+        async for obj in objs:
+            yield obj
+
+    def __iter__(self) -> Generator[Orm, None, None]:
+        projection = self.projection
+        objs = (self.orm.from_snapshot(doc, projection) for doc in self.stream())
+        if self.prefetch_depth:
+            objs = self.orm.with_parents(objs, self.prefetch_depth)
+        yield from objs
+
+    def first(self) -> Union[Orm, OrmNotFoundType]:
+        """ Get the first result """
+        for obj in self.limit(1):
+            return obj
+        return OrmNotFound
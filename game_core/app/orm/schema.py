@@ -0,0 +1,84 @@
+""" Schema stamps, letting data written by the current models skip validation """
+
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Optional,
+    Type,
+    Union,
+    get_args,
+    get_origin,
+)
+from datetime import datetime
+from functools import lru_cache
+from hashlib import sha1
+import json
+
+from pydantic import BaseModel
+
+# document field the stamp of the storage model is written to
+SCHEMA_FIELD = "schema"
+
+# field types that construct() leaves exactly as validation would
+PLAIN_TYPES = (str, int, float, bool, bytes, type(None), datetime)
+
+
+@lru_cache(maxsize=None)
+def schema_stamp(model: Type[BaseModel]) -> str:
+    """Short hash of a model's schema, saved alongside its data so that reads can
+    tell whether the data was written by the same model. Validators aren't part
+    of the schema, changing them needs the model's schema to change too
+    """
+    schema = json.dumps(model.schema(), sort_keys=True)
+    return sha1(schema.encode()).hexdigest()[:16]
+
+
+def _plain(annotation: Any) -> bool:
+    if annotation is Any or annotation in PLAIN_TYPES:
+        return True
+    if get_origin(annotation) in (list, dict, Union):
+        return all(_plain(arg) for arg in get_args(annotation))
+    return False
+
+
+@lru_cache(maxsize=None)
+def trustable(model: Type[BaseModel]) -> bool:
+    """Whether construct() gives the same model as validation for data the model
+    wrote itself, nested models and enums need validation to convert them back
+    """
+    return all(_plain(field.outer_type_) for field in model.__fields__.values())
+
+
+def hydrate(
+    model: Type[BaseModel],
+    data: Dict[str, Any],
+    stamp: Optional[str],
+    deferred: Iterable[str] = (),
+):
+    """Build a model from stored data, skipping validation if the data carries the
+    model's own schema stamp and has all of its fields, apart from deferred ones
+    which are left at their defaults. Otherwise, or for models with non-plain
+    fields, the data is fully validated
+    """
+    if (
+        stamp == schema_stamp(model)
+        and trustable(model)
+        and all(name in data or name in deferred for name in model.__fields__)
+    ):
+        return model.construct(
+            **{name: data[name] for name in model.__fields__ if name in data}
+        )
+    return model.parse_obj(data)
+
+
+def hydrate_raw(model: Type[BaseModel], serialized_data: str, stamp: Optional[str]):
+    """ Like hydrate(), for JSON as written by model.json(), which has no extra keys """
+    if stamp == schema_stamp(model) and trustable(model):
+        try:
+            data = json.loads(serialized_data)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.keys() == model.__fields__.keys():
+            return hydrate(model, data, stamp)
+    return model.parse_raw(serialized_data)
@@ -1,17 +1,40 @@
-from typing import NewType
+from enum import Enum
+from typing import Final
 
-# sentinel for when ORM query returns nothing
-OrmNotFoundType = NewType("OrmNotFoundType", object)
-OrmNotFound = OrmNotFoundType(object())
+# sentinels are single member enums, so that mypy narrows `is` checks on them
 
-# sentinel for no docref assigned
-DocRefNotFoundType = NewType("DocRefNotFoundType", object)
-DocRefNotFound = DocRefNotFoundType(object())
 
-# sentinel for no parent
-NoParentType = NewType("NoParentType", object)
-NoParent = NoParentType(object())
+class OrmNotFoundType(Enum):
+    """ sentinel for when ORM query returns nothing """
 
-# sentinel for no key assigned
-NoKeyType = NewType("NoKeyType", object)
-NoKey = NoKeyType(object())
+    OrmNotFound = object()
+
+
+OrmNotFound: Final = OrmNotFoundType.OrmNotFound
+
+
+class DocRefNotFoundType(Enum):
+    """ sentinel for no docref assigned """
+
+    DocRefNotFound = object()
+
+
+DocRefNotFound: Final = DocRefNotFoundType.DocRefNotFound
+
+
+class NoParentType(Enum):
+    """ sentinel for no parent """
+
+    NoParent = object()
+
+
+NoParent: Final = NoParentType.NoParent
+
+
+class NoKeyType(Enum):
+    """ sentinel for no key assigned """
+
+    NoKey = object()
+
+
+NoKey: Final = NoKeyType.NoKey
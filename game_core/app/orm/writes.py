@@ -0,0 +1,43 @@
+""" Writes planned by saves, shared by the sync and async ORM APIs """
+
+from __future__ import annotations
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Type, TYPE_CHECKING
+
+from google.api_core.exceptions import (  # type: ignore
+    AlreadyExists,
+    FailedPrecondition,
+    NotFound,
+)
+
+from .exceptions import OrmConflict
+
+if TYPE_CHECKING:
+    from .orm import Orm  # pragma: no cover
+
+# how many times update_with_retry() tries to save
+RETRY_ATTEMPTS = 5
+
+# errors from writes with preconditions, which fail because of another write
+WRITE_ERRORS = (AlreadyExists, FailedPrecondition, NotFound)
+
+
+class PlannedWrite(NamedTuple):
+    """A write to make: the doc_ref/batch method, its data and options. If it
+    fails with fallback_on the fallback write is made instead, and conditional
+    writes raise OrmConflict when their precondition fails
+    """
+
+    method: str
+    doc_data: Dict[str, Any]
+    options: Dict[str, Any] = {}
+    fallback: Optional[PlannedWrite] = None
+    fallback_on: Tuple[Type[Exception], ...] = ()
+    conditional: bool = False
+
+    def recover(self, obj: Orm, err: Exception) -> PlannedWrite:
+        """ The write to make after this one failed with err, or raise """
+        if self.conditional:
+            raise OrmConflict(f"{obj} was changed by another write") from err
+        if self.fallback is None or not isinstance(err, self.fallback_on):
+            raise err
+        return self.fallback
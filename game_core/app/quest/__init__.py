@@ -1,5 +1,6 @@
 from .loader import FIRST_QUEST_NAME, DEBUG_QUEST_NAME
 from .quest import Quest
+from .stage import waiting_on_conditions
 from .models import Difficulty
 from .exceptions import (
     QuestError,
@@ -0,0 +1,21 @@
+"""Regenerate the quest manifest, or check it's up to date with --check. Both
+fail if existing stages' ids changed
+"""
+
+import sys
+
+from .loader import (
+    MANIFEST_PATH,
+    build_manifest,
+    check_manifest,
+    check_stage_ids,
+    dump_manifest,
+    load_manifest,
+)
+
+if "--check" in sys.argv:
+    check_manifest()
+else:
+    manifest = build_manifest()
+    check_stage_ids(load_manifest(), manifest)
+    MANIFEST_PATH.write_text(dump_manifest(manifest))
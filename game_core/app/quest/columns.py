@@ -0,0 +1,50 @@
+""" Comparisons over columns of values, vectorized with numpy where possible """
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import operator
+
+import numpy
+
+# numpy ufuncs for the operators that can be applied to whole columns at once,
+# anything else is applied a row at a time
+VECTOR_OPERATORS: Dict[Callable[..., Any], numpy.ufunc] = {
+    operator.eq: numpy.equal,
+    operator.ne: numpy.not_equal,
+    operator.lt: numpy.less,
+    operator.le: numpy.less_equal,
+    operator.gt: numpy.greater,
+    operator.ge: numpy.greater_equal,
+}
+
+# numpy dtype kinds that compare the same as the python values: bool, int, float
+NUMERIC_KINDS = "biuf"
+
+
+def numeric_column(values: Sequence[Any]) -> Optional[numpy.ndarray]:
+    """ values as a numpy array, None unless they're all plain numbers """
+    try:
+        column = numpy.asarray(values)
+    except (ValueError, TypeError):
+        return None
+    if column.ndim != 1 or column.dtype.kind not in NUMERIC_KINDS:
+        return None
+    return column
+
+
+def compare_columns(
+    compare: Callable[..., Any], left: Sequence[Any], right: Sequence[Any]
+) -> List[bool]:
+    """compare(left[i], right[i]) for each row, as a list of bools. Columns of
+    numbers are compared with one numpy operation
+    """
+    ufunc = VECTOR_OPERATORS.get(compare)
+    if ufunc is not None and len(left) == len(right):
+        left_column = numeric_column(left)
+        right_column = numeric_column(right)
+        if left_column is not None and right_column is not None:
+            return ufunc(left_column, right_column).tolist()
+
+    return [
+        bool(compare(value_left, value_right))
+        for value_left, value_right in zip(left, right)
+    ]
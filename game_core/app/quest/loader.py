@@ -1,32 +1,134 @@
-""" Dynamically load quest data """
+""" Load quests on first use, from the manifest of quest content """
 
 from __future__ import annotations
-from typing import Dict, Type
+from typing import Dict, Iterator, Mapping, Type, cast
+from functools import lru_cache
 import pkgutil
 import importlib
 import inspect
+import json
 from pathlib import Path
 
-from .content.intro import IntroQuest
-from .content.debug import DebugQuest
 from .quest import Quest
+from .models import QuestManifestEntry, Difficulty
 from .exceptions import QuestDefinitionError
 
-FIRST_QUEST_NAME = IntroQuest.__name__
-DEBUG_QUEST_NAME = DebugQuest.__name__
+FIRST_QUEST_NAME = "IntroQuest"
+DEBUG_QUEST_NAME = "DebugQuest"
 
-all_quests: Dict[str, Type[Quest]] = {}
+CONTENT_PATH = Path(__file__).parent / "content"
 
-for _, module_name, _ in pkgutil.iter_modules(
-    path=[str(Path(__file__).parent / "content")]
-):
-    module = importlib.import_module(".content." + module_name, __package__)
-    classes = inspect.getmembers(module, inspect.isclass)
+# generated with `python -m quest`, see build_manifest()
+MANIFEST_PATH = Path(__file__).parent / "manifest.json"
 
-    for parent, QuestClass in classes:
-        if Quest in QuestClass.__bases__:
-            if QuestClass.__name__ in all_quests:
+
+def scan_quests() -> Dict[str, Type[Quest]]:
+    """ Import every module of quest content, and find the quests defined in them """
+    quests: Dict[str, Type[Quest]] = {}
+    for _, module_name, _ in pkgutil.iter_modules(path=[str(CONTENT_PATH)]):
+        module = importlib.import_module(".content." + module_name, __package__)
+        classes = inspect.getmembers(module, inspect.isclass)
+
+        for _, QuestClass in classes:
+            if Quest in QuestClass.__bases__:
+                if QuestClass.__name__ in quests:
+                    raise QuestDefinitionError(
+                        f"Duplicate quests found with name {QuestClass.__name__}"
+                    )  # pragma: no cover
+                quests[QuestClass.__name__] = QuestClass
+    return quests
+
+
+def build_manifest() -> Dict[str, QuestManifestEntry]:
+    """ Manifest of the quest content as it is now """
+    return {
+        name: QuestManifestEntry(
+            module=QuestClass.__module__.rpartition(".")[2],
+            version=str(QuestClass.version),
+            difficulty=cast(Difficulty, QuestClass.difficulty),
+            stages=QuestClass.plan.ids,
+        )
+        for name, QuestClass in sorted(scan_quests().items())
+    }
+
+
+def dump_manifest(manifest: Dict[str, QuestManifestEntry]) -> str:
+    """ Manifest as written to MANIFEST_PATH """
+    data = {name: json.loads(entry.json()) for name, entry in manifest.items()}
+    return json.dumps(data, indent=4, sort_keys=True) + "\n"
+
+
+@lru_cache(maxsize=None)
+def load_manifest() -> Dict[str, QuestManifestEntry]:
+    """ Manifest of the quest content, as last generated """
+    data = json.loads(MANIFEST_PATH.read_text())
+    return {name: QuestManifestEntry.parse_obj(entry) for name, entry in data.items()}
+
+
+def check_stage_ids(
+    saved: Dict[str, QuestManifestEntry], current: Dict[str, QuestManifestEntry]
+) -> None:
+    """Raise QuestDefinitionError if a stage in the saved manifest has a different
+    id in the current one, or its id was given to another stage. Completed stages
+    are stored by id, so this would change which stages saved quests completed
+    """
+    for name, entry in current.items():
+        if name not in saved:
+            continue
+
+        saved_ids = saved[name].stages
+        saved_names = {stage_id: stage for stage, stage_id in saved_ids.items()}
+        for stage, stage_id in entry.stages.items():
+            saved_id = saved_ids.get(stage)
+            if saved_id is not None and saved_id != stage_id:
+                raise QuestDefinitionError(
+                    f"{name} stage '{stage}' changed id from {saved_id} to "
+                    f"{stage_id}, set its stage_id = {saved_id}"
+                )
+            if saved_id is None and stage_id in saved_names:
                 raise QuestDefinitionError(
-                    f"Duplicate quests found with name {QuestClass.__name__}"
-                )  # pragma: no cover
-            all_quests[QuestClass.__name__] = QuestClass
+                    f"{name} stage '{stage}' took id {stage_id} from stage "
+                    f"'{saved_names[stage_id]}', set a stage_id that wasn't used"
+                )
+
+
+def check_manifest() -> None:
+    """Raise QuestDefinitionError if the manifest is out of date with content, or
+    the content changed the ids of existing stages
+    """
+    check_stage_ids(load_manifest(), build_manifest())
+    if dump_manifest(load_manifest()) != dump_manifest(build_manifest()):
+        raise QuestDefinitionError(
+            f"{MANIFEST_PATH.name} is out of date, regenerate it with "
+            "`python -m quest`"
+        )
+
+
+class QuestRegistry(Mapping[str, Type[Quest]]):
+    """Quests by name, the module defining a quest is only imported the first
+    time the quest is looked up
+    """
+
+    def __init__(self):
+        self.loaded: Dict[str, Type[Quest]] = {}
+
+    def __getitem__(self, name: str) -> Type[Quest]:
+        if name not in self.loaded:
+            entry = load_manifest()[name]
+            module = importlib.import_module(".content." + entry.module, __package__)
+            QuestClass = getattr(module, name, None)
+            if not (inspect.isclass(QuestClass) and issubclass(QuestClass, Quest)):
+                raise QuestDefinitionError(
+                    f"{entry.module} has no quest {name}, the manifest is out of date"
+                )
+            self.loaded[name] = QuestClass
+        return self.loaded[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(load_manifest())
+
+    def __len__(self) -> int:
+        return len(load_manifest())
+
+
+all_quests = QuestRegistry()
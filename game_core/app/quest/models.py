@@ -1,5 +1,6 @@
 """ Data models for quests """
 
+from typing import Dict
 from enum import Enum
 from pydantic import BaseModel, Field
 
@@ -16,3 +17,14 @@ class Difficulty(Enum):
     ADVANCED = 3
     EXPERT = 4
     HACKER = 5
+
+
+class QuestManifestEntry(BaseModel):
+    """ Where a quest is defined, and its metadata, without importing it """
+
+    module: str = Field(..., title="Module in quest content defining the quest")
+    version: str = Field(..., title="Version of the quest")
+    difficulty: Difficulty = Field(..., title="Difficulty of the quest")
+    stages: Dict[str, int] = Field(
+        {}, title="Ids the quest's stages are stored under, by stage name"
+    )
@@ -0,0 +1,198 @@
+""" Stage graphs compiled once per quest class """
+
+from __future__ import annotations
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    cast,
+    TYPE_CHECKING,
+)
+
+from .exceptions import QuestDefinitionError
+
+if TYPE_CHECKING:
+    from .stage import Stage  # pragma: no cover
+
+
+class StagePlan:
+    """Validated and topologically sorted stage graph of a quest class. Stages
+    are referred to by their index in the topological order, and are stored by
+    their stage id, which doesn't change as stages are added
+    """
+
+    __slots__ = (
+        "names",
+        "indexes",
+        "children",
+        "parents",
+        "predecessors",
+        "roots",
+        "ids",
+        "bits",
+    )
+
+    names: Tuple[str, ...]
+    indexes: Dict[str, int]
+    children: Tuple[Tuple[int, ...], ...]
+    parents: Tuple[Tuple[int, ...], ...]
+    predecessors: Tuple[int, ...]
+    roots: Tuple[int, ...]
+    ids: Dict[str, int]
+    bits: Dict[str, int]
+
+    def __init__(self, quest_name: str, stages: Dict[str, Type[Stage]]):
+        # check and dedupe children, in definition order
+        children_of: Dict[str, List[str]] = {}
+        for stage_name, StageClass in stages.items():
+            children = list(dict.fromkeys(cast(List[str], StageClass.children)))
+            for child_name in children:
+                if child_name not in stages:
+                    raise QuestDefinitionError(
+                        f"{quest_name} does not have stage named '{child_name}'"
+                    )
+            children_of[stage_name] = children
+
+        # stage ids default to definition order, the manifest records them so
+        # that changes to existing stages' ids are caught, see check_stage_ids()
+        self.ids = {}
+        self.bits = {}
+        ids: Dict[int, str] = {}
+        for position, (stage_name, StageClass) in enumerate(stages.items()):
+            stage_id = position if StageClass.stage_id is None else StageClass.stage_id
+            if stage_id < 0 or stage_id in ids:
+                raise QuestDefinitionError(
+                    f"{quest_name} stage '{stage_name}' has an invalid or duplicate"
+                    f" stage id {stage_id}"
+                )
+            ids[stage_id] = stage_name
+            self.ids[stage_name] = stage_id
+            self.bits[stage_name] = 1 << stage_id
+
+        # Kahn's algorithm, anything left unordered is on a cycle
+        counts = {stage_name: 0 for stage_name in stages}
+        for children in children_of.values():
+            for child_name in children:
+                counts[child_name] += 1
+
+        order = [stage_name for stage_name, count in counts.items() if not count]
+        remaining = dict(counts)
+        for stage_name in order:
+            for child_name in children_of[stage_name]:
+                remaining[child_name] -= 1
+                if not remaining[child_name]:
+                    order.append(child_name)
+
+        if len(order) != len(stages):
+            cycle = [stage_name for stage_name in stages if remaining[stage_name]]
+            raise QuestDefinitionError(f"{quest_name} has a cycle in stages {cycle}")
+
+        self.names = tuple(order)
+        self.indexes = {stage_name: index for index, stage_name in enumerate(order)}
+        self.children = tuple(
+            tuple(self.indexes[child_name] for child_name in children_of[stage_name])
+            for stage_name in order
+        )
+        parents: List[List[int]] = [[] for _ in order]
+        for index, children_indexes in enumerate(self.children):
+            for child in children_indexes:
+                parents[child].append(index)
+        self.parents = tuple(tuple(stage_parents) for stage_parents in parents)
+        self.predecessors = tuple(len(stage_parents) for stage_parents in parents)
+        self.roots = tuple(
+            index for index, count in enumerate(self.predecessors) if not count
+        )
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def mask(self, stage_names: Iterable[str]) -> int:
+        """ Bitmask of the given stages, unknown stage names are ignored """
+        mask = 0
+        for stage_name in stage_names:
+            mask |= self.bits.get(stage_name, 0)
+        return mask
+
+    def unmask(self, mask: int) -> List[str]:
+        """ Names of the stages in a bitmask, in topological order """
+        return [stage_name for stage_name in self.names if mask & self.bits[stage_name]]
+
+    def frontier(self, is_complete: Callable[[str], bool]) -> List[str]:
+        """Stages that aren't complete but whose parents all are, worked out from
+        scratch for when there's no saved frontier to resume from
+        """
+        return [
+            stage_name
+            for index, stage_name in enumerate(self.names)
+            if not is_complete(stage_name)
+            and all(is_complete(self.names[parent]) for parent in self.parents[index])
+        ]
+
+    def cursor(
+        self, is_complete: Callable[[str], bool], start: Optional[Iterable[str]] = None
+    ) -> StageCursor:
+        """Start a run through the plan from the start stages, by default the
+        frontier of the stages that are complete
+        """
+        if start is None:
+            start = self.frontier(is_complete)
+        return StageCursor(self, is_complete, start)
+
+
+class StageCursor:
+    """Progress of a single run through a StagePlan, with the same interface as
+    graphlib.TopologicalSorter once prepared. The run starts from a frontier of
+    stages, and only visits stages from there on
+    """
+
+    __slots__ = ("plan", "is_complete", "ready", "pending", "seen")
+
+    def __init__(
+        self,
+        plan: StagePlan,
+        is_complete: Callable[[str], bool],
+        start: Iterable[str],
+    ):
+        self.plan = plan
+        self.is_complete = is_complete
+        self.ready = list(dict.fromkeys(plan.indexes[name] for name in start))
+
+        # stages handed out by get_ready() that aren't done yet
+        self.pending: Set[int] = set()
+
+        # stages made ready during this run, so each is only handed out once
+        self.seen: Set[int] = set(self.ready)
+
+    def is_active(self) -> bool:
+        """ Whether there are stages ready, or handed out and not yet done """
+        return bool(self.ready) or bool(self.pending)
+
+    def get_ready(self) -> Tuple[str, ...]:
+        """ Stages whose parents are all done, each is returned once """
+        ready, self.ready = sorted(self.ready), []
+        self.pending.update(ready)
+        return tuple(self.plan.names[index] for index in ready)
+
+    def done(self, stage_name: str) -> None:
+        """Mark a stage done, which has to be complete by now, making children
+        ready once all their parents are complete
+        """
+        index = self.plan.indexes[stage_name]
+        self.pending.discard(index)
+        names = self.plan.names
+        for child in self.plan.children[index]:
+            if child not in self.seen and all(
+                self.is_complete(names[parent]) for parent in self.plan.parents[child]
+            ):
+                self.seen.add(child)
+                self.ready.append(child)
+
+    def frontier(self) -> List[str]:
+        """ Stages ready or handed out but not done, to resume from next time """
+        indexes = sorted({*self.ready, *self.pending})
+        return [self.plan.names[index] for index in indexes]
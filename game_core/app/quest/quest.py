@@ -1,19 +1,23 @@
 """ Base Classes for quest objects """
 from __future__ import annotations
 
-from typing import List, Dict, ClassVar, Type, cast, TYPE_CHECKING
+from typing import Dict, ClassVar, List, Optional, Tuple, Type, TYPE_CHECKING
 
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic
 from inspect import isclass
-from graphlib import TopologicalSorter, CycleError
 
 from structlog import get_logger
 from pydantic import ValidationError
 from semver import VersionInfo  # type:  ignore
 
-from tick import TickType
-from .exceptions import QuestError, QuestLoadError, QuestDefinitionError
+from orm import hydrate_raw
+from tick import TickType, TickBudget
+from .exceptions import QuestError, QuestLoadError
 from .models import Difficulty, QuestBaseModel
+from .plan import StagePlan, StageCursor
 
 
 if TYPE_CHECKING:
@@ -74,8 +78,17 @@ class Quest(ABC):
     # default, overridable model is empty pydantic model
     QuestDataModel: ClassVar[Type[QuestBaseModel]] = QuestBaseModel
 
+    # stage graph, checked and compiled once per class
+    plan: ClassVar[StagePlan]
+
+    # how many ready stages run at once in threads, 1 runs them one at a time.
+    # Stages running together must not write the same quest data
+    stage_workers: ClassVar[int] = 1
+
     def __init_subclass__(cls):
-        """ Subclasses instantiate by copying default data """
+        """Subclasses instantiate by copying default data, their stage graph is
+        compiled here, raising QuestDefinitionError if it's broken
+        """
         from .stage import Stage  # avoid cyclic import
 
         # build class list
@@ -84,38 +97,30 @@ class Quest(ABC):
             if isclass(class_var) and issubclass(class_var, Stage):
                 cls.stages[name] = class_var
 
+        cls.plan = StagePlan(cls.__name__, cls.stages)
+
     # loaded player quest data
     quest_data: QuestBaseModel
-    graph: TopologicalSorter
 
     # the parent object
     quest_page: QuestPage
 
+    # version of the quest the loaded save data was written by
+    saved_version: Optional[VersionInfo]
+
     def __init__(self, quest_page):
         self.quest_page = quest_page
+        # the page stores completed stages by this quest's stage ids
+        quest_page.plan = self.plan
         self.quest_data = self.QuestDataModel()
-        self.load_stages()
-
-    def load_stages(self) -> None:
-        """ loads the stages """
+        self.saved_version = None
 
-        # load graph
-        self.graph = TopologicalSorter()
-        for stage_name, StageClass in self.stages.items():
-            for child_name in cast(List[str], StageClass.children):
-                if child_name not in self.stages:
-                    raise QuestDefinitionError(
-                        f"{self} does not have stage named '{child_name}'"
-                    )
-                self.graph.add(child_name, stage_name)
-
-        try:
-            self.graph.prepare()
-        except CycleError as err:
-            raise QuestDefinitionError(f"{self} prepare failed! {err}") from err
-
-    def load_raw(self, version_str: str, serialized_data: str) -> None:
-        """ Load save data back into structure """
+    def load_raw(
+        self, version_str: str, serialized_data: str, stamp: Optional[str] = None
+    ) -> None:
+        """Load save data back into structure, data stamped with the schema of
+        QuestDataModel is trusted and not validated again
+        """
 
         # check save version is safe before upgrading
         try:
@@ -127,9 +132,10 @@ class Quest(ABC):
             raise QuestLoadError(
                 f"{self} Unsafe version mismatch in! {save_semver} -> {self.version}"
             )
+        self.saved_version = save_semver
 
         try:
-            self.quest_data = self.QuestDataModel.parse_raw(serialized_data)
+            self.quest_data = hydrate_raw(self.QuestDataModel, serialized_data, stamp)
         except ValidationError as err:
             raise QuestLoadError(f"{self} data validation error! {err}") from err
 
@@ -137,54 +143,195 @@ class Quest(ABC):
         """ Returns serialized data to save """
         return self.quest_data.json()
 
-    def execute(self, tick_type: TickType) -> None:
-        """ Executes stages, tick_type helps nodes know whether to skip certain stages """
+    def execute(self, tick_type: TickType, budget: Optional[TickBudget] = None) -> None:
+        """Executes stages, tick_type helps nodes know whether to skip certain
+        stages. Execution stops early once the budget runs out, resuming from the
+        saved frontier next tick
+        """
 
         log = logger.bind(quest=self)
         log.info("Begin execution")
 
-        while self.graph.is_active():
-            ready_nodes = self.graph.get_ready()
-
-            if not ready_nodes:
-                log.info("No more ready nodes, stopping execution")
-                break
-
-            log.info("Got Ready nodes", ready_nodes=ready_nodes)
+        graph = self.plan.cursor(self.quest_page.is_stage_complete, self.frontier())
+        checks: Dict[str, datetime] = {}
+        try:
+            self.execute_stages(graph, tick_type, budget or TickBudget(), checks)
+        finally:
+            frontier = graph.frontier()
+            self.quest_page.set_frontier(
+                frontier, self.runs_on(TickType.FAST, frontier)
+            )
+            self.quest_page.set_next_run(self.next_run(frontier, checks))
 
-            for node in ready_nodes:
-                # skip if completed, avoids triggering two final stages
-                if self.quest_page.is_quest_complete():
-                    log.info("Done flag set, skipping the rest")
-                    return
+        log.info("Done processing node")
 
-                # completed node: TODO: just not put completed nodes into the graph?
-                if self.quest_page.is_stage_complete(node):
-                    self.graph.done(node)
-                    log.info(
-                        "Node is already complete, skipping",
-                        node=node,
-                    )
-                    continue
-
-                log_node = log.bind(node=node)
-                log_node.info("Begin processing stage")
-
-                # instantiate stage and execute
-                StageClass = self.stages[node]
-                stage = StageClass(self)
-                stage.prepare()
-
-                if stage.condition():
-                    log_node.info("Condition check passed, executing")
-                    stage.execute()
-
-                    if stage.is_done():
-                        log_node.info("Stage reports done")
+    def frontier(self) -> Optional[List[str]]:
+        """The frontier saved by the last execution, None if there isn't one that
+        can be trusted, as the stages may have changed since
+        """
+        frontier = self.quest_page.get_frontier()
+        if frontier is None:
+            return None
+        if self.saved_version is not None and self.saved_version != self.version:
+            return None
+        if not all(stage_name in self.plan.indexes for stage_name in frontier):
+            return None
+        return frontier
+
+    def resume_frontier(self) -> List[str]:
+        """ The stages execution would start from """
+        frontier = self.frontier()
+        if frontier is None:
+            return self.plan.frontier(self.quest_page.is_stage_complete)
+        return frontier
+
+    def next_run(
+        self, frontier: List[str], checks: Dict[str, datetime]
+    ) -> Optional[datetime]:
+        """When the quest has something to do next, the earliest check of the
+        frontier's stages. Stages that didn't get to run are due straight away,
+        and there's nothing to do once the quest is complete
+        """
+        if not frontier or self.quest_page.is_quest_complete():
+            return None
+        now = datetime.now(timezone.utc)
+        return min(checks.get(stage_name, now) for stage_name in frontier)
+
+    def runs_on(self, tick_type: TickType, stage_names: List[str]) -> bool:
+        """ Whether any of the stages runs on the tick type """
+        return any(
+            tick_type in self.stages[stage_name].tick_types
+            for stage_name in stage_names
+        )
+
+    def execute_stages(
+        self,
+        graph: StageCursor,
+        tick_type: TickType,
+        budget: TickBudget,
+        checks: Dict[str, datetime],
+    ) -> None:
+        """Executes stages from the graph's frontier onwards, stages that don't run
+        on the tick type are left in the frontier. Stages that ran without being
+        done put when to check them again in checks. With stage_workers,
+        the concurrent stages of each ready batch are started together, but their
+        results are applied in the same order as running them one at a time.
+        Stages always run to the end, the budget is checked between them: no more
+        are started once it's used up, or once a stage overran its time
+        """
+        log = logger.bind(quest=self)
+        stages_left = budget.max_stages
+        pool = None
+        if self.stage_workers > 1:
+            pool = ThreadPoolExecutor(self.stage_workers)
+        try:
+            while graph.is_active():
+                ready_nodes = graph.get_ready()
+
+                if not ready_nodes:
+                    log.info("No more ready nodes, stopping execution")
+                    break
+
+                log.info("Got Ready nodes", ready_nodes=ready_nodes)
+
+                # stages that fit in the budget, the concurrent ones start now
+                budgeted = [
+                    node
+                    for node in ready_nodes
+                    if tick_type in self.stages[node].tick_types
+                    and not self.quest_page.is_stage_complete(node)
+                ][:stages_left]
+
+                started: Dict[str, Future[Tuple[Optional[datetime], float]]] = {}
+                if (
+                    pool is not None
+                    and not self.quest_page.is_quest_complete()
+                    and budget.stage_fits()
+                ):
+                    started = {
+                        node: pool.submit(self.timed_stage, node)
+                        for node in budgeted
+                        if self.stages[node].concurrent
+                    }
+
+                # once out of budget, stages already started are still applied
+                deferring = False
+                for node in ready_nodes:
+                    # skip if completed, avoids triggering two final stages.
+                    # Stages already started still finish, but aren't marked
+                    if self.quest_page.is_quest_complete():
+                        log.info("Done flag set, skipping the rest")
+                        return
+
+                    # completed node, from a frontier saved before it was completed
+                    if self.quest_page.is_stage_complete(node):
+                        graph.done(node)
+                        log.info(
+                            "Node is already complete, skipping",
+                            node=node,
+                        )
+                        continue
+
+                    # left for a tick of a type the stage runs on
+                    if tick_type not in self.stages[node].tick_types:
+                        continue
+
+                    if node in started:
+                        next_check, seconds = started[node].result()
+                    elif deferring or node not in budgeted or not budget.stage_fits():
+                        deferring = True
+                        continue
+                    else:
+                        next_check, seconds = self.timed_stage(node)
+
+                    if stages_left is not None:
+                        stages_left -= 1
+
+                    if next_check is None:
                         self.quest_page.mark_stage_complete(node)
-                        self.graph.done(node)
+                        graph.done(node)
+                    else:
+                        checks[node] = next_check
 
-        log.info("Done processing node")
+                    if budget.overran(seconds):
+                        log.warning("Stage overran", node=node, seconds=seconds)
+                        deferring = True
+
+                if deferring:
+                    log.info("Out of budget, deferring to the next tick")
+                    return
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def timed_stage(self, node: str) -> Tuple[Optional[datetime], float]:
+        """ run_stage(), and the seconds it took """
+        start = monotonic()
+        next_check = self.run_stage(node)
+        return next_check, monotonic() - start
+
+    def run_stage(self, node: str) -> Optional[datetime]:
+        """Instantiate and execute a stage, returns None if it's done, otherwise
+        when it should be checked again
+        """
+        log_node = logger.bind(quest=self, node=node)
+        log_node.info("Begin processing stage")
+
+        StageClass = self.stages[node]
+        stage = StageClass(self)
+        stage.prepare()
+
+        if not stage.condition():
+            return stage.next_check()
+
+        log_node.info("Condition check passed, executing")
+        stage.execute()
+
+        if not stage.is_done():
+            return stage.next_check()
+
+        log_node.info("Stage reports done")
+        return None
 
     def __repr__(self):
         return f"{self.__class__.__name__}(quest_page={self.quest_page})"
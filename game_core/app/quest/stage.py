@@ -2,12 +2,27 @@
 
 from __future__ import annotations
 
-from typing import List, Optional, ClassVar, Any, Callable, TYPE_CHECKING
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Type,
+    cast,
+    TYPE_CHECKING,
+)
 from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
 import operator
 from structlog import get_logger
 
 from character import Character
+from .columns import compare_columns
+from tick import TickType
 
 logger = get_logger(__name__)
 
@@ -33,6 +48,23 @@ class Stage(ABC):
         """ List of children nodes of this stage """
         return NotImplemented
 
+    # stable id the stage's completion is stored under, defaults to the stage's
+    # position in the quest. The manifest records it, and regenerating the
+    # manifest fails if it changes, so set it when stages are inserted, moved or
+    # removed before this one
+    stage_id: ClassVar[Optional[int]] = None
+
+    # whether the stage may run in a thread alongside other ready stages, when
+    # the quest has stage_workers
+    concurrent: ClassVar[bool] = True
+
+    # tick types the stage runs on, quick stages that make no calls out can run
+    # on FAST ticks too
+    tick_types: ClassVar[FrozenSet[TickType]] = frozenset({TickType.FULL})
+
+    # how long a stage that isn't done waits before it's checked again
+    check_interval: ClassVar[timedelta] = timedelta(0)
+
     def prepare(self) -> None:
         """ Any preparation for the stage """
         return
@@ -49,6 +81,10 @@ class Stage(ABC):
         """ Returns whether quest was completed """
         return True
 
+    def next_check(self) -> datetime:
+        """ When to check the stage again if it isn't done, timer stages override """
+        return datetime.now(timezone.utc) + self.check_interval
+
     def __init__(self, quest: Quest):
         self.quest = quest
 
@@ -59,6 +95,8 @@ class Stage(ABC):
 class DebugStage(Stage):
     """ For debugging purposes """
 
+    tick_types = frozenset(TickType)
+
     def prepare(self) -> None:
         """ Print for debug purposes """
         logger.info(f"DEBUG STAGE PREPARE OF {self.quest}")
@@ -71,6 +109,11 @@ class DebugStage(Stage):
 class ConditionStage(Stage):
     """ For conditional branch execution """
 
+    tick_types = frozenset(TickType)
+
+    # quest data doesn't change by itself, so failed conditions can wait a while
+    check_interval = timedelta(minutes=15)
+
     @property
     @abstractmethod
     def variable(cls) -> str:
@@ -86,6 +129,34 @@ class ConditionStage(Stage):
     # the operator to use comparison on
     operator: ClassVar[Callable[..., bool]] = operator.eq
 
+    @classmethod
+    def batchable(cls) -> bool:
+        """ Whether condition_batch() gives the same results as condition() """
+        return (
+            cls.prepare is Stage.prepare and cls.condition is ConditionStage.condition
+        )
+
+    @classmethod
+    def condition_batch(cls, quests: Sequence[Quest]) -> List[bool]:
+        """ condition() for many quests at once, a column of values at a time """
+        variable = cast(str, cls.variable)
+        left = [getattr(quest.quest_data, variable) for quest in quests]
+        if cls.compare_variable is not None:
+            right = [
+                getattr(quest.quest_data, cls.compare_variable) for quest in quests
+            ]
+        else:
+            right = [cls.compare_value] * len(quests)
+
+        passed = compare_columns(cls.operator, left, right)
+        logger.info(
+            "Condition stage batch",
+            stage=cls.__name__,
+            count=len(passed),
+            passed=sum(passed),
+        )
+        return passed
+
     def condition(self) -> bool:
         value_left = getattr(self.quest.quest_data, self.variable)
 
@@ -105,8 +176,49 @@ class ConditionStage(Stage):
         return retval
 
 
+def waiting_on_conditions(quests: Sequence[Quest]) -> List[Optional[datetime]]:
+    """For each quest, when to check it again if executing it now would only find
+    failing conditions, else None. That's when every stage it would resume from
+    is a ConditionStage that fails, conditions are evaluated in a batch for all
+    the quests resuming from the same stage
+    """
+    resuming: Dict[int, List[Type[ConditionStage]]] = {}
+    waiting: Dict[Type[ConditionStage], List[int]] = {}
+    for index, quest in enumerate(quests):
+        frontier = quest.resume_frontier()
+        stages = [quest.stages[stage_name] for stage_name in frontier]
+        if (
+            stages
+            and not quest.quest_page.is_quest_complete()
+            and not any(map(quest.quest_page.is_stage_complete, frontier))
+            and all(
+                issubclass(StageClass, ConditionStage) and StageClass.batchable()
+                for StageClass in stages
+            )
+        ):
+            resuming[index] = cast(List[Type[ConditionStage]], stages)
+            for StageClass in resuming[index]:
+                waiting.setdefault(StageClass, []).append(index)
+
+    for StageClass, indexes in waiting.items():
+        passed = StageClass.condition_batch([quests[index] for index in indexes])
+        for index, condition in zip(indexes, passed):
+            if condition:
+                resuming.pop(index, None)
+
+    return [
+        min(StageClass(quests[index]).next_check() for StageClass in resuming[index])
+        if index in resuming
+        else None
+        for index in range(len(quests))
+    ]
+
+
 class FinalStage(Stage):
-    """ For ending the quest """
+    """ For ending the quest, final stages run one at a time so only one ends it """
+
+    concurrent = False
+    tick_types = frozenset(TickType)
 
     def __init_subclass__(cls):
         cls.children = []
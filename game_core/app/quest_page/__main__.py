@@ -0,0 +1,10 @@
+"""Schedule quest pages saved before next_run existed, run once after deploying
+ticks that only iterate due pages
+"""
+
+from datetime import datetime, timezone
+
+from .quest_page import QuestPage
+
+count = QuestPage.backfill_next_run(datetime.now(timezone.utc))
+print(f"Scheduled {count} quest pages")
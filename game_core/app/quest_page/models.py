@@ -1,12 +1,21 @@
 """ Data models for quests """
 
-from typing import List
+from typing import List, Optional
+from datetime import datetime, timezone
 from pydantic import BaseModel, Field
 
 
 class QuestData(BaseModel):
     quest_name: str = Field("", title="Name of the Quest")
     version: str = Field("", title="Version number to control loading")
-    completed_stages: List[str] = Field([], title="List of completed stage names")
+    completed: bytes = Field(b"", title="Bitmask of completed stage ids")
+    completed_stages: List[str] = Field([], title="Legacy list of completed stages")
+    frontier: Optional[List[str]] = Field(None, title="Stages to resume from")
+    fast: bool = Field(False, title="Whether the frontier runs on FAST ticks")
+    next_run: Optional[datetime] = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        title="When the quest is next due, new quests are due straight away",
+    )
     serialized_data: str = Field("", title="Serialized save data")
+    quest_schema: str = Field("", title="Schema stamp of the serialized save data")
     complete: bool = Field(False, title="Whether quest is completed")
@@ -1,22 +1,36 @@
 """ Base Classes for quest objects """
 from __future__ import annotations
-from typing import Generator
+from typing import Generator, Iterable, List, Optional, cast
+from datetime import datetime
 from structlog import get_logger
+from google.cloud.firestore_v1.base_document import DocumentSnapshot  # type: ignore
 
-from orm import Orm
+from orm import Orm, NoKey, schema_stamp
 from game import Game
 
 from quest import Quest, FIRST_QUEST_NAME, QuestLoadError
-from tick import TickType
+from quest.plan import StagePlan
+from tick import TickType, TickBudget
 from .models import QuestData
 
 logger = get_logger(__name__)
 
+# fields holding the quest's own save data
+QUEST_FIELDS = ("version", "serialized_data", "quest_schema")
+
+# fields holding completed stages, the list is only read to migrate it
+COMPLETED_FIELDS = ("completed", "completed_stages")
+
 
 class QuestPage(Orm, collection="quest", parent_orm=Game):
     data: QuestData
     storage_model = QuestData
-    quest: Quest
+
+    # whether loading the quest's save data waits for first access to .quest
+    quest_deferred: bool
+
+    # stage graph of the quest, which gives the stage ids of completed stages
+    plan: StagePlan
 
     @staticmethod
     def make_key(game: Game, quest_name: str) -> str:
@@ -31,55 +45,190 @@ class QuestPage(Orm, collection="quest", parent_orm=Game):
     @classmethod
     def from_game_get_quest(cls, game: Game, quest_name: str) -> QuestPage:
         key = cls.make_key(game, quest_name)
-        quest = cls(key, quest_name)
-        return quest
+        quest_page = cls.cached(key)
+        if quest_page is None:
+            quest_page = cls(key, quest_name)
+            quest_page.parent_key = game.key
+            quest_page.remember()
+        return cast(QuestPage, quest_page)
+
+    @classmethod
+    def iterate_all(
+        cls,
+        prefetch_depth: int = 0,
+        fields: Optional[List[str]] = None,
+        tick_type: TickType = TickType.FULL,
+        due: Optional[datetime] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> Generator[QuestPage, None, None]:
+        """Iterate over all quests, the generator yields loaded quest_pages, with
+        prefetch_depth levels of parents (game, user) fetched in batches. Only
+        the page's data is fetched, or just fields if given, in which case the
+        rest is fetched on first use. FAST ticks only iterate pages that have
+        stages to run on them, and given a due time, only pages scheduled to run
+        by then are iterated, most overdue first. start and end limit pages to a
+        range of keys
+        """
+        query = cls.query().key_range(start, end).prefetch(prefetch_depth)
+        if due is None:
+            query = query.where("complete", "!=", True)
+        else:
+            # complete quests have no next_run, so they're left out too
+            query = query.where("next_run", "<=", due).order_by("next_run")
+        if tick_type is TickType.FAST:
+            query = query.where("fast", "==", True)
+        # quest_name is needed to construct quest pages, and the legacy list of
+        # completed stages is fetched with the bitmask so it can be moved over
+        if fields is not None:
+            if "completed" in fields:
+                fields = [*fields, "completed_stages"]
+            fields = ["quest_name", *fields]
+        query = query.select(list(QuestData.__fields__) if fields is None else fields)
+        for quest_page in query:
+            yield cast(QuestPage, quest_page)
 
     @classmethod
-    def iterate_all(cls) -> Generator[QuestPage, None, None]:
-        """ Iterate over all quests, the generator yields loaded quest_pages """
-        docs = cls.col_ref.where("complete", "!=", True).stream()
-        for doc in docs:
-            data = cls.storage_model.parse_obj(doc.to_dict())
-            quest_page = cls(doc.id, data.quest_name)
-            quest_page.data = data
-            quest_page.quest.load_raw(data.version, data.serialized_data)
-            yield quest_page
+    def backfill_next_run(cls, due: datetime) -> int:
+        """Schedule quest pages saved before next_run existed to run at due, ticks
+        only query pages by next_run so they would never pick them up otherwise.
+        Only next_run is fetched and written, returns how many were scheduled
+        """
+        count = 0
+        query = cls.query().where("complete", "!=", True).select(["next_run"])
+        with cls.batch() as orm_batch:
+            for doc in query.stream():
+                if "next_run" not in (doc.to_dict() or {}):
+                    orm_batch.update(doc.reference, {"next_run": due})
+                    count += 1
+        return count
+
+    @classmethod
+    def iterate_game(cls, game: Game) -> Generator[QuestPage, None, None]:
+        """ Iterate over a game's quests that aren't complete """
+        query = cls.query().where("parent_key", "==", game.key)
+        for quest_page in query.where("complete", "!=", True):
+            quest_page.fetched_parent = game
+            yield cast(QuestPage, quest_page)
+
+    @classmethod
+    def from_snapshot(
+        cls, doc: DocumentSnapshot, fields: Optional[Iterable[str]] = None
+    ) -> QuestPage:
+        """ Create quest page from snapshot, quest_name is needed to construct """
+        quest_page = cast(Optional[QuestPage], cls.cached(doc.id)) or cls(
+            doc.id, doc.get("quest_name")
+        )
+        quest_page.load_snapshot(doc, fields)
+        quest_page.remember()
+        return quest_page
 
     def __init__(self, key: str, quest_name):
         super().__init__(key)
-        self.quest = Quest.from_name(quest_name, self)
+        self._quest = Quest.from_name(quest_name, self)
+        self.quest_deferred = False
         self.data.quest_name = quest_name
 
-    def load(self) -> None:
-        """ Additionally parse the quest storage """
-        super().load()
-        if isinstance(self.quest, Quest):
-            self.quest.load_raw(self.data.version, self.data.serialized_data)
-
-    def save(self) -> None:
-        """ Additionally parse out the quest storage """
-        if isinstance(self.quest, Quest):
+    @property
+    def quest(self) -> Quest:
+        """ The quest, with its save data loaded """
+        if self.quest_deferred:
+            self.quest_deferred = False
+            self.require(*QUEST_FIELDS)
+            self.load_quest()
+        return self._quest
+
+    def load_quest(self) -> None:
+        """ Parse the quest storage """
+        self._quest.load_raw(
+            self.data.version,
+            self.data.serialized_data,
+            self.data.quest_schema if self.trusted_reads else None,
+        )
+
+    def load_snapshot(
+        self, doc: DocumentSnapshot, fields: Optional[Iterable[str]] = None
+    ) -> None:
+        """ Additionally parse the quest storage, unless it was deferred """
+        super().load_snapshot(doc, fields)
+        self.quest_deferred = any(field in self.deferred for field in QUEST_FIELDS)
+        if not self.quest_deferred:
+            self.load_quest()
+
+    def load_storage_model(self, data: dict) -> None:
+        """ Pages saved without parent_key get it from the game key in their key """
+        super().load_storage_model(data)
+        if self.parent_key is NoKey and isinstance(self.key, str):
+            self.parent_key = self.key.rpartition(":")[0]
+
+    def before_save(self) -> None:
+        """ Parse out the quest storage, unless it was never loaded """
+        if not self.quest_deferred:
             self.data.serialized_data = self.quest.save_raw()
             self.data.version = str(self.quest.version)
-        super().save()
-
-    def execute(self, tick_type: TickType) -> None:
-        """ Execute """
-        self.quest.execute(tick_type)
+            self.data.quest_schema = schema_stamp(self.quest.QuestDataModel)
+
+    def execute(self, tick_type: TickType, budget: Optional[TickBudget] = None) -> None:
+        """ Execute, within the tick's budget if given """
+        self.quest.execute(tick_type, budget)
+
+    @property
+    def completed_mask(self) -> int:
+        """Bitmask of completed stages by stage id, stages completed before the
+        bitmask was used are moved over from the old list on first access
+        """
+        self.require(*COMPLETED_FIELDS)
+        mask = int.from_bytes(self.data.completed, "little")
+        if self.data.completed_stages:
+            mask |= self.plan.mask(self.data.completed_stages)
+            self.completed_mask = mask
+        return mask
+
+    @completed_mask.setter
+    def completed_mask(self, mask: int) -> None:
+        self.require(*COMPLETED_FIELDS)
+        self.data.completed = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+        self.data.completed_stages = []
+
+    def completed_stages(self) -> List[str]:
+        """ Names of the completed stages """
+        return self.plan.unmask(self.completed_mask)
 
     def mark_stage_complete(self, stage_name: str) -> None:
         """ Mark a stage as completed """
-        if stage_name not in self.data.completed_stages:
-            self.data.completed_stages.append(stage_name)
+        bit = self.plan.bits[stage_name]
+        mask = self.completed_mask
+        if not mask & bit:
+            self.completed_mask = mask | bit
 
     def is_stage_complete(self, stage_name: str) -> bool:
         """ Returns whether stage is completed """
-        return stage_name in self.data.completed_stages
+        return bool(self.completed_mask & self.plan.bits[stage_name])
+
+    def get_frontier(self) -> Optional[List[str]]:
+        """ Stages execution left off at, None if not known """
+        self.require("frontier")
+        return self.data.frontier
+
+    def set_frontier(self, frontier: List[str], fast: bool = False) -> None:
+        """Save the stages execution left off at, and whether any of them run on
+        FAST ticks, which only iterate pages that have such stages
+        """
+        self.require("frontier", "fast")
+        self.data.frontier = frontier
+        self.data.fast = fast
+
+    def set_next_run(self, next_run: Optional[datetime]) -> None:
+        """ Schedule the quest for the first tick after next_run, None for never """
+        self.require("next_run")
+        self.data.next_run = next_run
 
     def mark_quest_complete(self) -> None:
         """ Mark the quest as complete """
+        self.require("complete")
         self.data.complete = True
 
     def is_quest_complete(self) -> bool:
         """ Returns whether the quest is complete """
+        self.require("complete")
         return self.data.complete
@@ -1 +1,4 @@
-from .tick import TickEvent, TickType
+from .tick import TickEvent, TickType, TickShard
+from .budget import TickBudget
+from .publisher import publish_ticks
+from .pipeline import run_pipeline
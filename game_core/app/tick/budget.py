@@ -0,0 +1,51 @@
+""" Limits on how much work a tick does, keeping it under the function timeout """
+
+from typing import Optional
+from time import monotonic
+
+
+class TickBudget:
+    """Budgets for a tick, None leaves a budget unlimited. max_stages is the
+    number of stages each quest page may run, max_stage_time is the seconds a
+    stage is expected to take at most, and the deadline is duration seconds from
+    when the budget is made, after which no more stages or quest pages are
+    started. A quest page starts no more stages once one overran max_stage_time
+    """
+
+    __slots__ = ("max_stages", "max_stage_time", "deadline")
+
+    def __init__(
+        self,
+        max_stages: Optional[int] = None,
+        max_stage_time: Optional[float] = None,
+        duration: Optional[float] = None,
+    ):
+        self.max_stages = max_stages
+        self.max_stage_time = max_stage_time
+        self.deadline = None if duration is None else monotonic() + duration
+
+    def remaining(self) -> Optional[float]:
+        """ Seconds left before the deadline, None if there isn't one """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        """ Whether the deadline has passed """
+        return self.remaining() == 0.0
+
+    def stage_fits(self) -> bool:
+        """Whether a stage may start: the deadline hasn't passed, and if stages
+        have a time limit, there's at least that long left before it. Stages
+        can't be interrupted, so they have to be expected to finish in time
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return True
+        if self.max_stage_time is None:
+            return remaining > 0.0
+        return remaining >= self.max_stage_time
+
+    def overran(self, seconds: float) -> bool:
+        """ Whether a stage that took seconds went over max_stage_time """
+        return self.max_stage_time is not None and seconds > self.max_stage_time
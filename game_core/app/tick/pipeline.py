@@ -0,0 +1,98 @@
+""" Pipelines of steps running in their own threads, for overlapping network waits """
+
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+from contextvars import copy_context
+from queue import Queue
+from threading import Lock, Thread
+
+# items waiting between two steps, a step that's ahead blocks once this is full
+PIPELINE_QUEUE_SIZE = 8
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    steps: Sequence[Callable[[Any], Any]],
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+) -> None:
+    """Feed items from source through steps, each taking the previous step's
+    result. Iterating the source and each step run in their own thread, joined
+    by bounded queues so items stay in order and a slow step holds back the ones
+    before it. Threads run in copies of the caller's context, so batches and
+    identity scopes are shared.
+
+    Once something raises for an item, no more items are taken from the source,
+    and items after it are dropped while the ones before it carry on, so the
+    last step sees the same items as it would running serially. After all
+    threads have stopped, the error of the earliest item is raised
+    """
+    queues: List[Queue] = [Queue(queue_size) for _ in steps]
+    lock = Lock()
+    errors: List[Tuple[int, BaseException]] = []
+    failed_at: Optional[int] = None
+
+    def fail(index: int, err: BaseException) -> None:
+        nonlocal failed_at
+        with lock:
+            errors.append((index, err))
+            if failed_at is None or index < failed_at:
+                failed_at = index
+
+    def dropped(index: int) -> bool:
+        return failed_at is not None and index >= failed_at
+
+    def produce() -> None:
+        index = 0
+        try:
+            for item in source:
+                if failed_at is not None:
+                    break
+                queues[0].put((index, item))
+                index += 1
+        except BaseException as err:  # pylint: disable=broad-except
+            fail(index, err)
+        finally:
+            queues[0].put(_DONE)
+
+    def consume(step_index: int) -> None:
+        step = steps[step_index]
+        inbox = queues[step_index]
+        outbox = queues[step_index + 1] if step_index + 1 < len(queues) else None
+
+        # keeps taking items until the end, even dropped ones, so earlier steps
+        # never block on a full queue
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                break
+
+            index, item = entry
+            if dropped(index):
+                continue
+
+            try:
+                result = step(item)
+            except BaseException as err:  # pylint: disable=broad-except
+                fail(index, err)
+                continue
+
+            if outbox is not None:
+                outbox.put((index, result))
+
+        if outbox is not None:
+            outbox.put(_DONE)
+
+    threads = [Thread(target=copy_context().run, args=(produce,))]
+    for step_index in range(len(steps)):
+        threads.append(Thread(target=copy_context().run, args=(consume, step_index)))
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        _, err = min(errors, key=lambda error: error[0])
+        raise err
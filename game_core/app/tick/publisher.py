@@ -0,0 +1,55 @@
+""" Publishing ticks to the tick topic """
+
+from typing import Any, Iterable, Optional
+from threading import Lock
+
+from environs import Env
+
+from .tick import TickEvent
+
+env = Env()
+GCP_PROJECT_ID = env("GCP_PROJECT_ID", "")
+TICK_TOPIC = env("TICK_TOPIC", "tick")
+
+_lock = Lock()
+_publisher: Optional[Any] = None
+
+
+def get_publisher() -> Any:
+    """ Pub/Sub publisher, created on first use as only coordinator ticks need it """
+    global _publisher  # pylint: disable=global-statement
+    if _publisher is None:
+        with _lock:
+            if _publisher is None:
+                # pylint: disable=import-outside-toplevel
+                from google.cloud import pubsub_v1  # type: ignore
+
+                _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+
+def get_project_id() -> str:
+    """GCP_PROJECT_ID, or the project of the default credentials if it's not
+    set, raising rather than publishing to a topic outside any project
+    """
+    if GCP_PROJECT_ID:
+        return GCP_PROJECT_ID
+
+    import google.auth  # type: ignore # pylint: disable=import-outside-toplevel
+
+    _, project_id = google.auth.default()
+    if not project_id:
+        raise RuntimeError("GCP_PROJECT_ID not set, and credentials have no project")
+    return project_id
+
+
+def publish_ticks(tick_events: Iterable[TickEvent]) -> None:
+    """ Publish ticks to the tick topic, waiting until all are sent """
+    publisher = get_publisher()
+    topic = publisher.topic_path(get_project_id(), TICK_TOPIC)
+    futures = [
+        publisher.publish(topic, tick_event.json().encode())
+        for tick_event in tick_events
+    ]
+    for future in futures:
+        future.result()
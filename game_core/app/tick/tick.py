@@ -1,5 +1,7 @@
 """ Metadata pertaining to ticks/game loop execution """
 
+from __future__ import annotations
+from typing import List, Optional
 from enum import Enum
 from pydantic import BaseModel, Field
 
@@ -9,7 +11,30 @@ class TickType(Enum):
     FULL = "FULL"
 
 
+class TickShard(BaseModel):
+    """ Range of quest keys processed by one worker tick """
+
+    start: Optional[str] = Field(None, title="First key, None for the beginning")
+    end: Optional[str] = Field(None, title="Key after the last, None for the end")
+
+
 class TickEvent(BaseModel):
-    """ Model for ticks """
+    """Model for ticks, a tick with shards and no shard coordinates workers that
+    each tick a shard of the quests
+    """
 
     tick_type: TickType = Field(..., title="Type of tick")
+    shards: int = Field(1, ge=1, title="How many worker ticks to fan out to")
+    shard: Optional[TickShard] = Field(None, title="Quests for a worker tick")
+
+    def fan_out(self, keys: List[str]) -> List[TickEvent]:
+        """ Worker ticks for the shards between split keys """
+        bounds = [None, *keys, None]
+        return [
+            TickEvent(
+                tick_type=self.tick_type,
+                shards=1,
+                shard=TickShard(start=start, end=end),
+            )
+            for start, end in zip(bounds, bounds[1:])
+        ]
@@ -1,7 +1,7 @@
 """ User entity management, note: User entities in firestore are not necessary auth users """
 
 from __future__ import annotations
-from typing import Union
+from typing import Union, cast
 
 from orm import Orm
 from .models import UserData, Source
@@ -21,9 +21,7 @@ class User(Orm, collection="user"):
     def from_source_id(cls, source: Source, user_id: str) -> User:
         """ Create a user from the source+id """
         key = cls.make_key(source, user_id)
-        user = cls(key)
-        user.load()
-        return user
+        return cast(User, cls.get(key))
 
     @classmethod
     def new_from_data(cls, uid: str, source: Source, user_data: UserData) -> User:
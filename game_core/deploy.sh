@@ -17,6 +17,11 @@ if [[ -z "$WEB_API_KEY" ]]; then
     exit 1
 fi
 
+if [[ -z "$GCP_PROJECT_ID" ]]; then
+    echo "GCP_PROJECT_ID not set, run inside pipenv" 1>&2
+    exit 1
+fi
+
 pipenv lock -r > app/requirements.txt
 
 # Deploy github webhook listener
@@ -49,4 +54,5 @@ gcloud functions deploy tick \
     --trigger-resource "tick" \
     --memory=128MB \
     --source app \
+    --set-env-vars=GCP_PROJECT_ID=$GCP_PROJECT_ID \
     --service-account=$GCP_FUNCTIONS_SERVICE_ACCOUNT
\ No newline at end of file
@@ -0,0 +1,122 @@
+""" Tests for storage backends """
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+
+from firebase_utils import firestore, get_backend, use_backend, Backend, MemoryBackend
+from user import User, Source, UserData
+
+
+@pytest.fixture
+def memory_backend():
+    """ A fresh in-memory backend for the duration of the test """
+    backend = MemoryBackend(testing=True)
+    previous = use_backend(backend)
+    yield backend
+    use_backend(previous)
+
+
+def test_use_backend(memory_backend, testing_user):
+    """ The ORM stores data in whichever backend is in use """
+    assert get_backend() is memory_backend
+    assert not User(testing_user.key).exists
+
+    user = User(User.make_key(Source.TEST, "memory"))
+    user.save()
+    assert user.exists
+    assert memory_backend.db.collection("user").document(user.key).get().exists
+
+
+def test_backend_abstract(memory_backend):
+    """ Backends have to say how to create their async client """
+    with pytest.raises(TypeError):
+        Backend(memory_backend.client)  # pylint: disable=abstract-class-instantiated
+
+
+def test_memory_writes(memory_backend):
+    """ Writes, transforms and preconditions behave like firestore """
+    doc_ref = memory_backend.collection("things").document("thing")
+
+    with pytest.raises(NotFound):
+        doc_ref.update({"a": 1})
+
+    doc_ref.create({"a": 1, "b": [1], "created": firestore.SERVER_TIMESTAMP})
+    with pytest.raises(AlreadyExists):
+        doc_ref.create({"a": 2})
+
+    doc_ref.set({"b": firestore.ArrayUnion([1, 2]), "c": 3}, merge=True)
+    doc = doc_ref.get()
+    assert doc.to_dict()["b"] == [1, 2]
+    assert doc.get("created")
+
+    doc_ref.set({"a": 4, "c": 5}, merge=["a"])
+    assert doc_ref.get().to_dict() == {**doc.to_dict(), "a": 4}
+
+    stale = memory_backend.write_option(last_update_time=doc.update_time)
+    with pytest.raises(FailedPrecondition):
+        doc_ref.update({"a": 6}, option=stale)
+
+    doc_ref.set({"d": 1})
+    assert doc_ref.get().to_dict() == {"d": 1}
+
+
+def test_memory_batch_atomic(memory_backend):
+    """ Batches apply all of their writes or none """
+    col_ref = memory_backend.collection("things")
+    col_ref.document("existing").set({"a": 1})
+
+    batch = memory_backend.batch()
+    batch.set(col_ref.document("new"), {"a": 2})
+    batch.update(col_ref.document("existing"), {"a": 3})
+    batch.update(col_ref.document("missing"), {"a": 4})
+    with pytest.raises(NotFound):
+        batch.commit()
+
+    assert not col_ref.document("new").get().exists
+    assert col_ref.document("existing").get().get("a") == 1
+
+
+def test_memory_query(memory_backend):
+    """ Queries filter, order, project and page """
+    col_ref = memory_backend.collection("things")
+    for idx, value in enumerate([3, None, 1, 2]):
+        col_ref.document(f"doc{idx}").set({"value": value, "other": idx})
+    col_ref.document("no_value").set({"other": 9})
+
+    assert [doc.id for doc in col_ref.order_by("value").stream()] == [
+        "doc1",
+        "doc2",
+        "doc3",
+        "doc0",
+    ]
+    assert [doc.id for doc in col_ref.where("value", ">", 1).stream()] == [
+        "doc3",
+        "doc0",
+    ]
+    # like firestore, != doesn't match nulls
+    assert [doc.id for doc in col_ref.where("value", "!=", 1).stream()] == [
+        "doc3",
+        "doc0",
+    ]
+
+    query = col_ref.order_by("value", direction=firestore.Query.DESCENDING).limit(2)
+    assert [doc.id for doc in query.stream()] == ["doc0", "doc3"]
+
+    (last,) = query.limit(1).stream()
+    assert [doc.id for doc in query.start_after(last).stream()] == ["doc3", "doc2"]
+
+    (doc,) = col_ref.where("other", "==", 9).select(["other"]).stream()
+    assert doc.to_dict() == {"other": 9}
+
+
+def test_lazy_backend(memory_backend):
+    """ The configured backend is created once, on first use """
+    use_backend(None)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        created = list(executor.map(lambda _: get_backend(), range(32)))
+
+    assert all(backend is created[0] for backend in created)
+    assert created[0] is not memory_backend
+    assert created[0].collection("user") is created[0].collection("user")
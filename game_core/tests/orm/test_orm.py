@@ -0,0 +1,626 @@
+""" Tests for the ORM base class """
+
+import asyncio
+from typing import List, Optional
+
+import pytest
+from pydantic import BaseModel
+from firebase_utils import firestore, get_backend
+from user import User, Source, UserData
+from quest_page import QuestPage
+from game import Game
+from orm import (
+    NoKey,
+    OrmNotFound,
+    OrmConflict,
+    IdentityMap,
+    MAX_BATCH_SIZE,
+    schema_stamp,
+    hydrate,
+    hydrate_raw,
+)
+from orm.sentinels import DocRefNotFound
+
+
+@pytest.fixture
+def orm_user(random_id):
+    """ A user that doesn't exist in the database yet, cleans up afterwards """
+    user = User(User.make_key(Source.TEST, "orm_" + random_id))
+    yield user
+    user.delete()
+
+
+def test_persisted_state(orm_user):
+    """ Persistence state is tracked through load/save/delete """
+    assert orm_user.persisted is None
+
+    orm_user.load()
+    assert orm_user.persisted is False
+
+    orm_user.save()
+    assert orm_user.persisted is True
+    assert orm_user.exists
+
+    orm_user.delete()
+    assert orm_user.persisted is False
+    assert not orm_user.exists
+
+
+def test_save_unknown_state(orm_user):
+    """ Saving over an existing document without loading it first merges """
+    orm_user.data = UserData(name="first")
+    orm_user.save()
+
+    user = User(orm_user.key)
+    assert user.persisted is None
+    user.data = UserData(handle="second")
+    user.save()
+
+    orm_user.load()
+    assert orm_user.data.handle == "second"
+    assert orm_user.doc_ref.get().get("created")
+
+
+def test_upsert(orm_user):
+    """ Upsert merges without checking for existence """
+    orm_user.data = UserData(name="upserted")
+    orm_user.save(upsert=True)
+    assert orm_user.persisted
+
+    user = User(orm_user.key)
+    user.load()
+    assert user.data.name == "upserted"
+
+
+def test_no_key_persisted():
+    """ Objects without key are known not to exist """
+    user = User(NoKey)
+    assert user.persisted is False
+
+
+def test_no_changes_skips_write(orm_user):
+    """ Saving a loaded object without changes doesn't write """
+    orm_user.save()
+    orm_user.load()
+    update_time = orm_user.doc_ref.get().update_time
+
+    assert not orm_user.get_changes()
+    orm_user.save()
+    assert orm_user.doc_ref.get().update_time == update_time
+
+
+def test_partial_update(orm_user):
+    """ Only changed fields are written """
+    orm_user.data = UserData(name="name", handle="handle")
+    orm_user.save()
+
+    # change the database behind the object's back
+    orm_user.doc_ref.update({"name": "changed elsewhere"})
+
+    orm_user.data.handle = "new handle"
+    assert orm_user.get_changes() == {"handle": "new handle"}
+    orm_user.save()
+
+    orm_user.load()
+    assert orm_user.data.name == "changed elsewhere"
+    assert orm_user.data.handle == "new handle"
+
+
+def test_list_append_changes(testing_quest_page):
+    """ Appending to a list produces an ArrayUnion of the new items """
+    testing_quest_page.save()
+    testing_quest_page.data.frontier = []
+    testing_quest_page.save()
+    testing_quest_page.data.frontier.append("Start")
+
+    changes = testing_quest_page.get_changes()
+    assert list(changes) == ["frontier"]
+    assert isinstance(changes["frontier"], firestore.ArrayUnion)
+
+    testing_quest_page.save()
+    testing_quest_page.load()
+    assert testing_quest_page.data.frontier == ["Start"]
+    testing_quest_page.delete()
+
+
+def test_plan_save(orm_user):
+    """ Saves plan their write from what is known of the document """
+    doc_data = orm_user.get_document_data()
+
+    write = orm_user.plan_save(doc_data)
+    assert write.method == "create"
+    assert write.fallback.method == "set" and write.fallback.options == {"merge": True}
+    assert orm_user.plan_save(doc_data, batched=True).method == "set"
+
+    orm_user.load()
+    write = orm_user.plan_save(doc_data, batched=True)
+    assert (write.method, write.fallback) == ("set", None)
+    assert "created" in write.doc_data
+
+    orm_user.save()
+    assert orm_user.plan_save(orm_user.get_document_data()) is None
+    orm_user.data.name = "planned"
+    write = orm_user.plan_save(orm_user.get_document_data())
+    assert write.method == "update"
+    assert set(write.doc_data) == {"name", "updated"}
+
+
+def test_batch(orm_user):
+    """ Writes inside a batch are committed on exit """
+    with User.batch() as orm_batch:
+        orm_user.save()
+        assert len(orm_batch) == 1
+        assert not User(orm_user.key).exists
+
+    assert orm_batch.commits == 1
+    assert User(orm_user.key).exists
+
+    with User.batch():
+        orm_user.delete()
+    assert not User(orm_user.key).exists
+
+
+def test_batch_created(orm_user):
+    """ Documents known not to exist get "created" when saved inside a batch """
+    orm_user.load()
+    assert orm_user.persisted is False
+
+    with User.batch():
+        orm_user.save()
+
+    assert orm_user.doc_ref.get().get("created")
+
+
+def test_batch_created_unknown(orm_user):
+    """ Documents not known to exist or not are looked up before a batched save """
+    assert orm_user.persisted is None
+
+    with User.batch():
+        orm_user.save()
+    created = orm_user.doc_ref.get().get("created")
+    assert created
+
+    # documents that turn out to exist keep theirs
+    user = User(orm_user.key)
+    with User.batch():
+        user.save()
+    assert user.doc_ref.get().get("created") == created
+
+
+def test_batch_flush_on_size(random_id):
+    """ Batches commit whenever they fill up """
+    users = [
+        User(User.make_key(Source.TEST, f"batch_{random_id}_{idx}")) for idx in range(5)
+    ]
+
+    with User.batch(size=2) as orm_batch:
+        for user in users:
+            user.save()
+        assert orm_batch.commits == 2
+        assert len(orm_batch) == 1
+
+    assert orm_batch.commits == 3
+    assert all(User(user.key).exists for user in users)
+
+    with User.batch():
+        for user in users:
+            user.delete()
+
+
+def test_batch_discard(orm_user):
+    """ Uncommitted writes are discarded when the batch errors """
+    with pytest.raises(RuntimeError):
+        with User.batch():
+            orm_user.save()
+            raise RuntimeError("abort")
+
+    assert not User(orm_user.key).exists
+
+
+def test_batch_size_invalid():
+    """ Batches can't exceed firestore's limit """
+    with pytest.raises(ValueError):
+        with User.batch(size=MAX_BATCH_SIZE + 1):
+            pass
+
+
+def test_get_many(testing_user, random_id):
+    """ Fetch several objects at once """
+    missing_key = User.make_key(Source.TEST, "missing_" + random_id)
+
+    users = User.get_many([testing_user.key, missing_key, testing_user.key])
+    assert users[0].key == testing_user.key
+    assert users[0].data == testing_user.data
+    assert users[0].persisted
+    assert users[1] is OrmNotFound
+    assert users[2].key == testing_user.key
+
+    assert User.get_many([]) == []
+
+
+def test_get_many_quest_pages(testing_quest_page):
+    """ Quest pages are hydrated along with their quest """
+    testing_quest_page.save()
+
+    (quest_page,) = QuestPage.get_many([testing_quest_page.key])
+    assert quest_page.quest.__class__ is testing_quest_page.quest.__class__
+    assert quest_page.data == testing_quest_page.data
+
+    testing_quest_page.delete()
+
+
+def test_identity_scope(testing_user):
+    """ Inside an identity scope a key resolves to one object, loaded once """
+    with User.identity_scope() as identity_map:
+        user = User.get(testing_user.key)
+        assert user.persisted
+        assert User.get(testing_user.key) is user
+        assert User.from_source_id(Source.TEST, testing_user.data.id) is user
+        assert User.get_many([testing_user.key]) == [user]
+        assert len(identity_map) == 1
+
+        # nested scopes share the map
+        with User.identity_scope() as inner_map:
+            assert inner_map is identity_map
+
+    assert User.get(testing_user.key) is not user
+
+
+def test_identity_scope_delete(orm_user):
+    """ Deleted objects stay in the scope, known not to exist """
+    orm_user.save()
+    with User.identity_scope():
+        user = User.get(orm_user.key)
+        user.delete()
+        assert User.get(orm_user.key) is user
+        assert User.get_many([orm_user.key]) == [OrmNotFound]
+
+
+def test_identity_scope_parent(testing_user):
+    """ Parents resolve through the identity scope """
+    with User.identity_scope():
+        user = User.get(testing_user.key)
+        game = Game.from_user(user)
+        assert Game.from_user(user) is game
+        assert game.parent is user
+        assert game.parent is game.parent
+
+
+def test_identity_map_lru(random_id):
+    """ Bounded identity maps evict the least recently used object """
+    identity_map = IdentityMap(max_size=2)
+    users = [User(f"{random_id}_{idx}") for idx in range(3)]
+
+    with User.identity_scope(identity_map):
+        for user in users:
+            user.remember()
+            assert User.cached(users[0].key) is users[0]
+
+    assert len(identity_map) == 2
+    assert identity_map.get(User.collection, users[0].key) is users[0]
+    assert identity_map.get(User.collection, users[1].key) is None
+
+    with pytest.raises(ValueError):
+        IdentityMap(max_size=0)
+
+
+@pytest.fixture
+def query_users(random_id):
+    """ A handful of users sharing a random handle to query on """
+    users = []
+    with User.batch():
+        for idx in range(5):
+            user = User(User.make_key(Source.TEST, f"query_{random_id}_{idx}"))
+            user.data = UserData(handle=random_id, name=f"{random_id}_{4 - idx}")
+            user.save()
+            users.append(user)
+    yield users
+
+    with User.batch():
+        for user in users:
+            user.delete()
+
+
+def query_names(random_id):
+    """Query for the query_users by a range of their names, which is served by
+    single field indexes when also ordered by name
+    """
+    query = User.query().where("name", ">=", random_id)
+    return query.where("name", "<", random_id + "`")
+
+
+def test_query(query_users, random_id):
+    """ Query with filters, ordering and limits, paging through small pages """
+    query = User.query().where("handle", "==", random_id).page_size(2)
+
+    assert [user.key for user in query] == [user.key for user in query_users]
+    assert [user.key for user in query.limit(3)] == [
+        user.key for user in query_users[:3]
+    ]
+
+    query = query_names(random_id).page_size(2)
+    assert [user.data.name for user in query.order_by("name")] == [
+        f"{random_id}_{idx}" for idx in range(5)
+    ]
+    assert [user.key for user in query.order_by("name", descending=True)] == [
+        user.key for user in query_users
+    ]
+
+
+def test_query_resume(query_users, random_id):
+    """ Resume a query after an object, or a stored cursor """
+    query = query_names(random_id).order_by("name")
+    results = list(query.limit(2))
+
+    cursor = query.cursor_for(results[-1])
+    assert [user.data.name for user in query.start_after(cursor)] == [
+        f"{random_id}_{idx}" for idx in range(2, 5)
+    ]
+    assert [user.data.name for user in query.start_after(results[0])] == [
+        f"{random_id}_{idx}" for idx in range(1, 5)
+    ]
+
+
+def test_query_select(query_users, random_id):
+    """ Projected queries only fetch the selected fields """
+    (user,) = User.query().where("handle", "==", random_id).select(["name"]).limit(1)
+    assert user.data.name == query_users[0].data.name
+    assert user.data.handle == ""
+
+
+def test_query_key_range(query_users, random_id):
+    """ Key ranges include the start key and stop before the end key """
+    keys = [user.key for user in query_users]
+    query = User.query().where("handle", "==", random_id)
+    assert [user.key for user in query.key_range(keys[1], keys[3])] == keys[1:3]
+    assert [user.key for user in query.key_range(start=keys[3])] == keys[3:]
+    assert [user.key for user in query.key_range(end=keys[1])] == keys[:1]
+
+    split = get_backend().partition_keys(User.collection, 3)
+    assert len(split) == 2
+    assert split == sorted(set(split))
+
+    # collections with fewer keys than ranges aren't split
+    assert get_backend().partition_keys(User.collection, len(keys) * 1000) == []
+    assert get_backend().partition_keys("_" + random_id, 3) == []
+
+
+def test_query_one(query_users, random_id):
+    """ Fetch single objects """
+    assert User.query_one("handle", "==", random_id).key == query_users[0].key
+    assert User.query_one("handle", "==", "_" + random_id) is OrmNotFound
+    assert len(list(User.query_all("handle", "==", random_id))) == 5
+
+    with pytest.raises(ValueError):
+        User.query().page_size(0)
+
+
+def test_async_persisted_state(orm_user):
+    """ Async load/save/delete share state with the sync API """
+
+    async def run():
+        assert not await orm_user.aio.exists()
+        orm_user.data.name = "async"
+        await orm_user.aio.save()
+        assert orm_user.persisted
+
+        user = User(orm_user.key)
+        await user.aio.load()
+        assert user.data.name == "async"
+
+        user.data.name = "async_changed"
+        await user.aio.save()
+        assert (await User.aio.get(orm_user.key)).data.name == "async_changed"
+
+        await user.aio.delete()
+        assert not user.persisted
+
+    asyncio.run(run())
+    assert not orm_user.exists
+
+    with pytest.raises(TypeError):
+        asyncio.run(User.aio.load())
+
+
+def test_async_batch_rejected(orm_user):
+    """ Async writes aren't collected by sync batches """
+
+    async def run():
+        with User.batch():
+            with pytest.raises(RuntimeError):
+                await orm_user.aio.save()
+            with pytest.raises(RuntimeError):
+                await orm_user.aio.delete()
+
+    asyncio.run(run())
+
+
+def test_async_no_key():
+    """ Async reads and deletes of objects without a key do nothing """
+
+    async def run():
+        user = User()
+        assert user.aio.doc_ref is DocRefNotFound
+        assert not await user.aio.exists()
+        await user.aio.load()
+        await user.aio.delete()
+        assert user.key is NoKey
+
+    asyncio.run(run())
+
+
+def test_async_query(query_users, random_id):
+    """ Async iteration pages through queries """
+
+    async def run():
+        query = User.query().where("handle", "==", random_id).page_size(2)
+        names = [user.data.name async for user in query]
+        assert names == [user.data.name for user in query_users]
+
+        found = await User.aio.get_many([query_users[0].key, "missing"])
+        assert found[0].key == query_users[0].key
+        assert found[1] is OrmNotFound
+
+    asyncio.run(run())
+
+
+def test_async_concurrent_saves(random_id):
+    """ Many objects can be saved concurrently """
+    users = [
+        User(User.make_key(Source.TEST, f"async_{random_id}_{idx}"))
+        for idx in range(10)
+    ]
+
+    async def run():
+        await asyncio.gather(*(user.aio.save() for user in users))
+        assert all(await asyncio.gather(*(user.aio.exists() for user in users)))
+        await asyncio.gather(*(user.aio.delete() for user in users))
+
+    asyncio.run(run())
+    assert not any(User(user.key).exists for user in users)
+
+
+def test_save_if_unmodified(orm_user):
+    """ Conditional saves fail if another write got there first """
+    orm_user.save(if_unmodified=True)
+    assert orm_user.update_time is not None
+
+    user = User(orm_user.key)
+    with pytest.raises(OrmConflict):
+        user.save(if_unmodified=True)
+
+    user.load()
+    orm_user.data.name = "first"
+    orm_user.save(if_unmodified=True)
+
+    user.data.name = "second"
+    with pytest.raises(OrmConflict):
+        user.save(if_unmodified=True)
+
+    user.load()
+    assert user.data.name == "first"
+    user.data.name = "second"
+    user.save(if_unmodified=True)
+
+
+def test_update_with_retry(orm_user):
+    """ Conflicting saves are retried after reloading """
+    orm_user.data.name = "start"
+    orm_user.save()
+    user = User.get(orm_user.key)
+
+    calls = []
+
+    def change():
+        calls.append(user.data.name)
+        if len(calls) == 1:
+            orm_user.data.name = "concurrent"
+            orm_user.save()
+        user.data.name = user.data.name + "_changed"
+
+    user.update_with_retry(change)
+    assert calls == ["start", "concurrent"]
+    assert User.get(orm_user.key).data.name == "concurrent_changed"
+
+    with pytest.raises(RuntimeError):
+        with User.batch():
+            user.update_with_retry(change)
+
+
+def test_batch_conflict(orm_user):
+    """ Conditional saves in a batch fail the batch, which gives update_times """
+    orm_user.save()
+    user = User.get(orm_user.key)
+    with User.batch():
+        user.data.name = "batched"
+        user.save(if_unmodified=True)
+    assert user.update_time is not None
+
+    orm_user.data.name = "concurrent"
+    orm_user.save()
+
+    with pytest.raises(OrmConflict):
+        with User.batch():
+            user.data.name = "conflict"
+            user.save(if_unmodified=True)
+
+
+def test_async_update_with_retry(orm_user):
+    """ Async conflicting saves are retried after reloading """
+    orm_user.save()
+
+    async def run():
+        user = await User.aio.get(orm_user.key)
+        orm_user.data.name = "concurrent"
+        orm_user.save()
+
+        user.data.name = "stale"
+        with pytest.raises(OrmConflict):
+            await user.aio.save(if_unmodified=True)
+
+        async def change():
+            user.data.name = user.data.name + "_changed"
+
+        await user.aio.update_with_retry(change)
+
+    asyncio.run(run())
+    assert User.get(orm_user.key).data.name == "concurrent_changed"
+
+
+def test_trusted_reads(orm_user, monkeypatch):
+    """ Data stamped with the storage model's schema isn't validated again """
+    orm_user.data.name = "trusted"
+    orm_user.save()
+    assert orm_user.doc_ref.get().get("schema") == schema_stamp(UserData)
+
+    def parse_obj(data):
+        raise AssertionError("validated")
+
+    monkeypatch.setattr(UserData, "parse_obj", parse_obj)
+    user = User(orm_user.key)
+    user.load()
+    assert user.data.name == "trusted"
+    assert isinstance(user.data, UserData)
+
+    # unstamped data is validated
+    orm_user.doc_ref.update({"schema": firestore.DELETE_FIELD})
+    with pytest.raises(AssertionError):
+        User(orm_user.key).load()
+
+
+def test_hydrate():
+    """ Only plain models with complete stamped data skip validation """
+
+    class Plain(BaseModel):
+        items: List[str] = []
+        count: Optional[int] = None
+
+    class Nested(BaseModel):
+        source: Source = Source.TEST
+
+    stamp = schema_stamp(Plain)
+    assert hydrate(Plain, {"items": ["a"], "count": "1"}, stamp).count == "1"
+    assert hydrate(Plain, {"items": ["a"], "count": "1"}, None).count == 1
+    assert hydrate(Plain, {"count": "1"}, stamp).count == 1
+    assert hydrate_raw(Plain, '{"items": [], "count": "1"}', stamp).count == "1"
+
+    nested = hydrate(Nested, {"source": "test"}, schema_stamp(Nested))
+    assert nested.source is Source.TEST
+
+
+def test_query_select_deferred(query_users, random_id):
+    """ Fields left out of projected queries are fetched on demand """
+    (user,) = User.query().where("handle", "==", random_id).select(["name"]).limit(1)
+    assert "profileImage" in user.deferred
+
+    user.data.name = "changed"
+    user.require("name")
+    assert "profileImage" in user.deferred
+
+    user.require("profileImage", "handle")
+    assert not user.deferred
+    assert user.data.handle == random_id
+    assert user.data.name == "changed"
+
+    user.save()
+    assert User.get(user.key).data.name == "changed"
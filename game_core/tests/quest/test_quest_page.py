@@ -1,9 +1,14 @@
 """ Test quest data """
 
+import asyncio
+from datetime import datetime, timedelta, timezone
+
 import pytest
 from firebase_utils import db
+from game import Game
 from quest_page import QuestPage
 from quest import DEBUG_QUEST_NAME, QuestError, QuestLoadError
+from tick import TickType
 
 
 def test_quest_fail(testing_game):
@@ -59,3 +64,160 @@ def test_quest(testing_game):
 
     # check it
     assert quest.exists
+
+
+def test_quest_parent(testing_game):
+    """ Quest pages have their game as parent """
+    quest = QuestPage.from_game_get_quest(testing_game, DEBUG_QUEST_NAME)
+    assert quest.parent.key == testing_game.key
+
+
+def test_iterate_all_prefetch(testing_quest_page, testing_game, testing_user):
+    """ Iterating with prefetch loads the game and user up front """
+    game = Game.from_user(testing_user)
+    game.set_fork_url(testing_game.data.fork_url)
+    game.save(upsert=True)
+    testing_quest_page.save()
+
+    for quest_page in QuestPage.iterate_all(prefetch_depth=2):
+        if quest_page.key == testing_quest_page.key:
+            break
+    else:
+        pytest.fail("Quest page not found")  # pragma: no cover
+
+    assert quest_page.parent.key == testing_game.key
+    assert quest_page.parent.persisted
+    assert quest_page.parent.data == testing_game.data
+    assert quest_page.parent.parent.key == testing_user.key
+    assert quest_page.parent.parent.persisted
+
+    testing_quest_page.delete()
+
+
+def test_async_prefetch(testing_quest_page, testing_game, testing_user):
+    """ Async iteration with prefetch loads the game and user up front """
+    testing_quest_page.save()
+    query = QuestPage.query().key_range(
+        testing_quest_page.key, testing_quest_page.key + "\0"
+    )
+
+    async def run():
+        (quest_page,) = [quest_page async for quest_page in query.prefetch(2)]
+        assert quest_page.fetched_parent.key == testing_game.key
+        assert quest_page.parent.parent.key == testing_user.key
+
+        # pages of prefetched objects are yielded as they fill up
+        orphan = QuestPage.from_game_get_quest(Game("missing"), DEBUG_QUEST_NAME)
+        objs = [orphan, quest_page]
+        pages = QuestPage.aio.with_parents(iterate(objs), page_size=1)
+        assert [obj async for obj in pages] == objs
+        assert orphan.fetched_parent is None
+
+    async def iterate(objs):
+        for obj in objs:
+            yield obj
+
+    asyncio.run(run())
+    testing_quest_page.delete()
+
+
+def test_iterate_all_projected(testing_quest_page):
+    """ Projected iteration defers the quest's save data until it's used """
+    testing_quest_page.mark_stage_complete("Start")
+    testing_quest_page.save()
+
+    for quest_page in QuestPage.iterate_all(fields=["completed"]):
+        if quest_page.key == testing_quest_page.key:
+            break
+    else:
+        pytest.fail("Quest page not found")  # pragma: no cover
+
+    assert quest_page.quest_deferred
+    assert "serialized_data" in quest_page.deferred
+    assert quest_page.is_stage_complete("Start")
+
+    # saving without using the quest leaves its save data alone
+    quest_page.mark_stage_complete("First")
+    quest_page.save()
+    assert quest_page.quest_deferred
+
+    assert quest_page.quest.version
+    assert not quest_page.deferred
+    assert quest_page.data.serialized_data == testing_quest_page.data.serialized_data
+
+    testing_quest_page.load()
+    assert testing_quest_page.completed_stages() == ["Start", "First"]
+
+    testing_quest_page.delete()
+
+
+def test_completed_migration(testing_quest_page):
+    """ Completed stages saved as a list are moved over to the bitmask """
+    testing_quest_page.data.completed_stages = ["First", "Start", "Gone"]
+    testing_quest_page.save()
+
+    testing_quest_page.load()
+    assert testing_quest_page.is_stage_complete("Start")
+    assert not testing_quest_page.is_stage_complete("Second")
+    assert testing_quest_page.completed_stages() == ["Start", "First"]
+    assert testing_quest_page.data.completed == b"\x03"
+    assert not testing_quest_page.data.completed_stages
+
+    testing_quest_page.save()
+    testing_quest_page.load()
+    assert testing_quest_page.completed_stages() == ["Start", "First"]
+
+    testing_quest_page.delete()
+
+
+def test_iterate_all_fast(testing_quest_page):
+    """ FAST ticks only iterate pages with stages that run on them """
+    testing_quest_page.set_frontier(["Second"], fast=False)
+    testing_quest_page.save()
+    keys = [page.key for page in QuestPage.iterate_all(tick_type=TickType.FAST)]
+    assert testing_quest_page.key not in keys
+
+    testing_quest_page.set_frontier(["Second"], fast=True)
+    testing_quest_page.save()
+    keys = [page.key for page in QuestPage.iterate_all(tick_type=TickType.FAST)]
+    assert testing_quest_page.key in keys
+
+    testing_quest_page.delete()
+
+
+def test_iterate_all_due(testing_quest_page):
+    """ Given a due time, only quests scheduled by then are iterated """
+    now = datetime.now(timezone.utc)
+    testing_quest_page.set_next_run(now + timedelta(minutes=5))
+    testing_quest_page.save()
+
+    keys = [page.key for page in QuestPage.iterate_all(due=now)]
+    assert testing_quest_page.key not in keys
+    keys = [page.key for page in QuestPage.iterate_all(due=now + timedelta(hours=1))]
+    assert testing_quest_page.key in keys
+
+    testing_quest_page.set_next_run(None)
+    testing_quest_page.save()
+    keys = [page.key for page in QuestPage.iterate_all(due=now + timedelta(hours=1))]
+    assert testing_quest_page.key not in keys
+
+    testing_quest_page.delete()
+
+
+def test_backfill_next_run(testing_quest_page):
+    """ Pages saved before next_run existed are scheduled by the backfill """
+    testing_quest_page.save()
+    doc_data = testing_quest_page.doc_ref.get().to_dict()
+    del doc_data["next_run"]
+    testing_quest_page.doc_ref.set(doc_data)
+
+    now = datetime.now(timezone.utc)
+    keys = [page.key for page in QuestPage.iterate_all(due=now)]
+    assert testing_quest_page.key not in keys
+
+    assert QuestPage.backfill_next_run(now) >= 1
+    keys = [page.key for page in QuestPage.iterate_all(due=now)]
+    assert testing_quest_page.key in keys
+    assert QuestPage.backfill_next_run(now) == 0
+
+    testing_quest_page.delete()
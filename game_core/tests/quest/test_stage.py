@@ -1,12 +1,22 @@
 """ Test for quest load/save handling system """
 
+import threading
+import time
+
 import pytest
 from semver import VersionInfo  # type:  ignore
 
-from tick import TickType
+from tick import TickType, TickBudget
 from quest import Quest, Difficulty, QuestDefinitionError, DEBUG_QUEST_NAME
-from quest.stage import DebugStage
-from quest.loader import all_quests
+from quest.stage import Stage, DebugStage, FinalStage
+from quest import FIRST_QUEST_NAME
+from quest.loader import (
+    all_quests,
+    check_manifest,
+    check_stage_ids,
+    load_manifest,
+    QuestRegistry,
+)
 from quest.content.debug import DebugQuest
 
 
@@ -15,31 +25,6 @@ class BadQuest(Quest):
     description = "Bad quest for testing, it is missing stuff"
 
 
-class BadStageCycle(Quest):
-    version = VersionInfo.parse("1.0.0")
-    difficulty = Difficulty.RESERVED
-    description = "Bad quest for testing, it has malformed stages"
-
-    class Start(DebugStage):
-        children = ["Loop"]
-
-    class Loop(DebugStage):
-        """ This should form a cycle, and get flagged by test """
-
-        children = ["Start"]
-
-
-class BadStageNotExist(Quest):
-    version = VersionInfo.parse("1.0.0")
-    difficulty = Difficulty.RESERVED
-    description = "Bad quest for testing, it has malformed stages"
-
-    class Start(DebugStage):
-        """ This references a stage that doesn't exist, and get flagged """
-
-        children = ["Loop"]
-
-
 def test_all_quest_instantiate(testing_quest_page):
     """Instantiate all quests to check abstract base class implementation
     and stage loading
@@ -50,6 +35,24 @@ def test_all_quest_instantiate(testing_quest_page):
         quest = quest_class(testing_quest_page)
 
 
+def test_manifest():
+    """ The quest manifest is up to date, and describes the quests it loads """
+    check_manifest()
+
+    registry = QuestRegistry()
+    assert set(registry) == {FIRST_QUEST_NAME, DEBUG_QUEST_NAME}
+    assert not registry.loaded
+
+    entry = load_manifest()[DEBUG_QUEST_NAME]
+    assert registry[DEBUG_QUEST_NAME] is DebugQuest
+    assert list(registry.loaded) == [DEBUG_QUEST_NAME]
+    assert entry.version == str(DebugQuest.version)
+    assert entry.difficulty == DebugQuest.difficulty
+
+    with pytest.raises(KeyError):
+        registry["NoSuchQuest"]
+
+
 def test_fail_instantiate(testing_quest_page):
     """ Test bad quests that fail to instantiate """
 
@@ -57,14 +60,35 @@ def test_fail_instantiate(testing_quest_page):
         BadQuest(testing_quest_page)
 
 
-def test_fail_stage(testing_quest_page):
-    """ Test bad quests that fail due to stage problems """
+def test_fail_stage():
+    """ Test bad quests that fail due to stage problems, when they are defined """
 
     with pytest.raises(QuestDefinitionError):
-        quest = BadStageCycle(testing_quest_page)
+
+        class BadStageCycle(Quest):
+            version = VersionInfo.parse("1.0.0")
+            difficulty = Difficulty.RESERVED
+            description = "Bad quest for testing, it has malformed stages"
+
+            class Start(DebugStage):
+                children = ["Loop"]
+
+            class Loop(DebugStage):
+                """ This should form a cycle, and get flagged by test """
+
+                children = ["Start"]
 
     with pytest.raises(QuestDefinitionError):
-        quest = BadStageNotExist(testing_quest_page)
+
+        class BadStageNotExist(Quest):
+            version = VersionInfo.parse("1.0.0")
+            difficulty = Difficulty.RESERVED
+            description = "Bad quest for testing, it has malformed stages"
+
+            class Start(DebugStage):
+                """ This references a stage that doesn't exist, and get flagged """
+
+                children = ["Loop"]
 
 
 def test_quest_has_stages(testing_quest_page):
@@ -84,11 +108,11 @@ def test_execute(testing_quest_page):
     """ Test quest execution """
 
     # check we didn't start off with any completed stages
-    assert not testing_quest_page.data.completed_stages
+    assert not testing_quest_page.completed_stages()
 
     # Debugquest is linear, so we expect to see only the start quest
     testing_quest_page.execute(TickType.FULL)
-    assert len(testing_quest_page.data.completed_stages) == len(
+    assert len(testing_quest_page.completed_stages()) == len(
         testing_quest_page.quest.stages
     )
 
@@ -101,7 +125,7 @@ def test_resume(testing_quest_page):
 
     # resume
     testing_quest_page.execute(TickType.FULL)
-    assert len(testing_quest_page.data.completed_stages) == len(
+    assert len(testing_quest_page.completed_stages()) == len(
         testing_quest_page.quest.stages
     )
 
@@ -110,9 +134,201 @@ def test_done_skip(testing_quest_page):
     """ Test quest execution skipping if done """
 
     # check we have no completed stages
-    assert not testing_quest_page.data.completed_stages
+    assert not testing_quest_page.completed_stages()
     testing_quest_page.mark_quest_complete()
 
     # excecution should just skip because we marked quest as complete
     testing_quest_page.execute(TickType.FULL)
-    assert not testing_quest_page.data.completed_stages
+    assert not testing_quest_page.completed_stages()
+
+
+def test_stage_plan(testing_quest_page):
+    """ Stage graphs are compiled once per class, runs only hold a cursor """
+    plan = DebugQuest.plan
+    assert plan.names == ("Start", "First", "Second")
+    assert plan.predecessors == (0, 1, 1)
+    assert DebugQuest(testing_quest_page).plan is plan
+
+    completed = set()
+    cursor = plan.cursor(completed.__contains__)
+    other = plan.cursor(completed.__contains__)
+    assert cursor.get_ready() == ("Start",)
+    assert cursor.get_ready() == ()
+    completed.add("Start")
+    cursor.done("Start")
+    assert cursor.get_ready() == ("First",)
+    assert other.get_ready() == ("Start",)
+    assert cursor.frontier() == ["First"]
+
+
+def test_stage_ids():
+    """ Stage ids default to definition order and can't be shared """
+    assert DebugQuest.plan.bits == {"Start": 1, "First": 2, "Second": 4}
+    assert DebugQuest.plan.unmask(5) == ["Start", "Second"]
+
+    with pytest.raises(QuestDefinitionError):
+
+        class DuplicateIdQuest(Quest):
+            version = VersionInfo.parse("1.0.0")
+            difficulty = Difficulty.RESERVED
+            description = "Bad quest for testing, it has clashing stage ids"
+
+            class Start(DebugStage):
+                children = ["Moved"]
+
+            class Moved(DebugStage):
+                children = []
+                stage_id = 0
+
+
+def test_stage_ids_manifest():
+    """ Stage ids recorded in the manifest can't change, or be reused """
+    saved = load_manifest()
+    assert saved[DEBUG_QUEST_NAME].stages == DebugQuest.plan.ids
+
+    def changed(stages):
+        entry = saved[DEBUG_QUEST_NAME].copy(update={"stages": stages})
+        return {**saved, DEBUG_QUEST_NAME: entry}
+
+    # new stages may be added with new ids, and stages removed
+    check_stage_ids(saved, changed({"Start": 0, "Inserted": 3, "Second": 2}))
+
+    # inserting a stage without stage ids shifts the ones after it
+    with pytest.raises(QuestDefinitionError):
+        check_stage_ids(saved, changed({"Start": 0, "Inserted": 1, "First": 2}))
+
+    # a removed stage's id would give its completion to another stage
+    with pytest.raises(QuestDefinitionError):
+        check_stage_ids(saved, changed({"Start": 0, "Second": 2, "Inserted": 1}))
+
+
+def test_resume_frontier(testing_quest_page):
+    """ Execution resumes from the saved frontier, not from the first stage """
+    testing_quest_page.data.completed_stages = ["Start"]
+    testing_quest_page.data.frontier = ["Second"]
+
+    # the frontier is trusted, so First isn't visited
+    testing_quest_page.execute(TickType.FULL)
+    assert testing_quest_page.completed_stages() == ["Start", "Second"]
+    assert testing_quest_page.data.frontier == []
+
+    # frontiers naming stages that don't exist are rebuilt from completed stages
+    testing_quest_page.data.frontier = ["Gone"]
+    testing_quest_page.data.complete = False
+    testing_quest_page.execute(TickType.FULL)
+    assert "First" in testing_quest_page.completed_stages()
+
+
+def test_concurrent_stages(testing_quest_page):
+    """ Ready stages run together with stage_workers, but complete in order """
+    barrier = threading.Barrier(2, timeout=5)
+
+    class WaitStage(DebugStage):
+        def execute(self):
+            barrier.wait()
+
+    class ConcurrentQuest(Quest):
+        version = VersionInfo.parse("1.0.0")
+        difficulty = Difficulty.RESERVED
+        description = "Quest for testing, its branches have to run together"
+        stage_workers = 2
+
+        class Start(DebugStage):
+            children = ["BranchA", "BranchB"]
+
+        class BranchA(WaitStage):
+            children = ["EndingA"]
+
+        class BranchB(WaitStage):
+            children = ["EndingB"]
+
+        class EndingA(FinalStage):
+            pass
+
+        class EndingB(FinalStage):
+            pass
+
+    quest = ConcurrentQuest(testing_quest_page)
+    quest.execute(TickType.FULL)
+
+    assert testing_quest_page.completed_stages() == [
+        "Start",
+        "BranchA",
+        "BranchB",
+        "EndingA",
+    ]
+    assert testing_quest_page.is_quest_complete()
+
+
+def test_stage_budget(testing_quest_page):
+    """ Execution stops when out of budget, and resumes from there next tick """
+    testing_quest_page.execute(TickType.FULL, TickBudget(max_stages=1))
+    assert testing_quest_page.completed_stages() == ["Start"]
+    assert testing_quest_page.get_frontier() == ["First"]
+
+    testing_quest_page.execute(TickType.FULL, TickBudget(duration=0))
+    assert testing_quest_page.completed_stages() == ["Start"]
+
+    testing_quest_page.execute(TickType.FULL, TickBudget(max_stages=2))
+    assert testing_quest_page.is_quest_complete()
+
+
+def test_stage_time(testing_quest_page):
+    """Stages always run to the end, but once one overran its time the rest are
+    left for the next tick
+    """
+
+    class SlowQuest(Quest):
+        version = VersionInfo.parse("1.0.0")
+        difficulty = Difficulty.RESERVED
+        description = "Quest for testing, its first stage is slow"
+
+        class Start(DebugStage):
+            children = ["Next"]
+
+            def execute(self):
+                time.sleep(0.05)
+
+        class Next(DebugStage):
+            children = []
+
+    quest = SlowQuest(testing_quest_page)
+    quest.execute(TickType.FULL, TickBudget(max_stage_time=0.01))
+    assert testing_quest_page.completed_stages() == ["Start"]
+    assert testing_quest_page.get_frontier() == ["Next"]
+
+    quest.execute(TickType.FULL, TickBudget(max_stage_time=5))
+    assert testing_quest_page.completed_stages() == ["Start", "Next"]
+
+    # stages aren't started without max_stage_time left before the deadline
+    budget = TickBudget(max_stage_time=5, duration=1)
+    assert not budget.stage_fits()
+    assert TickBudget(max_stage_time=5, duration=10).stage_fits()
+    assert not TickBudget(duration=0).stage_fits()
+
+
+def test_fast_tick(testing_quest_page):
+    """ FAST ticks only run stages that run on them, leaving the rest """
+
+    class MixedQuest(Quest):
+        version = VersionInfo.parse("1.0.0")
+        difficulty = Difficulty.RESERVED
+        description = "Quest for testing, it has a stage that only runs on FULL"
+
+        class Start(DebugStage):
+            children = ["Slow", "Quick"]
+
+        class Slow(Stage):
+            children = []
+
+        class Quick(DebugStage):
+            children = []
+
+    quest = MixedQuest(testing_quest_page)
+    quest.execute(TickType.FAST)
+    assert testing_quest_page.completed_stages() == ["Start", "Quick"]
+    assert testing_quest_page.get_frontier() == ["Slow"]
+    assert not testing_quest_page.data.fast
+
+    quest.execute(TickType.FULL)
+    assert testing_quest_page.completed_stages() == ["Start", "Slow", "Quick"]
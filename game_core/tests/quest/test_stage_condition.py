@@ -3,9 +3,11 @@
 import pytest
 from semver import VersionInfo  # type:  ignore
 import operator
+from datetime import datetime, timedelta, timezone
 
 from tick import TickType
-from quest import Quest, Difficulty
+from quest import Quest, Difficulty, waiting_on_conditions
+from quest.columns import VECTOR_OPERATORS, compare_columns, numeric_column
 from quest.quest import QuestBaseModel
 from quest.stage import DebugStage, ConditionStage, FinalStage
 
@@ -45,8 +47,8 @@ def test_initial_execute(testing_quest_page):
     quest = TestQuestBranching(testing_quest_page)
     quest.execute(TickType.FULL)
 
-    assert len(testing_quest_page.data.completed_stages) == 1
-    assert "Start" in testing_quest_page.data.completed_stages
+    assert len(testing_quest_page.completed_stages()) == 1
+    assert "Start" in testing_quest_page.completed_stages()
     assert not testing_quest_page.is_quest_complete()
 
 
@@ -76,3 +78,68 @@ def test_ending2(testing_quest_page):
     assert not testing_quest_page.is_stage_complete("BranchA")
     assert not testing_quest_page.is_stage_complete("EndingA")
     assert testing_quest_page.is_quest_complete()
+
+
+def test_next_run(testing_quest_page):
+    """ Failed conditions put off the quest, complete quests aren't run again """
+    quest = TestQuestBranching(testing_quest_page)
+    quest.execute(TickType.FULL)
+    next_run = testing_quest_page.data.next_run
+    assert next_run > datetime.now(timezone.utc) + timedelta(minutes=10)
+
+    quest.quest_data.value_a = 100
+    quest.execute(TickType.FULL)
+    assert testing_quest_page.is_quest_complete()
+    assert testing_quest_page.data.next_run is None
+
+
+def test_condition_batch(testing_quest_page):
+    """ Batches of conditions agree with conditions checked one at a time """
+    quests = [TestQuestBranching(testing_quest_page) for _ in range(4)]
+    for value, quest in enumerate(quests):
+        quest.quest_data.value_a = value * 5
+
+    for StageClass in (TestQuestBranching.BranchA, TestQuestBranching.BranchB):
+        assert StageClass.batchable()
+        assert StageClass.condition_batch(quests) == [
+            StageClass(quest).condition() for quest in quests
+        ]
+    assert TestQuestBranching.BranchB.condition_batch([]) == []
+
+
+def test_compare_columns():
+    """ Each row's values are compared by the operator """
+    assert compare_columns(operator.gt, [1, 5, 10], [2, 2, 2]) == [False, True, True]
+    assert compare_columns(operator.eq, ["a", "b"], ["a", "a"]) == [True, False]
+    assert compare_columns(operator.contains, [[1], [2]], [1, 1]) == [True, False]
+    assert compare_columns(operator.eq, [[1], [1, 2]], [[1], [1]]) == [True, False]
+    assert compare_columns(operator.eq, [1, None], [1, 2]) == [True, False]
+
+
+def test_compare_columns_vectorized():
+    """ Columns of numbers are compared by numpy, the same as row by row """
+    assert numeric_column([1, 2.5, True]) is not None
+    assert numeric_column(["a"]) is None
+    assert numeric_column([[1], [2]]) is None
+    assert numeric_column([1, None]) is None
+
+    left = [0, 1, 2, 3.5, False]
+    right = [1, 1, 1, 1, True]
+    for compare in VECTOR_OPERATORS:
+        passed = compare_columns(compare, left, right)
+        assert passed == [compare(*row) for row in zip(left, right)]
+        assert all(type(value) is bool for value in passed)
+    assert compare_columns(operator.eq, [], []) == []
+
+
+def test_waiting_on_conditions(testing_quest_page):
+    """ Quests only waiting on failing conditions don't need executing """
+    quest = TestQuestBranching(testing_quest_page)
+    assert waiting_on_conditions([quest]) == [None]
+
+    quest.execute(TickType.FULL)
+    next_run = waiting_on_conditions([quest])[0]
+    assert next_run > datetime.now(timezone.utc) + timedelta(minutes=10)
+
+    quest.quest_data.value_a = 100
+    assert waiting_on_conditions([quest]) == [None]
@@ -2,6 +2,8 @@
 
 import os
 import json
+import hmac
+import hashlib
 import pytest
 
 from pydantic import ValidationError
@@ -11,9 +13,10 @@ from firebase_utils import db, firestore
 from github_utils import GitHubHookFork
 import app.github_utils.github
 
-from user import User, Source
+from user import User, Source, UserData
 from game import Game
 from quest_page import QuestPage
+from quest import DEBUG_QUEST_NAME
 
 FUNCTION_SOURCE = "app/main.py"
 TEST_FILES = os.path.join(
@@ -123,6 +126,7 @@ def test_good_fork(webhook_listener_client, good_fork):
     quest = QuestPage.from_game_get_first_quest(game)
 
     assert game.exists
+    assert game.doc_ref.get().get("created")
     assert quest.exists
 
     # erase quest and run again
@@ -135,3 +139,128 @@ def test_good_fork(webhook_listener_client, good_fork):
     assert res.status_code == 200
 
     assert quest.exists
+
+
+def sign(payload: bytes) -> str:
+    """ Signature GitHub would send for a payload """
+    digest = hmac.new(
+        key=app.github_utils.github.WEBHOOK_SECRET.encode(),
+        msg=payload,
+        digestmod=hashlib.sha256,
+    ).hexdigest()
+    return f"sha256={digest}"
+
+
+def post_event(client, event, data):
+    """ Post a signed webhook event """
+    payload = json.dumps(data).encode()
+    headers = {
+        "Content-Type": "application/json",
+        "X-GitHub-Event": event,
+        "X-Hub-Signature-256": sign(payload),
+    }
+    return client.post("/", headers=headers, data=payload)
+
+
+@pytest.fixture
+def player_game(random_id):
+    """ A game played by a GitHub user, with a quest that hasn't run yet """
+    user_data = UserData(
+        profileImage="",
+        name="Test Player",
+        handle=random_id,
+        id=str(abs(hash(random_id))),
+        accessToken="",
+    )
+    user = User.new_from_data(random_id, Source.GITHUB, user_data)
+    game = Game.from_user(user)
+    game.set_fork_url(f"https://api.github.com/repos/{random_id}/lgtm")
+    game.save()
+    QuestPage.from_game_get_quest(game, DEBUG_QUEST_NAME).save()
+    yield game
+    game.delete()
+    user.delete()
+
+
+def test_activity(webhook_listener_client, player_game):
+    """ Activity on a player's fork executes their quests straight away """
+    owner = {"login": "player", "id": int(player_game.key.partition(":")[2])}
+    repository = {
+        "id": 1,
+        "full_name": player_game.data.fork_url.partition("/repos/")[2],
+        "owner": owner,
+        "url": player_game.data.fork_url,
+    }
+    issue = {"id": 2, "number": 1, "title": "Hi", "state": "open", "user": owner}
+    comment = {"id": 3, "body": "Hello", "user": owner}
+    data = {
+        "action": "created",
+        "issue": issue,
+        "comment": comment,
+        "repository": repository,
+        "sender": owner,
+    }
+
+    # activity on another of the player's repos is not routed
+    other = {**data, "repository": {**repository, "id": 2, "full_name": "other"}}
+    res = post_event(webhook_listener_client, "issue_comment", other)
+    assert res.status_code == 404
+
+    quest_page = QuestPage.from_game_get_quest(player_game, DEBUG_QUEST_NAME)
+    quest_page.load()
+    assert not quest_page.is_quest_complete()
+
+    res = post_event(webhook_listener_client, "issue_comment", data)
+    assert res.status_code == 200
+
+    quest_page.load()
+    assert quest_page.is_quest_complete()
+    quest_page.delete()
+
+    # the fork's id was stored when it was first matched by name
+    player_game.load()
+    assert player_game.data.fork_id == repository["id"]
+
+
+def test_activity_push(webhook_listener_client, player_game):
+    """Push payloads give the repo's html url rather than the API url, forks are
+    matched by id so they're routed all the same
+    """
+    player_game.set_fork_id(1)
+    player_game.save()
+
+    owner = {"login": "player", "id": int(player_game.key.partition(":")[2])}
+    repository = {
+        "id": 1,
+        "full_name": "player/renamed",
+        "owner": owner,
+        "url": "https://github.com/player/renamed",
+    }
+    data = {
+        "ref": "refs/heads/main",
+        "before": "0" * 40,
+        "after": "1" * 40,
+        "repository": repository,
+        "sender": owner,
+    }
+
+    res = post_event(webhook_listener_client, "push", data)
+    assert res.status_code == 200
+
+    quest_page = QuestPage.from_game_get_quest(player_game, DEBUG_QUEST_NAME)
+    quest_page.load()
+    assert quest_page.is_quest_complete()
+    quest_page.delete()
+
+    other = {**data, "repository": {**repository, "id": 2}}
+    res = post_event(webhook_listener_client, "push", other)
+    assert res.status_code == 404
+
+
+def test_activity_invalid(webhook_listener_client):
+    """ Events are validated against their own models, unknown ones are ignored """
+    res = post_event(webhook_listener_client, "push", {"ref": "refs/heads/main"})
+    assert res.status_code == 400
+
+    res = post_event(webhook_listener_client, "ping", {"zen": "Keep it simple"})
+    assert res.status_code == 200
@@ -1,19 +1,32 @@
 """ Tests for main.py """
 
+import sys
 import pytest
 import json
 from base64 import b64encode
+from datetime import datetime, timezone
 
 from functions_framework import create_app  # type: ignore
-from tick import TickEvent, TickType
+from firebase_utils import get_backend
+from quest_page import QuestPage
+from quest import FIRST_QUEST_NAME
+from orm.identity import current_identity_map
+from tick import TickEvent, TickType, TickShard
 
 FUNCTION_SOURCE = "app/main.py"
 
 
 @pytest.fixture(scope="module")
-def tick_client():
+def tick_app():
+    """ Tick app, and the main module it was loaded from """
+    app = create_app("tick", FUNCTION_SOURCE, "event")
+    return app, sys.modules["main"]
+
+
+@pytest.fixture(scope="module")
+def tick_client(tick_app):
     """ Tick clietn """
-    return create_app("tick", FUNCTION_SOURCE, "event").test_client()
+    return tick_app[0].test_client()
 
 
 @pytest.fixture
@@ -55,6 +68,136 @@ def test_tick(tick_client, tick_payload, testing_quest_page):
     # check if it's complete now
     testing_quest_page.load()
     assert testing_quest_page.is_quest_complete()
-    assert len(testing_quest_page.data.completed_stages) == len(
+    assert len(testing_quest_page.completed_stages()) == len(
         testing_quest_page.quest.stages
     )
+
+
+def test_tick_shard(tick_client, tick_payload, testing_quest_page):
+    """ Worker ticks only process the quests in their shard """
+    testing_quest_page.save()
+
+    key = testing_quest_page.key
+    shard = TickShard(start=key + "\0")
+    data = TickEvent(tick_type=TickType.FULL, shard=shard).json()
+    tick_payload["data"]["data"] = b64encode(data.encode()).decode()
+    res = tick_client.post("/", json=tick_payload)
+    assert res.status_code == 200
+
+    testing_quest_page.load()
+    assert not testing_quest_page.is_quest_complete()
+
+    shard = TickShard(start=key, end=key + "\0")
+    data = TickEvent(tick_type=TickType.FULL, shard=shard).json()
+    tick_payload["data"]["data"] = b64encode(data.encode()).decode()
+    res = tick_client.post("/", json=tick_payload)
+    assert res.status_code == 200
+
+    testing_quest_page.load()
+    assert testing_quest_page.is_quest_complete()
+    testing_quest_page.delete()
+
+
+def test_tick_error(
+    tick_client, tick_payload, testing_game, testing_quest_page, monkeypatch
+):
+    """ Pages executed before a page that raises are still saved """
+    testing_quest_page.set_next_run(datetime(2000, 1, 1, tzinfo=timezone.utc))
+    testing_quest_page.save()
+    failing_page = QuestPage.from_game_get_quest(testing_game, FIRST_QUEST_NAME)
+    failing_page.set_next_run(datetime(2000, 1, 2, tzinfo=timezone.utc))
+    failing_page.save()
+
+    execute = QuestPage.execute
+
+    def execute_or_fail(quest_page, *args):
+        if quest_page.key != testing_quest_page.key:
+            raise RuntimeError("Stage failed")
+        execute(quest_page, *args)
+
+    monkeypatch.setattr(QuestPage, "execute", execute_or_fail)
+    res = tick_client.post("/", json=tick_payload)
+    failing_page.delete()
+    assert res.status_code != 200
+
+    testing_quest_page.load()
+    assert testing_quest_page.is_quest_complete()
+    testing_quest_page.delete()
+
+
+def test_tick_conflict(tick_client, tick_payload, testing_quest_page, monkeypatch):
+    """ Pages saved by something else during the tick aren't overwritten """
+    testing_quest_page.save()
+
+    execute = QuestPage.execute
+
+    def execute_during_write(quest_page, *args):
+        execute(quest_page, *args)
+        testing_quest_page.doc_ref.update({"frontier": ["Other"]})
+
+    monkeypatch.setattr(QuestPage, "execute", execute_during_write)
+    res = tick_client.post("/", json=tick_payload)
+    assert res.status_code == 200
+
+    testing_quest_page.load()
+    assert testing_quest_page.get_frontier() == ["Other"]
+    assert not testing_quest_page.is_quest_complete()
+    testing_quest_page.delete()
+
+
+def test_tick_identity_scope(
+    tick_app, tick_client, tick_payload, testing_quest_page, monkeypatch
+):
+    """ Pages are executed in the tick's bounded identity scope """
+    testing_quest_page.save()
+    scopes = []
+
+    def execute(quest_page, *args):
+        scopes.append(current_identity_map.get())
+
+    monkeypatch.setattr(QuestPage, "execute", execute)
+    res = tick_client.post("/", json=tick_payload)
+    testing_quest_page.delete()
+    assert res.status_code == 200
+
+    assert scopes and scopes[0] is not None
+    assert all(scope is scopes[0] for scope in scopes)
+    assert scopes[0].max_size == tick_app[1].ORM_CACHE_SIZE
+
+
+def test_fan_out():
+    """ Coordinator ticks cover every key with one worker tick per shard """
+    tick_event = TickEvent(tick_type=TickType.FAST, shards=3)
+    worker_events = tick_event.fan_out(["b", "d"])
+    assert [(worker.shard.start, worker.shard.end) for worker in worker_events] == [
+        (None, "b"),
+        ("b", "d"),
+        ("d", None),
+    ]
+    assert all(worker.tick_type == TickType.FAST for worker in worker_events)
+    assert TickEvent(tick_type=TickType.FULL).fan_out([])[0].shard == TickShard()
+
+
+def test_tick_coordinator(tick_app, tick_client, tick_payload, random_id, monkeypatch):
+    """ Coordinator ticks publish worker ticks covering the whole key range """
+    collection = get_backend().collection(QuestPage.collection)
+    doc_refs = [collection.document(f"{random_id}_{idx}") for idx in range(6)]
+    for doc_ref in doc_refs:
+        doc_ref.set({})
+
+    published = []
+    monkeypatch.setattr(tick_app[1], "publish_ticks", published.extend)
+
+    data = TickEvent(tick_type=TickType.FAST, shards=3).json()
+    tick_payload["data"]["data"] = b64encode(data.encode()).decode()
+    res = tick_client.post("/", json=tick_payload)
+    for doc_ref in doc_refs:
+        doc_ref.delete()
+    assert res.status_code == 200
+
+    bounds = [(worker.shard.start, worker.shard.end) for worker in published]
+    assert len(bounds) == 3
+    assert bounds[0][0] is None and bounds[-1][1] is None
+    assert all(end == start for (_, end), (start, _) in zip(bounds, bounds[1:]))
+    assert all(worker.shards == 1 for worker in published)
+    assert all(worker.tick_type == TickType.FAST for worker in published)
@@ -0,0 +1,69 @@
+""" Tests for pipelined steps """
+
+from contextvars import ContextVar
+import threading
+
+import pytest
+from tick import run_pipeline
+
+scope: ContextVar[str] = ContextVar("scope", default="")
+
+
+def test_pipeline():
+    """ Items go through every step in order, with the caller's context """
+    results = []
+    threads = set()
+
+    def double(item):
+        threads.add(threading.get_ident())
+        return item * 2
+
+    def collect(item):
+        threads.add(threading.get_ident())
+        results.append((item, scope.get()))
+
+    scope.set("tick")
+    run_pipeline(range(20), [double, collect], queue_size=2)
+    assert results == [(item * 2, "tick") for item in range(20)]
+    assert len(threads) == 2
+    assert threading.get_ident() not in threads
+
+
+def test_pipeline_error():
+    """ The earliest item's error is raised, and later items are dropped """
+    saved = []
+    source_taken = []
+
+    def source():
+        for item in range(100):
+            source_taken.append(item)
+            yield item
+
+    def check(item):
+        if item in (3, 5):
+            raise ValueError(item)
+        return item
+
+    def save(item):
+        if item == 4:
+            raise KeyError(item)
+        saved.append(item)
+
+    with pytest.raises(ValueError) as err:
+        run_pipeline(source(), [check, save], queue_size=1)
+    assert err.value.args == (3,)
+    assert saved == [0, 1, 2]
+    assert len(source_taken) < 100
+
+
+def test_pipeline_source_error():
+    """ Errors iterating the source are raised too """
+
+    def source():
+        yield 1
+        raise RuntimeError("fetch failed")
+
+    saved = []
+    with pytest.raises(RuntimeError):
+        run_pipeline(source(), [saved.append])
+    assert saved == [1]
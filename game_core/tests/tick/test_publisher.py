@@ -0,0 +1,62 @@
+""" Tests for publishing ticks """
+
+from concurrent.futures import Future
+
+import pytest
+import google.auth  # type: ignore
+from google.cloud import pubsub_v1  # type: ignore
+
+from tick import TickEvent, TickType, TickShard, publish_ticks
+from tick import publisher
+
+
+class StubPublisherClient:
+    """ Collects published messages instead of sending them """
+
+    topic_path = staticmethod(pubsub_v1.PublisherClient.topic_path)
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, data):
+        self.published.append((topic, data))
+        future = Future()
+        future.set_result(str(len(self.published)))
+        return future
+
+
+@pytest.fixture
+def stub_publisher(monkeypatch):
+    """ A fresh publisher, created from the stub client """
+    monkeypatch.setattr(pubsub_v1, "PublisherClient", StubPublisherClient)
+    monkeypatch.setattr(publisher, "_publisher", None)
+    monkeypatch.setattr(publisher, "GCP_PROJECT_ID", "project")
+    return publisher.get_publisher()
+
+
+# pylint: disable=redefined-outer-name
+def test_publish_ticks(stub_publisher):
+    """ Each tick is published to the tick topic, by one publisher """
+    tick_events = TickEvent(tick_type=TickType.FULL, shards=2).fan_out(["b"])
+    publish_ticks(tick_events)
+
+    assert publisher.get_publisher() is stub_publisher
+    topics = {topic for topic, _ in stub_publisher.published}
+    assert topics == {f"projects/project/topics/{publisher.TICK_TOPIC}"}
+    shards = [TickEvent.parse_raw(data).shard for _, data in stub_publisher.published]
+    assert shards == [TickShard(start=None, end="b"), TickShard(start="b", end=None)]
+
+
+def test_project_fallback(stub_publisher, monkeypatch):
+    """ Without GCP_PROJECT_ID, the default credentials' project is used """
+    monkeypatch.setattr(publisher, "GCP_PROJECT_ID", "")
+    monkeypatch.setattr(google.auth, "default", lambda: (None, "default-project"))
+    assert publisher.get_project_id() == "default-project"
+
+    publish_ticks([TickEvent(tick_type=TickType.FAST)])
+    ((topic, _),) = stub_publisher.published
+    assert topic.startswith("projects/default-project/")
+
+    monkeypatch.setattr(google.auth, "default", lambda: (None, None))
+    with pytest.raises(RuntimeError):
+        publish_ticks([TickEvent(tick_type=TickType.FAST)])